@@ -1,20 +1,53 @@
 import argparse
+import asyncio
+import logging
 import mimetypes
+import os
+import shutil
 import string
+import sys
+import tempfile
+import time
 from contextlib import asynccontextmanager
+from datetime import timedelta
 from pathlib import Path
+from types import SimpleNamespace
+from typing import AsyncIterator, Iterable, Optional
 
+import aiofiles
 from sanic import response
 from sanic import Sanic
+from sanic.exceptions import ContentRangeError
+from sanic.exceptions import InvalidUsage
+from sanic.exceptions import NotFound
+from sanic.exceptions import PayloadTooLarge
+from sanic.exceptions import SanicException
+from sanic.exceptions import ServiceUnavailable
 from sanic.log import logger
 from sanic.response import json
+from sanic.response import json_dumps
 
 from . import app
+from . import bench
+from . import compression
 from . import db
+from . import error
+from . import metrics
+from . import preview
+from . import reaper
+from .asset_cache import AssetCache
+from .error import Error
+from .packfile import SEGMENT_CHANNEL
+from .packfile import PackStore
+from .tag_cache import TagCache
+from .tag_index import ASSET_CHANNEL
+from .tag_index import TagIndex
+from .tag_suggest import TagUsage
+from .write_batcher import WriteBatcher
 
 # NOTE: Nothing here is runnable yet
 
-server = Sanic(name="sham")
+server = Sanic(name="sham", env_prefix="SHAM_")
 
 
 # Documentation-provided functions for CORS
@@ -43,63 +76,845 @@ def add_cors_headers(request, response):
 server.register_middleware(add_cors_headers, "response")
 
 
-config = {
-    "asset_dir": Path("~/tmp").expanduser().as_posix(),
-    "db_user": "stephen",
-    "db_pass": "password",
+REQUEST_SECONDS = metrics.Histogram(
+    "sham_http_request_seconds",
+    "Time to respond to requests, up to the first byte for streamed responses",
+    ["method", "route"],
+)
+REQUESTS = metrics.Counter(
+    "sham_http_requests_total", "Requests answered", ["method", "route", "status"]
+)
+UPLOAD_BYTES = metrics.Counter("sham_upload_bytes_total", "Bytes of assets uploaded")
+DOWNLOAD_BYTES = metrics.Counter(
+    "sham_download_bytes_total", "Bytes of assets and previews sent"
+)
+DB_POOL_ACQUIRE_SECONDS = metrics.Histogram(
+    "sham_db_pool_acquire_seconds", "Time spent waiting for a database connection"
+)
+# These are read from their sources when `GET /metrics` is scraped, and
+# periodically by `metrics.WorkerMetrics`
+DB_POOL_CONNECTIONS = metrics.Gauge(
+    "sham_db_pool_connections", "Database connections, by state", ["state"]
+)
+DB_POOL_ACQUIRE_TIMEOUTS = metrics.Counter(
+    "sham_db_pool_acquire_timeouts_total", "Requests that gave up waiting for a connection"
+)
+TMP_DIR_FILES = metrics.Gauge("sham_tmp_dir_files", "Uploads in progress in asset_dir/tmp")
+TMP_DIR_BYTES = metrics.Gauge("sham_tmp_dir_bytes", "Size of asset_dir/tmp")
+ASSET_CACHE_BYTES = metrics.Gauge("sham_asset_cache_bytes", "Size of the asset cache")
+ASSET_CACHE_LOOKUPS = metrics.Counter(
+    "sham_asset_cache_lookups_total", "Asset cache lookups", ["result"]
+)
+
+
+def start_request_timer(request):
+    request.ctx.start_time = time.perf_counter()
+
+
+def record_request(request, response):
+    # Unmatched routes are lumped together, so junk URLs can't make new series
+    route = request.route.path if request.route else "unmatched"
+    REQUESTS.labels(request.method, route, response.status).inc()
+    if start_time := getattr(request.ctx, "start_time", None):
+        REQUEST_SECONDS.labels(request.method, route).observe(
+            time.perf_counter() - start_time
+        )
+
+
+server.register_middleware(start_request_timer, "request")
+server.register_middleware(record_request, "response")
+
+
+# Everything sham can be configured with, and the defaults. Each can be set
+# with an environment variable prefixed with SHAM_ (SHAM_ASSET_DIR=/srv/assets)
+# or the matching command line flag (--asset_dir /srv/assets), and flags win.
+# Settings live in `server.config`, so every worker sees the same ones.
+DEFAULT_CONFIG = {
+    "ASSET_DIR": Path("~/tmp").expanduser().as_posix(),
+    "HOST": "0.0.0.0",
+    "PORT": 8000,
+    # Each worker is a process with its own connection pool and caches
+    "WORKERS": 1,
+    "DB_URL": None,
+    "DB_USER": "stephen",
+    "DB_PASS": "password",
+    "DB_POOL_MIN_SIZE": 2,
+    "DB_POOL_MAX_SIZE": 10,
+    # Seconds to wait for a free connection before giving up with a 503
+    "DB_POOL_ACQUIRE_TIMEOUT": 10.0,
+    "DB_STATEMENT_CACHE_SIZE": 100,
+    # When false, the server refuses to start against an out of date schema
+    # instead of migrating it (see `sham migrate`)
+    "MIGRATE_ON_STARTUP": True,
+    "MAX_UPLOAD_SIZE": 50_000_000,
+    # Batch uploads are held in memory until they're parsed, and every request
+    # in flight holds its own, so this is well under MAX_UPLOAD_SIZE. Big files
+    # go to `POST /assets` one at a time, which streams them to disk.
+    "MAX_BATCH_UPLOAD_SIZE": 16_000_000,
+    "MAX_BATCH_FILES": 1000,
+    # Store identical uploads once, see `app.AssetWriter`
+    "CONTENT_ADDRESSED": False,
+    # Pack uploads up to PACK_MAX_ASSET_SIZE bytes into segment files instead
+    # of a file each, see `packfile.PackStore`. Assets that were packed can
+    # still be read with this off.
+    "PACKS": False,
+    "PACK_MAX_ASSET_SIZE": 64 * 1024,
+    "PACK_SEGMENT_SIZE": 256 * 1024 * 1024,
+    # Keep every tag in memory, see `tag_cache.TagCache`
+    "TAG_CACHE": True,
+    # Seconds between recounting how many assets each tag is on, which ranks
+    # `GET /tags/suggest`. Needs the tag cache.
+    "TAG_USAGE_INTERVAL": 60.0,
+    # Answer tag searches from bitmaps in memory, see `tag_index.TagIndex`
+    "TAG_INDEX": False,
+    # Make small previews of uploaded images, see `preview.PreviewRenderer`.
+    # Needs Pillow.
+    "PREVIEWS": True,
+    "PREVIEW_WORKERS": 2,
+    # Small assets are kept in memory once read, see `asset_cache.AssetCache`.
+    # A size of 0 turns the cache off.
+    "ASSET_CACHE_SIZE": 64 * 1024 * 1024,
+    "ASSET_CACHE_MAX_ENTRY_SIZE": 256 * 1024,
+    # Keep gzip (and zstd, with zstandard installed) copies of text-like
+    # uploads to send to clients that accept them, see
+    # `compression.VariantWriter`
+    "COMPRESSION": True,
+    "COMPRESSION_WORKERS": 1,
+    "COMPRESSION_MIN_SIZE": 1024,
+    # Commit small writes that arrive together in one transaction, see
+    # `write_batcher.WriteBatcher`. The delay is in seconds.
+    "WRITE_BATCHING": False,
+    "WRITE_BATCH_SIZE": 100,
+    "WRITE_BATCH_DELAY": 0.002,
+    # Clean up after deleted assets and failed uploads, see `reaper.reap`.
+    # Times are in seconds.
+    "REAPER": True,
+    "REAPER_INTERVAL": 600.0,
+    "REAPER_GRACE_PERIOD": 86400.0,
+    "REAPER_BATCH_SIZE": 1000,
+    "REAPER_BATCH_DELAY": 0.1,
+    # Log what would be removed without removing anything
+    "REAPER_DRY_RUN": False,
+    # Where each worker writes its metrics for `GET /metrics` to merge, see
+    # `metrics.WorkerMetrics`. A temporary directory by default. The interval
+    # is in seconds.
+    "METRICS_DIR": None,
+    "METRICS_INTERVAL": 5.0,
+}
+
+for key, value in DEFAULT_CONFIG.items():
+    server.config.setdefault(key, value)
+
+# Counters for how the pool is being used, reported by `GET /stats`
+pool_stats = {
+    "acquired": 0,
+    "acquire_timeouts": 0,
+    "acquire_wait_seconds": 0.0,
 }
 
 
+def get_db_url():
+    if db_url := server.config.DB_URL:
+        return db_url
+
+    return db.db_url(server.config.DB_USER, server.config.DB_PASS)
+
+
+@server.listener("main_process_start")
+async def migrate_db(app, loop):
+    # This runs once, before any workers are started
+    if server.config.MIGRATE_ON_STARTUP:
+        await db.migrate_db_by_url(get_db_url())
+
+
+@server.listener("main_process_start")
+async def create_metrics_dir(app, loop):
+    # Workers are forked after this, so they all see the same directory
+    app.ctx.metrics_tmp_dir = None
+    if not server.config.METRICS_DIR:
+        app.ctx.metrics_tmp_dir = server.config.METRICS_DIR = tempfile.mkdtemp(
+            prefix="sham-metrics-"
+        )
+
+
+@server.listener("main_process_stop")
+async def remove_metrics_dir(app, loop):
+    if app.ctx.metrics_tmp_dir:
+        shutil.rmtree(app.ctx.metrics_tmp_dir, ignore_errors=True)
+
+
+@server.listener("before_server_start")
+async def create_db_pool(app, loop):
+    db_url = get_db_url()
+
+    conn = await db.connect_to_db_by_url(db_url)
+    try:
+        if not await db.schema_is_current(conn):
+            raise RuntimeError("Database schema is out of date, run `sham migrate`")
+    finally:
+        await conn.close()
+
+    app.ctx.db_pool = await db.create_pool(
+        db_url,
+        min_size=server.config.DB_POOL_MIN_SIZE,
+        max_size=server.config.DB_POOL_MAX_SIZE,
+        statement_cache_size=server.config.DB_STATEMENT_CACHE_SIZE,
+    )
+
+    app.ctx.tag_cache = None
+    app.ctx.tag_usage = None
+    if server.config.TAG_CACHE:
+        app.ctx.tag_cache = TagCache()
+        await app.ctx.tag_cache.start(app.ctx.db_pool, db_url)
+        # Started by the first `GET /tags/suggest`
+        app.ctx.tag_usage = TagUsage(app.ctx.db_pool, server.config.TAG_USAGE_INTERVAL)
+
+    app.ctx.tag_index = None
+    if server.config.TAG_INDEX:
+        app.ctx.tag_index = TagIndex()
+        await app.ctx.tag_index.start(app.ctx.db_pool, db_url)
+
+
+@server.listener("after_server_stop")
+async def close_db_pool(app, loop):
+    if app.ctx.tag_cache:
+        await app.ctx.tag_cache.close()
+
+    if app.ctx.tag_usage:
+        await app.ctx.tag_usage.close()
+
+    if app.ctx.tag_index:
+        await app.ctx.tag_index.close()
+
+    await app.ctx.db_pool.close()
+
+
+@server.listener("before_server_start")
+async def create_pack_store(app, loop):
+    app.ctx.packs = PackStore(
+        server.config.ASSET_DIR,
+        app.ctx.db_pool.acquire,
+        server.config.PACK_MAX_ASSET_SIZE if server.config.PACKS else 0,
+        server.config.PACK_SEGMENT_SIZE,
+    )
+
+
+@server.listener("after_server_stop")
+async def close_pack_store(app, loop):
+    # Seals this worker's segment, so it's closed before the pool is
+    await app.ctx.packs.close()
+
+
+@server.listener("before_server_start")
+async def create_asset_cache(app, loop):
+    app.ctx.asset_cache = None
+    if server.config.ASSET_CACHE_SIZE:
+        app.ctx.asset_cache = AssetCache(
+            server.config.ASSET_CACHE_SIZE, server.config.ASSET_CACHE_MAX_ENTRY_SIZE
+        )
+
+
+def _forget_asset(asset_id: int):
+    server.ctx.packs.discard(asset_id)
+    if asset_cache := server.ctx.asset_cache:
+        asset_cache.discard(asset_id)
+        for encoding in compression.ENCODINGS:
+            asset_cache.discard((asset_id, encoding))
+
+
+def _on_asset_notification(payload: str):
+    # "<sequence number> <op> <item> <item>...", see `notify_batched`
+    _seq, op, *items = payload.split(" ")
+    if op in ("DELETED", "PURGED"):
+        for item in items:
+            _forget_asset(int(item))
+
+
+def _on_segment_notification(payload: str):
+    _seq, _op, *items = payload.split(" ")
+    for item in items:
+        server.ctx.packs.discard_segment(int(item))
+
+
+async def _forget_all_assets():
+    # Anything could have been deleted while we weren't listening
+    server.ctx.packs.clear()
+    if asset_cache := server.ctx.asset_cache:
+        asset_cache.clear()
+
+
+@server.listener("before_server_start")
+async def start_asset_listener(app, loop):
+    # Deletes in other workers and the reaper's purges have to reach the
+    # locations and cached assets this worker remembers
+    app.ctx.asset_listener = db.Listener(
+        get_db_url(),
+        {
+            ASSET_CHANNEL: _on_asset_notification,
+            SEGMENT_CHANNEL: _on_segment_notification,
+        },
+        _forget_all_assets,
+    )
+    await app.ctx.asset_listener.start()
+
+
+@server.listener("after_server_stop")
+async def stop_asset_listener(app, loop):
+    await app.ctx.asset_listener.close()
+
+
+@server.listener("before_server_start")
+async def start_previews(app, loop):
+    app.ctx.previews = None
+    if server.config.PREVIEWS:
+        if preview.previews_available():
+            app.ctx.previews = preview.PreviewRenderer(
+                server.config.ASSET_DIR,
+                server.config.PREVIEW_WORKERS,
+                packs=app.ctx.packs,
+            )
+            app.ctx.previews.start()
+        else:
+            logger.warning("Pillow isn't installed, previews are turned off")
+
+
+@server.listener("after_server_stop")
+async def stop_previews(app, loop):
+    if app.ctx.previews:
+        await app.ctx.previews.close()
+
+
+@server.listener("before_server_start")
+async def create_write_batcher(app, loop):
+    app.ctx.write_batcher = None
+    if server.config.WRITE_BATCHING:
+        app.ctx.write_batcher = WriteBatcher(
+            get_db_conn,
+            server.config.WRITE_BATCH_SIZE,
+            server.config.WRITE_BATCH_DELAY,
+        )
+
+
+@server.listener("after_server_stop")
+async def close_write_batcher(app, loop):
+    if app.ctx.write_batcher:
+        await app.ctx.write_batcher.close()
+
+
+@server.listener("before_server_start")
+async def start_reaper(app, loop):
+    # Every worker runs one, but a lock in the database lets only one of them
+    # reap at a time
+    app.ctx.reaper = None
+    if server.config.REAPER:
+        app.ctx.reaper = reaper.Reaper(
+            app.ctx.db_pool,
+            server.config.ASSET_DIR,
+            server.config.REAPER_INTERVAL,
+            timedelta(seconds=server.config.REAPER_GRACE_PERIOD),
+            server.config.REAPER_BATCH_SIZE,
+            server.config.REAPER_BATCH_DELAY,
+            server.config.REAPER_DRY_RUN,
+        )
+        app.ctx.reaper.start()
+
+
+@server.listener("after_server_stop")
+async def stop_reaper(app, loop):
+    if app.ctx.reaper:
+        await app.ctx.reaper.close()
+
+
+async def reap_once() -> Optional[reaper.ReapResult]:
+    conn = await db.connect_to_db_by_url(get_db_url())
+    try:
+        return await reaper.reap(
+            conn,
+            server.config.ASSET_DIR,
+            timedelta(seconds=server.config.REAPER_GRACE_PERIOD),
+            server.config.REAPER_BATCH_SIZE,
+            server.config.REAPER_BATCH_DELAY,
+            server.config.REAPER_DRY_RUN,
+        )
+    finally:
+        await conn.close()
+
+
+@server.listener("before_server_start")
+async def start_variants(app, loop):
+    app.ctx.variants = None
+    if server.config.COMPRESSION:
+        app.ctx.variants = compression.VariantWriter(
+            server.config.ASSET_DIR,
+            server.config.COMPRESSION_WORKERS,
+            server.config.COMPRESSION_MIN_SIZE,
+            packs=app.ctx.packs,
+        )
+        app.ctx.variants.start()
+
+
+@server.listener("after_server_stop")
+async def stop_variants(app, loop):
+    if app.ctx.variants:
+        await app.ctx.variants.close()
+
+
+def _after_upload(assets: Iterable[tuple[int, str]]):
+    # Previews and compressed variants are made in the background, the upload
+    # doesn't wait for them
+    previews = server.ctx.previews
+    variants = server.ctx.variants
+    for asset_id, name in assets:
+        if previews:
+            previews.submit(asset_id, name)
+        if variants:
+            variants.submit(asset_id, name)
+
+
 @asynccontextmanager
 async def get_db_conn():
-    # TODO: connection pooling
-    if db_url := config.get("db_url"):
-        conn = await db.connect_to_db_by_url(db_url)
-    else:
-        conn = await db.connect_to_db(config["db_user"], config["db_pass"])
+    pool = server.ctx.db_pool
+
+    start = time.monotonic()
+    try:
+        conn = await pool.acquire(timeout=server.config.DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats["acquire_timeouts"] += 1
+        DB_POOL_ACQUIRE_TIMEOUTS.inc()
+        raise ServiceUnavailable("Timed out waiting for a database connection")
+    finally:
+        wait = time.monotonic() - start
+        pool_stats["acquire_wait_seconds"] += wait
+        DB_POOL_ACQUIRE_SECONDS.observe(wait)
 
+    pool_stats["acquired"] += 1
     try:
         yield conn
     finally:
-        await conn.close()
+        await pool.release(conn)
+
+
+async def small_write(f, *args):
+    """
+    Run `f(conn, *args)`, one of the small writes in `app`, batched with
+    others if write batching is on.
+    """
+    if write_batcher := server.ctx.write_batcher:
+        return await write_batcher.submit(f, *args)
+
+    async with get_db_conn() as conn:
+        return await f(conn, *args)
+
+
+# Asset ids never change content, so caches can keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+
+    return False
+
+
+def _parse_range(range_header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    Returns the inclusive (start, end) of a single byte range, or None when
+    the whole asset should be sent. Raises ContentRangeError when the range
+    can't be satisfied.
+    """
+    if not range_header:
+        return None
+
+    unit, _, ranges = range_header.partition("=")
+    # Multiple ranges are allowed to be ignored, we send the whole thing
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition("-")
+    try:
+        if not start:
+            # "bytes=-500" is the last 500 bytes
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise ContentRangeError("Range not satisfiable", SimpleNamespace(total=size))
+
+    return start, end
+
+
+async def _read_asset(key, open_file):
+    """
+    An asset (or one of its variants) from the asset cache as bytes, or else
+    the file opened by `open_file`. Small files are read whole and cached so
+    the next request can skip the disk. Returns `(body, file)`, one of which
+    is None.
+    """
+    asset_cache = server.ctx.asset_cache
+    if asset_cache:
+        if (body := asset_cache.get(key)) is not None:
+            ASSET_CACHE_LOOKUPS.labels("hit").inc()
+            return body, None
+        ASSET_CACHE_LOOKUPS.labels("miss").inc()
+
+    f = await open_file()
+    if asset_cache and asset_cache.fits(app.asset_size(f)):
+        try:
+            body = await f.read()
+        finally:
+            await f.close()
+        asset_cache.put(key, body)
+        return body, None
+
+    return None, f
 
 
 @server.route("/assets/<asset_id_with_extension>", methods=["GET"])
 async def get_asset(request, asset_id_with_extension):
     # We allow {asset-id}.{whatever-extension} and we guess the mime types.
     # Otherwise everything is octet streams.
+    try:
+        asset_id = int(Path(asset_id_with_extension).stem)
+    except ValueError:
+        raise NotFound(f"{asset_id_with_extension} is not an asset")
 
-    # TODO: error handling
-    asset_id = int(Path(asset_id_with_extension).stem)
+    content_type = (
+        mimetypes.guess_type(asset_id_with_extension)[0] or "application/octet-stream"
+    )
+    etag = f'"{asset_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
 
-    return response.raw(
-        # TODO: error handling
-        await app.get_asset(config["asset_dir"], asset_id),
-        headers={
-            "Content-Type": mimetypes.guess_type(asset_id_with_extension)[0]
-            or "application/octet-stream"
-        },
+    # Text-like assets may have compressed variants, made when they were
+    # uploaded (see `compression.VariantWriter`). Ranges are always of the
+    # unencoded asset.
+    encoding = None
+    if server.ctx.variants and compression.is_compressible(content_type):
+        headers["Vary"] = "Accept-Encoding"
+        if "range" not in request.headers:
+            encoding = compression.negotiate(
+                request.headers.get("accept-encoding"), compression.ENCODINGS
+            )
+
+    # Deleted assets keep their files until they're reaped, so look before
+    # answering, even with a 304. Deletes evict cached assets (see
+    # `_forget_asset`), so anything in the cache is still live.
+    asset_cache = server.ctx.asset_cache
+    cached = asset_cache is not None and any(
+        key in asset_cache for key in [asset_id, (asset_id, encoding)]
     )
+    if not cached:
+        async with get_db_conn() as conn:
+            if not await app.asset_exists(conn, asset_id):
+                raise NotFound(f"asset {asset_id} not found")
+
+    if_none_match = request.headers.get("if-none-match")
+    if encoding and _etag_matches(if_none_match, f'"{asset_id}-{encoding}"'):
+        headers["ETag"] = f'"{asset_id}-{encoding}"'
+        return response.empty(status=304, headers=headers)
+    if _etag_matches(if_none_match, etag):
+        return response.empty(status=304, headers=headers)
+
+    body = f = None
+    if encoding:
+        variant_path = compression.variant_path_from_dir_and_id(
+            server.config.ASSET_DIR, asset_id, encoding
+        )
+        try:
+            body, f = await _read_asset(
+                (asset_id, encoding), lambda: aiofiles.open(variant_path, "rb")
+            )
+            etag = headers["ETag"] = f'"{asset_id}-{encoding}"'
+            headers["Content-Encoding"] = encoding
+        except FileNotFoundError:
+            # Not worth compressing, or not compressed yet
+            pass
+
+    if body is None and f is None:
+        try:
+            body, f = await _read_asset(
+                asset_id,
+                lambda: app.open_asset(
+                    server.config.ASSET_DIR, asset_id, server.ctx.packs
+                ),
+            )
+        except app.AssetNotFound:
+            raise NotFound(f"asset {asset_id} not found")
+
+    try:
+        size = len(body) if body is not None else app.asset_size(f)
+
+        # A Range is only honoured if the client's copy (if any) is still current
+        if_range = request.headers.get("if-range")
+        byte_range = None
+        if if_range is None or if_range == etag:
+            byte_range = _parse_range(request.headers.get("range"), size)
+
+        if byte_range:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        else:
+            start, end = 0, size - 1
+            status = 200
+
+        DOWNLOAD_BYTES.inc(end - start + 1)
+        if body is not None:
+            return response.raw(
+                body[start : end + 1],
+                status=status,
+                headers=headers,
+                content_type=content_type,
+            )
+
+        headers["Content-Length"] = str(end - start + 1)
+
+        # Stream the file so large assets (and many concurrent downloads) don't
+        # have to fit in memory
+        stream = await request.respond(
+            status=status, headers=headers, content_type=content_type
+        )
+        async for chunk in app.read_chunks(f, start, end - start + 1):
+            await stream.send(chunk)
+        await stream.eof()
+    finally:
+        if f:
+            await f.close()
+
+
+# Largest page of assets a search can ask for
+MAX_SEARCH_LIMIT = 1000
+
+
+def _int_args(request, name) -> list[int]:
+    try:
+        return [int(value) for value in request.args.getlist(name, [])]
+    except ValueError:
+        raise InvalidUsage(f"{name} must be an integer")
+
+
+def _search_params_from_request(request) -> app.SearchParams:
+    """
+    - `tag=<tag-id>`, repeatable: assets must have every tag
+    - `exclude_tag=<tag-id>`, repeatable: assets must have none of these tags
+    - `kv=<key>=<value>`, repeatable: assets must have a tag with this key and value
+    - `name_prefix=<prefix>`
+    - `after_id=<asset-id>`, `limit=<n>`: pagination
+    """
+    key_values = []
+    for key_value in request.args.getlist("kv", []):
+        key, sep, value = key_value.partition("=")
+        if not sep:
+            raise InvalidUsage("kv must look like <key>=<value>")
+        key_values.append((key, value))
+
+    after_id = _int_args(request, "after_id")
+    limit = _int_args(request, "limit")
+    if limit and not 0 < limit[0] <= MAX_SEARCH_LIMIT:
+        raise InvalidUsage(f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+
+    search_params = app.SearchParams(
+        tag_ids=_int_args(request, "tag"),
+        exclude_tag_ids=_int_args(request, "exclude_tag"),
+        key_values=key_values,
+        name_prefix=request.args.get("name_prefix"),
+        after_id=after_id[0] if after_id else None,
+    )
+    if limit:
+        search_params.limit = limit[0]
+
+    return search_params
+
+
+def _tag_index_for(search_params: app.SearchParams) -> Optional[TagIndex]:
+    """
+    The tag index, if there is one and it can answer this search on its own.
+    """
+    tag_index = server.ctx.tag_index
+    if tag_index and not search_params.key_values and not search_params.name_prefix:
+        return tag_index
+
+    return None
 
 
 @server.route("/assets", methods=["GET"])
 async def get_assets(request):
+    search_params = _search_params_from_request(request)
+
     async with get_db_conn() as conn:
-        assets = await app.get_assets(conn, app.SearchParams)
+        if tag_index := _tag_index_for(search_params):
+            asset_ids = tag_index.search(
+                search_params.tag_ids,
+                search_params.exclude_tag_ids,
+                search_params.after_id,
+                search_params.limit,
+            )
+            assets = await app.get_assets_by_ids(conn, asset_ids)
+        else:
+            assets = await app.get_assets(conn, search_params)
+            asset_ids = [asset.asset_id for asset in assets]
+
+    # A full page means there may be more. This goes by the ids searched
+    # rather than the assets found, in case the index is a moment behind a
+    # delete.
+    next_after_id = None
+    if len(asset_ids) == search_params.limit:
+        next_after_id = asset_ids[-1]
+
+    return json({
+        "asset": [asset.to_dict() for asset in assets],
+        "next_after_id": next_after_id,
+    })
 
-    return json({"asset": [asset.to_dict() for asset in assets]})
 
+@server.route("/assets/count", methods=["GET"])
+async def count_assets(request):
+    # Takes the same search parameters as `GET /assets`
+    search_params = _search_params_from_request(request)
 
-@server.route("/assets", methods=["POST"])
+    if tag_index := _tag_index_for(search_params):
+        count = tag_index.count(search_params.tag_ids, search_params.exclude_tag_ids)
+    else:
+        async with get_db_conn() as conn:
+            count = await app.count_assets(conn, search_params)
+
+    return json({"count": count})
+
+
+# Most values returned for each facet key
+MAX_FACET_LIMIT = 1000
+
+
+@server.route("/assets/facets", methods=["GET"])
+async def get_facets(request):
+    # Takes the same search parameters as `GET /assets`, and
+    # - `facet=<key>`, repeatable: only count tags with these keys
+    # - `facet_limit=<n>`: values returned for each key, most common first
+    search_params = _search_params_from_request(request)
+    keys = request.args.getlist("facet") or None
+    facet_limit = _int_args(request, "facet_limit") or [10]
+    if not 0 < facet_limit[0] <= MAX_FACET_LIMIT:
+        raise InvalidUsage(f"facet_limit must be between 1 and {MAX_FACET_LIMIT}")
+
+    tag_index = _tag_index_for(search_params)
+    if tag_index and (tag_cache := server.ctx.tag_cache):
+        # The index knows which assets have each tag, the cache knows each
+        # tag's key and value
+        matching = tag_index.matching(
+            search_params.tag_ids, search_params.exclude_tag_ids
+        )
+        tags = {
+            tag.tag_id: tag
+            for tag in tag_cache.by_id.values()
+            if keys is None or tag.key in keys
+        }
+        counts = tag_index.facet_counts(matching, tags)
+        total = len(matching)
+        facets = app.top_facets(
+            [
+                app.FacetCount(tag_id, tags[tag_id].key, tags[tag_id].value, count)
+                for tag_id, count in counts.items()
+            ],
+            facet_limit[0],
+        )
+    else:
+        async with get_db_conn() as conn:
+            total = await app.count_assets(conn, search_params)
+            facets = await app.get_facets(conn, search_params, keys, facet_limit[0])
+
+    # {"total": 3, "facets": {"game": [{"tag_id": 1, "value": "SM64", "count": 2}]}}
+    by_key = {}
+    for facet in facets:
+        by_key.setdefault(facet.key, []).append(
+            {"tag_id": facet.tag_id, "value": facet.value, "count": facet.count}
+        )
+
+    return json({"total": total, "facets": by_key})
+
+
+@server.route("/assets", methods=["POST"], stream=True)
 async def post_asset(request):
+    # Either a multipart form with a "file" (and optionally a "filename"), or
+    # the raw file as the request body with the name in `?filename=`. Raw
+    # bodies are streamed straight to disk, so they're the way to send large
+    # files.
+    max_upload_size = server.config.MAX_UPLOAD_SIZE
+    if _content_length(request) > max_upload_size:
+        raise PayloadTooLarge("file body too large")
+
+    if request.content_type.startswith("multipart/form-data"):
+        return await _post_asset_form(request)
+
+    filename = request.args.get("filename", "")
+
+    try:
+        async with app.AssetWriter(
+            server.config.ASSET_DIR,
+            max_upload_size,
+            server.config.CONTENT_ADDRESSED,
+            server.ctx.packs,
+        ) as writer:
+            async for chunk in request.stream:
+                UPLOAD_BYTES.inc(len(chunk))
+                await writer.write(chunk)
+
+            async with get_db_conn() as conn:
+                asset_id = await writer.commit(conn, filename)
+    except app.AssetTooLarge:
+        raise PayloadTooLarge("file body too large")
+
+    _after_upload([(asset_id, filename)])
+    return json({"id": asset_id})
+
+
+def _content_length(request) -> int:
+    # 0 when there isn't one, like a chunked upload
+    value = request.headers.get("content-length", "0")
+    try:
+        length = int(value)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise InvalidUsage(f"invalid content-length {value!r}")
+    return length
+
+
+async def _receive_form(request, max_size):
+    # Multipart forms are parsed from the whole body, but at least stop reading
+    # as soon as it's too big
+    if _content_length(request) > max_size:
+        raise PayloadTooLarge("body too large")
+
+    body = bytearray()
+    async for chunk in request.stream:
+        body += chunk
+        if len(body) > max_size:
+            raise PayloadTooLarge("body too large")
+    request.body = bytes(body)
+
+
+async def _post_asset_form(request):
+    await _receive_form(request, server.config.MAX_UPLOAD_SIZE)
+
     upload_file = request.files.get("file")
     if not upload_file:
         # TODO: good error
         raise Exception("no upload file")
 
-    if len(upload_file.body) > 50e6:
-        # TODO: good error
-        raise Exception("file body too large")
+    UPLOAD_BYTES.inc(len(upload_file.body))
 
     if 'filename' in request.form:
         filename = request.form['filename']
@@ -107,20 +922,98 @@ async def post_asset(request):
         filename = upload_file.name
 
     async with get_db_conn() as conn:
-        # TODO: is there a way to do file streaming?
-        # https://sanic.readthedocs.io/en/latest/sanic/streaming.html
         asset_id = await app.post_asset(
-            conn, config["asset_dir"], filename, upload_file.body
+            conn,
+            server.config.ASSET_DIR,
+            filename,
+            upload_file.body,
+            content_addressed=server.config.CONTENT_ADDRESSED,
+            packs=server.ctx.packs,
         )
 
+    _after_upload([(asset_id, filename)])
     return json({"id": asset_id})
 
 
+@server.route("/assets/batch", methods=["POST"], stream=True)
+async def post_assets(request):
+    # A multipart form with any number of "file" parts, and optionally "tag"
+    # fields with tag ids to put on every file
+    await _receive_form(request, server.config.MAX_BATCH_UPLOAD_SIZE)
+
+    files = request.files.getlist("file", [])
+    if len(files) > server.config.MAX_BATCH_FILES:
+        raise InvalidUsage(f"at most {server.config.MAX_BATCH_FILES} files at once")
+    UPLOAD_BYTES.inc(sum(len(upload_file.body) for upload_file in files))
+
+    try:
+        tag_ids = [int(tag_id) for tag_id in request.form.getlist("tag", [])]
+    except ValueError:
+        raise InvalidUsage("tag must be an integer")
+
+    try:
+        async with get_db_conn() as conn:
+            asset_ids = await app.post_assets(
+                conn,
+                server.config.ASSET_DIR,
+                [(upload_file.name, upload_file.body) for upload_file in files],
+                tag_ids=tag_ids,
+                content_addressed=server.config.CONTENT_ADDRESSED,
+                packs=server.ctx.packs,
+            )
+    except app.TagNotFound as e:
+        raise InvalidUsage(f"tag {e} does not exist")
+
+    _after_upload(zip(asset_ids, (upload_file.name for upload_file in files)))
+    return json({"ids": asset_ids})
+
+
+@server.route("/assets/<asset_id>/preview", methods=["GET"])
+async def get_asset_preview(request, asset_id):
+    # A small WEBP of an image asset, cached like the asset itself
+    try:
+        asset_id = int(asset_id)
+    except ValueError:
+        raise NotFound(f"{asset_id} is not an asset")
+
+    previews = server.ctx.previews
+    if not previews:
+        raise NotFound("previews are turned off")
+
+    async with get_db_conn() as conn:
+        assets = await app.get_assets_by_ids(conn, [asset_id])
+    if not assets:
+        raise NotFound(f"asset {asset_id} not found")
+
+    etag = f'"{asset_id}-preview"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return response.empty(status=304, headers=headers)
+
+    preview_path = await previews.get(asset_id, assets[0].name)
+    if not preview_path:
+        raise NotFound(f"asset {asset_id} has no preview")
+
+    f = await aiofiles.open(preview_path, "rb")
+    try:
+        body = await f.read()
+    finally:
+        await f.close()
+
+    DOWNLOAD_BYTES.inc(len(body))
+    return response.raw(
+        body, headers=headers, content_type=preview.PREVIEW_CONTENT_TYPE
+    )
+
+
 @server.route("/assets/<asset_id>", methods=["DELETE"])
 async def delete_asset(request, asset_id):
     async with get_db_conn() as conn:
         await app.delete_asset(conn, int(asset_id))
 
+    # Other workers hear about it from the asset table's trigger
+    _forget_asset(int(asset_id))
+
     return json("success")
 
 
@@ -136,34 +1029,273 @@ async def post_tag(request):
     assert isinstance(value, str)
     assert isinstance(linked_asset_id, int) or linked_asset_id == None
 
-    async with get_db_conn() as conn:
-        tag_id = await app.post_tag(
-            conn,
-            app.TagInfo(
-                key=request.json["key"],
-                value=request.json["value"],
-                linked_asset_id=request.json.get("linked_asset_id"),
-            ),
+    tag_id = await small_write(
+        app.post_tag,
+        app.TagInfo(
+            key=request.json["key"],
+            value=request.json["value"],
+            linked_asset_id=request.json.get("linked_asset_id"),
+        ),
+    )
+
+    # Other workers hear about this through the tag table's trigger, but we
+    # want it to be visible here straight away
+    if tag_cache := server.ctx.tag_cache:
+        tag_cache.put(
+            app.TagResult(
+                tag_id=tag_id,
+                key=key,
+                value=value,
+                linked_asset_id=linked_asset_id,
+            )
         )
 
     return json({"id": tag_id})
 
 
+# Most suggestions returned at once
+MAX_SUGGEST_LIMIT = 100
+
+
+@server.route("/tags/suggest", methods=["GET"])
+async def suggest_tags(request):
+    # `q=<prefix>`, `limit=<n>`: tags for autocomplete, most used first
+    prefix = request.args.get("q", "")
+    limit = _int_args(request, "limit") or [10]
+    if not 0 < limit[0] <= MAX_SUGGEST_LIMIT:
+        raise InvalidUsage(f"limit must be between 1 and {MAX_SUGGEST_LIMIT}")
+
+    if tag_cache := server.ctx.tag_cache:
+        await server.ctx.tag_usage.start()
+        usage = server.ctx.tag_usage.counts
+        suggestions = [
+            (tag, usage.get(tag.tag_id, 0))
+            for tag in tag_cache.suggestions.suggest(prefix, limit[0], usage)
+        ]
+    elif prefix.strip():
+        async with get_db_conn() as conn:
+            suggestions = await app.suggest_tags(conn, prefix, limit[0])
+    else:
+        suggestions = []
+
+    return json([{**tag.to_dict(), "count": count} for tag, count in suggestions])
+
+
+# Most tags that can be ensured in one request
+MAX_ENSURE_TAGS = 10_000
+
+
+def _parse_tag_info(item) -> app.TagInfo | Error:
+    match item:
+        case {"key": str(key), "value": str(value), **rest} if isinstance(
+            rest.get("linked_asset_id"), (int, type(None))
+        ):
+            return app.TagInfo(key, value, rest.get("linked_asset_id"))
+
+    return Error(f"expected a key, value and optional linked_asset_id, got {item}")
+
+
+@server.route("/tags/ensure", methods=["POST"])
+async def ensure_tags(request):
+    # {"tags": [{"key": "a", "value": "b", "linked_asset_id": null}, ...],
+    #  "asset_id": 1}
+    tags = request.json.get("tags")
+    asset_id = request.json.get("asset_id")
+    if not isinstance(tags, list):
+        raise InvalidUsage("tags must be a list")
+    if not isinstance(asset_id, (int, type(None))):
+        raise InvalidUsage("asset_id must be an int")
+    if len(tags) > MAX_ENSURE_TAGS:
+        raise InvalidUsage(f"at most {MAX_ENSURE_TAGS} tags at once")
+
+    tags, errors = error.partition_dict(
+        {i: _parse_tag_info(item) for i, item in enumerate(tags)}
+    )
+    if errors:
+        raise InvalidUsage(str(Error.wrap("tags", errors)))
+
+    try:
+        async with get_db_conn() as conn:
+            results = await app.ensure_tags(conn, list(tags.values()), asset_id)
+    except app.AssetNotFound as e:
+        raise NotFound(f"asset {e} not found")
+
+    # Like `post_tag`, make new tags visible here straight away
+    if tag_cache := server.ctx.tag_cache:
+        for result in results:
+            if tag_cache.get(result.tag_id) is None:
+                tag_cache.put(result)
+
+    return json({"ids": [result.tag_id for result in results]})
+
+
+# Streamed responses are sent in pieces of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _wants_ndjson(request) -> bool:
+    return (
+        request.args.get("format") == "ndjson"
+        or "application/x-ndjson" in request.headers.get("accept", "")
+    )
+
+
+async def _stream_json(request, items: AsyncIterator):
+    """
+    Send `items` as they're produced, either as a JSON array or, if the client
+    asked for it, as newline delimited JSON. Nothing is held in memory beyond
+    one chunk of output.
+    """
+    ndjson = _wants_ndjson(request)
+    stream = await request.respond(
+        content_type="application/x-ndjson" if ndjson else "application/json"
+    )
+
+    chunk = [] if ndjson else ["["]
+    chunk_size = 0
+    separator = ""
+    async for item in items:
+        encoded = json_dumps(item)
+        if ndjson:
+            chunk.append(encoded + "\n")
+        else:
+            chunk.append(separator + encoded)
+            separator = ","
+
+        chunk_size += len(encoded)
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            await stream.send("".join(chunk))
+            chunk = []
+            chunk_size = 0
+
+    if not ndjson:
+        chunk.append("]")
+    await stream.send("".join(chunk))
+    await stream.eof()
+
+
 # TODO: support search parameters
 @server.route("/tags", methods=["GET"])
 async def get_tags(request):
+    if tag_cache := server.ctx.tag_cache:
+        headers = {
+            "ETag": f'"{tag_cache.etag(json_dumps)}"',
+            "Cache-Control": "no-cache",
+        }
+        if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return response.empty(status=304, headers=headers)
+
+        if _wants_ndjson(request):
+            body = tag_cache.serialized(json_dumps, "ndjson")
+            content_type = "application/x-ndjson"
+        else:
+            body = tag_cache.serialized(json_dumps, "json")
+            content_type = "application/json"
+
+        return response.raw(body, headers=headers, content_type=content_type)
+
+    async with get_db_conn() as conn:
+        tags = (tag.to_dict() async for tag in app.iter_tags(conn))
+        await _stream_json(request, tags)
+
+
+@server.route("/tags/<tag_id>/implies", methods=["POST"])
+async def post_associated_tag(request, tag_id):
+    try:
+        tag_id = int(tag_id)
+    except ValueError:
+        raise InvalidUsage(f"{tag_id} is not an int")
+
+    implies = request.json.get("tag_id")
+    if not isinstance(implies, int):
+        raise InvalidUsage("tag_id must be an int")
+
+    async with get_db_conn() as conn:
+        try:
+            await app.post_associated_tag(conn, implied_by=tag_id, implies=implies)
+        except app.TagCycle as e:
+            raise SanicException(str(e), status_code=409)
+        except app.TagNotFound as e:
+            if e.args[0] == tag_id:
+                raise NotFound(f"tag {e} not found")
+            raise InvalidUsage(f"tag {e} does not exist")
+
+    return json({"result": "you did it!"})
+
+
+@server.route("/tags/<tag_id>/implies", methods=["GET"])
+async def get_implied_tags(request, tag_id):
+    try:
+        tag_id = int(tag_id)
+    except ValueError:
+        raise InvalidUsage(f"{tag_id} is not an int")
+
+    async with get_db_conn() as conn:
+        return json(await app.get_implied_tags(conn, tag_id))
+
+
+@server.route("/tags/<tag_id>/implies/<implied_tag_id>", methods=["DELETE"])
+async def delete_associated_tag(request, tag_id, implied_tag_id):
+    try:
+        tag_id = int(tag_id)
+        implied_tag_id = int(implied_tag_id)
+    except ValueError:
+        raise InvalidUsage("tag ids must be ints")
+
     async with get_db_conn() as conn:
-        return json([
-            tag.to_dict() for tag in await app.get_tags(conn)
-        ])
+        await app.delete_associated_tag(conn, implied_by=tag_id, implies=implied_tag_id)
+
+    return json({"result": "you did it!"})
 
 
 @server.route("/asset_tags", methods=["GET"])
 async def get_all_asset_tags(request):
     async with get_db_conn() as conn:
-        asset_tags = await app.get_all_asset_tags(conn)
+        await _stream_json(request, app.iter_all_asset_tags(conn))
+
+
+# Most (asset, tag) pairs that can be changed in one request
+MAX_ASSET_TAG_BATCH = 100_000
+
+
+def _parse_asset_tag(item) -> tuple[int, int] | Error:
+    match item:
+        case {"asset_id": int(asset_id), "tag_id": int(tag_id)}:
+            return asset_id, tag_id
+
+    return Error(f"expected an asset_id and tag_id, got {item}")
+
+
+@server.route("/asset_tags", methods=["POST"])
+async def post_asset_tags(request):
+    # {"add": [{"asset_id": 1, "tag_id": 2}, ...], "remove": [...]}
+    add = request.json.get("add", [])
+    remove = request.json.get("remove", [])
+    if not isinstance(add, list) or not isinstance(remove, list):
+        raise InvalidUsage("add and remove must be lists")
+
+    if len(add) + len(remove) > MAX_ASSET_TAG_BATCH:
+        raise InvalidUsage(f"at most {MAX_ASSET_TAG_BATCH} changes at once")
+
+    add, add_errors = error.partition_dict(
+        {i: _parse_asset_tag(item) for i, item in enumerate(add)}
+    )
+    remove, remove_errors = error.partition_dict(
+        {i: _parse_asset_tag(item) for i, item in enumerate(remove)}
+    )
+
+    async with get_db_conn() as conn:
+        result = await app.post_asset_tags(conn, add, remove)
+    add_errors.update(result.errors)
+
+    # Errors are keyed by where the pair was in the request
+    errors = {}
+    if add_errors:
+        errors["add"] = {i: str(e) for i, e in sorted(add_errors.items())}
+    if remove_errors:
+        errors["remove"] = {i: str(e) for i, e in sorted(remove_errors.items())}
 
-    return json(asset_tags)
+    return json({"added": result.added, "removed": result.removed, "errors": errors})
 
 
 @server.route("/assets/<asset_id>/tags", methods=["POST"])
@@ -179,8 +1311,7 @@ async def post_tag_on_asset(request, asset_id):
     tag_id = request.json.get("tag_id")
     assert isinstance(tag_id, int)
 
-    async with get_db_conn() as conn:
-        tag_id = await app.post_tag_on_asset(conn, asset_id=asset_id, tag_id=tag_id)
+    await small_write(app.post_tag_on_asset, asset_id, tag_id)
 
     return json({"result": "you did it!"})
 
@@ -213,28 +1344,269 @@ async def delete_tag_on_asset(request, asset_id, tag_id):
         # TODO: Return 4xx error
         raise AssertionError(f"{tag_id} is not an int")
 
-    async with get_db_conn() as conn:
-        await app.delete_tag_from_asset(
-            conn, asset_id=asset_id, tag_id=tag_id,
-        )
+    await small_write(app.delete_tag_from_asset, asset_id, tag_id)
 
     return json({"result": "you did it!"})
 
 
+@server.route("/stats", methods=["GET"])
+async def get_stats(request):
+    stats = {"db_pool": {**db.pool_metrics(server.ctx.db_pool), **pool_stats}}
+    if server.ctx.asset_cache:
+        stats["asset_cache"] = server.ctx.asset_cache.stats()
+
+    return json(stats)
+
+
+def _dir_usage(path: Path) -> tuple[int, int]:
+    files, size = 0, 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files += 1
+                    size += entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return files, size
+
+
+@server.listener("before_server_start")
+async def start_worker_metrics(app, loop):
+    app.ctx.worker_metrics = metrics.WorkerMetrics(
+        Path(server.config.METRICS_DIR), server.config.METRICS_INTERVAL
+    )
+    app.ctx.worker_metrics.start(_update_gauges)
+
+
+@server.listener("after_server_stop")
+async def stop_worker_metrics(app, loop):
+    await app.ctx.worker_metrics.close()
+
+
+async def _update_gauges():
+    pool_metrics = db.pool_metrics(server.ctx.db_pool)
+    for state in ["size", "idle", "in_use", "max_size"]:
+        DB_POOL_CONNECTIONS.labels(state).set(pool_metrics[state])
+
+    files, size = await asyncio.get_running_loop().run_in_executor(
+        None, _dir_usage, Path(server.config.ASSET_DIR) / "tmp"
+    )
+    TMP_DIR_FILES.set(files)
+    TMP_DIR_BYTES.set(size)
+
+    if asset_cache := server.ctx.asset_cache:
+        ASSET_CACHE_BYTES.set(asset_cache.size)
+
+
+@server.route("/metrics", methods=["GET"])
+async def get_metrics(request):
+    # Prometheus' text format for every worker, see `metrics.WorkerMetrics`
+    await _update_gauges()
+    return response.text(
+        await server.ctx.worker_metrics.expose(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 def main():
-    parser = argparse.ArgumentParser()
+    # `sham bench` has flags of its own
+    if sys.argv[1:2] == ["bench"]:
+        bench.main(sys.argv[2:])
+        return
+
+    # Flags that aren't given are left out, so they don't override settings
+    # from the environment
+    parser = argparse.ArgumentParser(argument_default=argparse.SUPPRESS)
+    parser.add_argument(
+        "command", nargs="?", default="serve", choices=["serve", "migrate", "reshard", "reap"]
+    )
     parser.add_argument("--asset_dir")
+    parser.add_argument("--host")
+    parser.add_argument("-p", "--port", type=int)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Processes to serve from, 0 for one per CPU",
+    )
     parser.add_argument("--db_url")
     parser.add_argument("--db_user")
     parser.add_argument("--db_pass")
-    parser.add_argument("-p", "--port", default=8000)
+    parser.add_argument("--db_pool_min_size", type=int)
+    parser.add_argument("--db_pool_max_size", type=int)
+    parser.add_argument("--db_pool_acquire_timeout", type=float)
+    parser.add_argument("--db_statement_cache_size", type=int)
+    parser.add_argument("--max_upload_size", type=int)
+    parser.add_argument(
+        "--max_batch_upload_size",
+        type=int,
+        help="Largest POST /assets/batch body, which is held in memory",
+    )
+    parser.add_argument(
+        "--graceful_shutdown_timeout",
+        type=float,
+        help="On shutdown, seconds to let in-flight requests (like uploads) finish",
+    )
+    parser.add_argument(
+        "--content_addressed",
+        action="store_true",
+        help="Store identical uploads once, linked from each asset",
+    )
+    parser.add_argument(
+        "--packs",
+        action="store_true",
+        help="Pack small uploads into large segment files instead of a file each",
+    )
+    parser.add_argument(
+        "--pack_max_asset_size",
+        type=int,
+        help="Largest upload to pack",
+    )
+    parser.add_argument(
+        "--pack_segment_size",
+        type=int,
+        help="Bytes to write to a segment before starting another",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1000,
+        help="With reshard, how many files to move at a time",
+    )
+    parser.add_argument(
+        "--batch_delay",
+        type=float,
+        default=0.1,
+        help="With reshard, seconds to wait between batches",
+    )
+    parser.add_argument(
+        "--no_tag_cache",
+        dest="tag_cache",
+        action="store_false",
+        help="Read tags from the database on every request",
+    )
+    parser.add_argument(
+        "--tag_usage_interval",
+        type=float,
+        help="Seconds between recounting tag usage for suggestions",
+    )
+    parser.add_argument(
+        "--tag_index",
+        action="store_true",
+        help="Keep a bitmap of each tag's assets in memory for fast tag searches",
+    )
+    parser.add_argument(
+        "--no_previews",
+        dest="previews",
+        action="store_false",
+        help="Don't make previews of uploaded images",
+    )
+    parser.add_argument(
+        "--preview_workers",
+        type=int,
+        help="Processes making previews",
+    )
+    parser.add_argument(
+        "--no_compression",
+        dest="compression",
+        action="store_false",
+        help="Don't keep compressed copies of text-like uploads",
+    )
+    parser.add_argument(
+        "--compression_workers",
+        type=int,
+        help="Threads compressing uploads",
+    )
+    parser.add_argument(
+        "--asset_cache_size",
+        type=int,
+        help="Bytes of small assets to keep in memory, 0 to turn the cache off",
+    )
+    parser.add_argument(
+        "--asset_cache_max_entry_size",
+        type=int,
+        help="Largest asset to keep in memory",
+    )
+    parser.add_argument(
+        "--write_batching",
+        action="store_true",
+        help="Commit small writes (tags, tagging) that arrive together in one transaction",
+    )
+    parser.add_argument(
+        "--write_batch_size",
+        type=int,
+        help="Most writes to commit together",
+    )
+    parser.add_argument(
+        "--write_batch_delay",
+        type=float,
+        help="Seconds a write waits for others to join its batch",
+    )
+    parser.add_argument(
+        "--no_reaper",
+        dest="reaper",
+        action="store_false",
+        help="Don't clean up after deleted assets and failed uploads",
+    )
+    parser.add_argument(
+        "--reaper_interval",
+        type=float,
+        help="Seconds between reaper passes",
+    )
+    parser.add_argument(
+        "--reaper_grace_period",
+        type=float,
+        help="Seconds to keep deleted assets and leftovers before reaping them",
+    )
+    parser.add_argument("--reaper_batch_size", type=int)
+    parser.add_argument("--reaper_batch_delay", type=float)
+    parser.add_argument(
+        "--reaper_dry_run",
+        action="store_true",
+        help="Report what the reaper would remove without removing it",
+    )
+    parser.add_argument(
+        "--metrics_dir",
+        help="Directory workers share their metrics through, a temporary one by default",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        help="Seconds between each worker writing its metrics to --metrics_dir",
+    )
+    parser.add_argument(
+        "--no_migrate",
+        dest="migrate_on_startup",
+        action="store_false",
+        help="Don't migrate the schema when the server starts",
+    )
+
+    args = vars(parser.parse_args())
+    command = args.pop("command")
+    batch_size = args.pop("batch_size")
+    batch_delay = args.pop("batch_delay")
+    server.config.update({name.upper(): value for name, value in args.items()})
+
+    if command == "migrate":
+        asyncio.run(db.migrate_db_by_url(get_db_url()))
+        return
+
+    if command == "reshard":
+        # For its progress
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        asyncio.run(
+            app.reshard_assets(server.config.ASSET_DIR, batch_size, batch_delay)
+        )
+        return
 
-    args = parser.parse_args()
-    config["db_url"] = args.db_url
-    config["db_user"] = config["db_user"] or args.db_user
-    config["db_pass"] = config["db_pass"] or args.db_pass
+    if command == "reap":
+        result = asyncio.run(reap_once())
+        if result is None:
+            sys.exit("Another reaper is running")
+        print(json_dumps(result.to_dict()))
+        return
 
-    server.run(host="0.0.0.0", port=args.port)
+    workers = server.config.WORKERS or len(os.sched_getaffinity(0))
+    server.run(host=server.config.HOST, port=server.config.PORT, workers=workers)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,35 @@
+import asyncio
+import contextlib
 import dataclasses
+import hashlib
+import itertools
+import logging
+import os
 import shutil
 import string
-from typing import List, Optional
-from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+from dataclasses import dataclass, field
 from pathlib import Path
 from uuid import uuid4 as uuid
 
 import aiofiles
 import aiofiles.os
+import asyncpg
+
+from . import metrics
+from . import packfile
+from .error import Error
+
+logger = logging.getLogger(__name__)
+
+# How long the functions here take, which is mostly waiting on the database.
+# Labelled with the function's name, see `GET /metrics`.
+DB_QUERY_SECONDS = metrics.Histogram(
+    "sham_db_query_seconds",
+    "Time spent in each database function of sham.app",
+    ["query"],
+)
+timed = metrics.timed(DB_QUERY_SECONDS)
 
 
 @dataclass
@@ -19,36 +41,228 @@ class TagInfo:
 
 @dataclass
 class SearchParams:
-    pass
+    # Assets must have all of these tags...
+    tag_ids: List[int] = field(default_factory=list)
+    # ...and none of these
+    exclude_tag_ids: List[int] = field(default_factory=list)
+    # (key, value) pairs of tags that assets must have
+    key_values: List[Tuple[str, str]] = field(default_factory=list)
+    name_prefix: Optional[str] = None
+    # Keyset pagination: only return assets with ids after this one
+    after_id: Optional[int] = None
+    limit: int = 100
 
 
+# Assets are spread over two levels of directories named after the low bytes
+# of their id in hex, so no directory ends up with millions of files. Asset
+# 1234 (0x4d2) is `asset_dir/shards/d2/04/1234`. They're under `shards` so a
+# directory like `asset_dir/10` can't clash with asset 10 from before
+# sharding.
 def asset_path_from_dir_and_id(asset_dir, asset_id):
+    hex_id = f"{asset_id:04x}"
+    return Path(asset_dir) / "shards" / hex_id[-2:] / hex_id[-4:-2] / str(asset_id)
+
+
+def blob_path_from_dir_and_sha256(asset_dir, sha256):
+    return Path(asset_dir) / "blobs" / sha256[:2] / sha256[2:4] / sha256
+
+
+# Before sharding, everything was directly in `asset_dir` (or `blobs`). These
+# are still read from until `reshard_assets` has moved everything.
+def flat_asset_path_from_dir_and_id(asset_dir, asset_id):
     return Path(asset_dir) / str(asset_id)
 
 
+def flat_blob_path_from_dir_and_sha256(asset_dir, sha256):
+    return Path(asset_dir) / "blobs" / sha256
+
+
+def _existing_blob_path(asset_dir, sha256) -> Optional[Path]:
+    for path in [
+        blob_path_from_dir_and_sha256(asset_dir, sha256),
+        flat_blob_path_from_dir_and_sha256(asset_dir, sha256),
+    ]:
+        if path.exists():
+            return path
+
+    return None
+
+
+_link = aiofiles.os.wrap(os.link)
+
+
+def _flat_files(asset_dir: Path):
+    """
+    Yields (current path, sharded path) for everything still stored flat.
+    """
+    with os.scandir(asset_dir) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.is_file():
+                yield Path(entry.path), asset_path_from_dir_and_id(
+                    asset_dir, int(entry.name)
+                )
+
+    blobs_dir = asset_dir / "blobs"
+    if blobs_dir.exists():
+        with os.scandir(blobs_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield Path(entry.path), blob_path_from_dir_and_sha256(
+                        asset_dir, entry.name
+                    )
+
+
+async def reshard_assets(asset_dir, batch_size=1000, batch_delay=0.1) -> int:
+    """
+    Move assets and blobs stored directly in `asset_dir` into the sharded
+    layout, `batch_size` files at a time with a pause in between so a live
+    server isn't starved of disk. Returns the number of files moved.
+
+    This is safe while the server is running: each file is moved with one
+    rename, and readers look in both places.
+    """
+    asset_dir = Path(asset_dir)
+    total_moved = 0
+
+    # Renaming while listing the directory may make us miss entries, so keep
+    # going until a pass finds nothing left to do
+    while True:
+        moved = 0
+        for batch in _batched(_flat_files(asset_dir), batch_size):
+            for source, destination in batch:
+                await aiofiles.os.makedirs(destination.parent, exist_ok=True)
+                try:
+                    await aiofiles.os.rename(source, destination)
+                except FileNotFoundError:
+                    # Someone else moved it
+                    continue
+                moved += 1
+
+            logger.info("Moved %d files", total_moved + moved)
+            await asyncio.sleep(batch_delay)
+
+        total_moved += moved
+        if not moved:
+            return total_moved
+
+
+def _batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+class AssetNotFound(Exception):
+    pass
+
+
+class TagNotFound(Exception):
+    pass
+
+
 # TODO: istm this would be better/faster to do in something like this in nginx
 # It's not clear how permissions would work in that case though...
-async def get_asset(asset_dir, asset_id) -> bytes:
+async def get_asset(
+    asset_dir, asset_id, packs: Optional[packfile.PackStore] = None
+) -> bytes:
     """
     - GET binary data for given asset_id
         - `GET /assets/<asset-id>`
     404 if asset not in DB / deleted in DB
     5XX if asset is in DB, but on in the filesystem
     """
-    file_path = asset_path_from_dir_and_id(asset_dir, asset_id)
-
-    # TODO: 404 on file not found
-    async with aiofiles.open(file_path, "r+b") as f:
+    f = await open_asset(asset_dir, asset_id, packs)
+    try:
         return await f.read()
+    finally:
+        await f.close()
+
+
+async def open_asset(asset_dir, asset_id, packs: Optional[packfile.PackStore] = None):
+    """
+    Open an asset for reading, from the sharded layout, where it was before
+    being resharded, or its segment if it was packed (see
+    `packfile.PackStore`). An open file keeps working if the asset is moved.
+    """
+    # Packed assets this worker has seen before are found without looking on
+    # disk or in the database
+    if packs and (f := packs.open_known(asset_id)):
+        return f
+
+    for file_path in [
+        asset_path_from_dir_and_id(asset_dir, asset_id),
+        flat_asset_path_from_dir_and_id(asset_dir, asset_id),
+    ]:
+        try:
+            return await aiofiles.open(file_path, "rb")
+        except FileNotFoundError:
+            pass
+
+    if packs and (f := await packs.open(asset_id)):
+        return f
+
+    raise AssetNotFound(asset_id)
+
+
+def asset_size(f) -> int:
+    # Packed assets aren't files of their own
+    if isinstance(f, packfile.PackedAsset):
+        return f.size
+    return os.fstat(f.fileno()).st_size
+
+
+async def asset_source(
+    asset_dir, asset_id, packs: Optional[packfile.PackStore] = None
+) -> List[str] | bytes:
+    """
+    What a worker thread or process making something from an asset (like a
+    preview) should read: the paths the asset's file may be at, or for a
+    packed asset its contents.
+    """
+    paths = [
+        str(asset_path_from_dir_and_id(asset_dir, asset_id)),
+        str(flat_asset_path_from_dir_and_id(asset_dir, asset_id)),
+    ]
+    if packs and not any(os.path.exists(path) for path in paths):
+        if (contents := await packs.read(asset_id)) is not None:
+            return contents
+
+    return paths
 
 
+async def read_chunks(
+    f, start: int, length: int, chunk_size: int = 256 * 1024
+) -> AsyncIterator[bytes]:
+    """
+    Read `length` bytes of an open asset starting at `start`, a chunk at a
+    time, so large assets are never held in memory all at once.
+    """
+    await f.seek(start)
+    while length > 0:
+        chunk = await f.read(min(length, chunk_size))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+@timed
 async def get_asset_tags(conn, asset_id):
     """
     - GET tags for asset_id (all tags, including implied tags and assets that link to this one)
         - `GET /assets/<asset-id>/tags`
     """
 
-    rows = await conn.fetch("SELECT * FROM asset_tag WHERE asset_id=$1", asset_id,)
+    rows = await conn.fetch(
+        """
+        SELECT tag_id FROM asset_tag WHERE asset_id = $1
+        UNION
+        SELECT tag_closure.implies
+        FROM asset_tag JOIN tag_closure ON tag_closure.implied_by = asset_tag.tag_id
+        WHERE asset_tag.asset_id = $1
+        """,
+        asset_id,
+    )
     return [row["tag_id"] for row in rows]
 
 @dataclass
@@ -63,24 +277,235 @@ class AssetInfo:
         }
 
 
-# TODO: determine what should actually be returned
-async def get_assets(conn, search_params: SearchParams) -> List[AssetInfo]:
+def _escape_like(pattern: str) -> str:
+    return pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@timed
+async def get_assets(conn, search_params: Optional[SearchParams]) -> List[AssetInfo]:
     """
     - GET paginated assets matching $SEARCH, returns:
         - `GET /assets?tag=<tag-id>&...`
         - asset_id
         - id to search from for next search
         - tags...? (this seems like it could get expensive, maybe only direct tags?)
+
+    Results are ordered by id. To get the next page, search again with
+    `after_id` set to the last id returned.
     """
+    search_params = search_params or SearchParams()
+    conditions, args = _search_conditions(search_params)
+
+    if search_params.after_id is not None:
+        args.append(search_params.after_id)
+        conditions.append(f"id > ${len(args)}")
 
-    # TODO: actually do a search, rather than returning everything
-    rows = await conn.fetch("SELECT id, name FROM asset WHERE deleted = false;")
+    args.append(search_params.limit)
+    rows = await conn.fetch(
+        f"""
+        SELECT id, name FROM asset
+        WHERE {" AND ".join(conditions)}
+        ORDER BY id
+        LIMIT ${len(args)}
+        """,
+        *args,
+    )
     return [
         AssetInfo(asset_id=row["id"], name=row["name"])
         for row in rows
     ]
 
 
+@timed
+async def count_assets(conn, search_params: Optional[SearchParams]) -> int:
+    """
+    How many assets match a search, ignoring `after_id` and `limit`.
+    """
+    conditions, args = _search_conditions(search_params or SearchParams())
+    return await conn.fetchval(
+        f"""
+        SELECT count(*) FROM asset
+        WHERE {" AND ".join(conditions)}
+        """,
+        *args,
+    )
+
+
+@timed
+async def asset_exists(conn, asset_id: int) -> bool:
+    """
+    Whether `asset_id` is an asset that can be downloaded: not deleted, and not
+    an upload that's still in progress.
+    """
+    return await conn.fetchval(
+        "SELECT EXISTS (SELECT FROM asset WHERE id = $1 AND NOT deleted)", asset_id
+    )
+
+
+@timed
+async def get_assets_by_ids(conn, asset_ids: List[int]) -> List[AssetInfo]:
+    """
+    The (non-deleted) assets with these ids, ordered by id. This is how
+    searches answered by `tag_index.TagIndex` get their names.
+    """
+    rows = await conn.fetch(
+        """
+        SELECT id, name FROM asset
+        WHERE id = ANY($1::int[]) AND NOT deleted
+        ORDER BY id
+        """,
+        asset_ids,
+    )
+    return [
+        AssetInfo(asset_id=row["id"], name=row["name"])
+        for row in rows
+    ]
+
+
+def _search_conditions(search_params: SearchParams) -> Tuple[List[str], list]:
+    """
+    SQL conditions on asset for everything in a search except the pagination,
+    and the arguments they refer to.
+    """
+    conditions = ["NOT deleted"]
+    args = []
+
+    def arg(value):
+        args.append(value)
+        return f"${len(args)}"
+
+    # Searching for a tag also finds assets with tags that imply it
+    def with_implied_by(tag_ids):
+        return f"""
+            SELECT unnest({tag_ids}::int[])
+            UNION ALL
+            SELECT implied_by FROM tag_closure WHERE implies = ANY({tag_ids}::int[])
+        """
+
+    for tag_id in search_params.tag_ids:
+        conditions.append(
+            f"""
+            id IN (
+                SELECT asset_id FROM asset_tag
+                WHERE tag_id IN ({with_implied_by(arg([tag_id]))})
+            )
+            """
+        )
+
+    if search_params.exclude_tag_ids:
+        exclude_tag_ids = arg(search_params.exclude_tag_ids)
+        conditions.append(
+            f"""
+            NOT EXISTS (
+                SELECT FROM asset_tag
+                WHERE asset_id = asset.id
+                AND tag_id IN ({with_implied_by(exclude_tag_ids)})
+            )
+            """
+        )
+
+    for key, value in search_params.key_values:
+        tag_ids = f"""
+            ARRAY(SELECT id FROM tag WHERE key = {arg(key)} AND value = {arg(value)})
+        """
+        conditions.append(
+            f"""
+            id IN (
+                SELECT asset_id FROM asset_tag
+                WHERE tag_id IN ({with_implied_by(tag_ids)})
+            )
+            """
+        )
+
+    if search_params.name_prefix:
+        conditions.append(
+            f"name LIKE {arg(_escape_like(search_params.name_prefix) + '%')}"
+        )
+
+    return conditions, args
+
+
+@dataclass
+class FacetCount:
+    tag_id: int
+    key: str
+    value: str
+    # Matching assets with this tag, directly or implied
+    count: int
+
+
+@timed
+async def get_facets(
+    conn,
+    search_params: Optional[SearchParams],
+    keys: Optional[List[str]] = None,
+    limit: int = 10,
+) -> List[FacetCount]:
+    """
+    - How many of the assets matching a search have each tag, for showing
+      "game: SM64 (1204), Zelda (380)" next to the results
+        - `GET /assets/facets`
+    Only tags with one of `keys` are counted, if given. Returns at most
+    `limit` tags per key, most common first, ordered by key.
+    """
+    conditions, args = _search_conditions(search_params or SearchParams())
+    key_condition = ""
+    if keys is not None:
+        args.append(keys)
+        key_condition = f"WHERE tag.key = ANY(${len(args)}::text[])"
+    args.append(limit)
+
+    # Each (asset, tag) pair is counted once, even if the asset has the tag
+    # directly and by implication
+    rows = await conn.fetch(
+        f"""
+        WITH matching AS (
+            SELECT id FROM asset WHERE {" AND ".join(conditions)}
+        ),
+        effective AS (
+            SELECT asset_tag.asset_id, asset_tag.tag_id
+            FROM matching JOIN asset_tag ON asset_tag.asset_id = matching.id
+            UNION
+            SELECT asset_tag.asset_id, tag_closure.implies
+            FROM matching JOIN asset_tag ON asset_tag.asset_id = matching.id
+            JOIN tag_closure ON tag_closure.implied_by = asset_tag.tag_id
+        ),
+        counts AS (
+            SELECT tag.id, tag.key, tag.value, count(*) AS count,
+                row_number() OVER (
+                    PARTITION BY tag.key ORDER BY count(*) DESC, tag.value, tag.id
+                ) AS rank
+            FROM effective JOIN tag ON tag.id = effective.tag_id
+            {key_condition}
+            GROUP BY tag.id
+        )
+        SELECT id, key, value, count FROM counts
+        WHERE rank <= ${len(args)}
+        ORDER BY key, rank
+        """,
+        *args,
+    )
+    return [
+        FacetCount(
+            tag_id=row["id"], key=row["key"], value=row["value"], count=row["count"]
+        )
+        for row in rows
+    ]
+
+
+def top_facets(counts: List[FacetCount], limit: int) -> List[FacetCount]:
+    """
+    Rank facet counts like `get_facets` does: by key, then most common first,
+    keeping at most `limit` per key.
+    """
+    ranked = sorted(counts, key=lambda c: (c.key, -c.count, c.value, c.tag_id))
+    return [
+        count
+        for _, group in itertools.groupby(ranked, key=lambda c: c.key)
+        for count in itertools.islice(group, limit)
+    ]
+
+
 @dataclass
 class TagResult:
     tag_id: int
@@ -93,6 +518,7 @@ class TagResult:
 
 
 # TODO: add an function for searching for tags
+@timed
 async def get_tags(conn) -> List[TagResult]:
     rows = await conn.fetch("SELECT id, key, value, linked_asset_id FROM tag;")
     return [
@@ -106,91 +532,765 @@ async def get_tags(conn) -> List[TagResult]:
     ]
 
 
-# TODO: is there a way to do file streaming?
-# TODO: return type
-async def post_asset(
-    conn, asset_dir: str | Path, unsanitized_file_name: str, file_contents: bytes
-) -> int:
+@timed
+async def suggest_tags(conn, prefix: str, limit: int = 10) -> List[Tuple[TagResult, int]]:
     """
-    - POST new binary data and return asset_id
-        - `POST /assets`
-        - optionally include preview?
-        - how does the client generate this?
+    - Tags whose key or value starts with `prefix` (ignoring case), most used
+      first, with how many assets they're on
+        - `GET /tags/suggest`, when tags aren't cached
+    `tag_suggest.TagSuggestions` does this in memory, and matches words
+    within keys and values too.
     """
+    rows = await conn.fetch(
+        """
+        SELECT tag.id, tag.key, tag.value, tag.linked_asset_id,
+            (SELECT count(*) FROM asset_tag WHERE tag_id = tag.id) AS count
+        FROM tag
+        WHERE lower(tag.key) LIKE $1
+        OR lower(tag.value) LIKE $1
+        OR lower(tag.key || ':' || tag.value) LIKE $1
+        ORDER BY lower(tag.key) = $2 OR lower(tag.value) = $2 DESC,
+            count DESC, length(tag.value), tag.key, tag.value
+        LIMIT $3
+        """,
+        _escape_like(prefix.strip().lower()) + "%",
+        prefix.strip().lower(),
+        limit,
+    )
+    return [
+        (
+            TagResult(
+                tag_id=row["id"],
+                key=row["key"],
+                value=row["value"],
+                linked_asset_id=row["linked_asset_id"],
+            ),
+            row["count"],
+        )
+        for row in rows
+    ]
+
+
+async def iter_tags(conn, batch_size: int = 1000) -> AsyncIterator[TagResult]:
+    """
+    Like `get_tags`, but reads the table through a server-side cursor
+    `batch_size` rows at a time instead of all at once.
+    """
+    async with conn.transaction():
+        async for row in conn.cursor(
+            "SELECT id, key, value, linked_asset_id FROM tag", prefetch=batch_size
+        ):
+            yield TagResult(
+                tag_id=row["id"],
+                key=row["key"],
+                value=row["value"],
+                linked_asset_id=row["linked_asset_id"],
+            )
+
+
+class AssetTooLarge(Exception):
+    pass
+
+
+def sanitize_file_name(unsanitized_file_name: str) -> str:
     # TODO: internationalization
     acceptable_characters = set(string.ascii_letters) | {" ", "_", "."} | set(string.digits)
-    sanitized_file_name = "".join(
+    return "".join(
         c if c in acceptable_characters else "_" for c in unsanitized_file_name
     )
 
-    # Write this to a temporary location on the same disk as the asset_dir.
-    # If files somehow get left here we know we can delete them if they're old.
-    # TODO: would tempfile.NamedTemporaryFile work here? is it fine to create
-    # the temporary file then move it?
-    # TODO: Should have a monitor for this (and admin disk space monitor)
 
-    try:
-        tmp_path = Path(asset_dir) / "tmp"
-        # We get scary-looking logs if we don't look before we leap
-        if not tmp_path.exists():
-            await aiofiles.os.mkdir(tmp_path)
-            print("Created path")
-    except FileExistsError:
-        # This will exist once the very first asset is uploaded, so we'll be
-        # catching this exception a lot
-        pass
-
-    temp_file_path = Path(asset_dir) / "tmp" / str(uuid())
-    async with aiofiles.open(temp_file_path, "w+b") as f:
-        await f.write(file_contents)
-
-    # Create an entry for a _deleted_ asset. This way, nothing assumes that this
-    # asset exists.
-    # TODO: should the name be part of the asset table? It never gets returned
-    # and could be a tag instead...
+class AssetWriter:
+    """
+    Writes an upload into `asset_dir/tmp` a chunk at a time, hashing it as it
+    goes, then moves it into place with `commit`.
+
+    Use as an async context manager. If the block exits without committing,
+    the temporary file is removed.
+
+    With `content_addressed`, the contents are stored once as a blob named
+    after their hash and every asset with those contents is a hard link to it.
+
+    With `packs`, uploads small enough to pack are kept in memory instead and
+    appended to a segment by `commit` (see `packfile.PackStore`). Content
+    addressed uploads are never packed, blobs need a file to link to.
+    """
+
+    def __init__(
+        self,
+        asset_dir: str | Path,
+        max_size: Optional[int] = None,
+        content_addressed: bool = False,
+        packs: Optional[packfile.PackStore] = None,
+    ):
+        self.asset_dir = Path(asset_dir)
+        self.max_size = max_size
+        self.content_addressed = content_addressed
+        if content_addressed or not (packs and packs.max_asset_size):
+            packs = None
+        self.packs = packs
+        # The upload so far, while it might still be packed
+        self._buffer = bytearray() if packs else None
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.temp_file_path = self.asset_dir / "tmp" / str(uuid())
+        self._file = None
+        self._committed = False
+
+    async def __aenter__(self):
+        # Write this to a temporary location on the same disk as the asset_dir.
+        # If files somehow get left here we know we can delete them if they're old.
+        # TODO: Should have a monitor for this (and admin disk space monitor)
+        try:
+            tmp_path = self.asset_dir / "tmp"
+            # We get scary-looking logs if we don't look before we leap
+            if not tmp_path.exists():
+                await aiofiles.os.mkdir(tmp_path)
+                print("Created path")
+        except FileExistsError:
+            # This will exist once the very first asset is uploaded, so we'll be
+            # catching this exception a lot
+            pass
+
+        if self._buffer is None:
+            self._file = await aiofiles.open(self.temp_file_path, "w+b")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        if not self._committed and self._file:
+            await aiofiles.os.remove(self.temp_file_path)
+
+    async def close(self):
+        if self._file and not self._file.closed:
+            await self._file.close()
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise AssetTooLarge(f"asset is larger than {self.max_size} bytes")
+
+        self.hash.update(chunk)
+        if self._buffer is not None:
+            self._buffer += chunk
+            if self.packs.fits(self.size):
+                return
+
+            # Too big to pack after all, carry on as a file
+            self._file = await aiofiles.open(self.temp_file_path, "w+b")
+            chunk, self._buffer = bytes(self._buffer), None
+
+        await self._file.write(chunk)
+
+    @timed
+    async def commit(self, conn, unsanitized_file_name: str) -> int:
+        await self.close()
+
+        if self.content_addressed:
+            await self._store_blob()
+            return await _post_blob_asset(
+                conn,
+                self.asset_dir,
+                unsanitized_file_name,
+                self.sha256,
+                self.size,
+                self._restore_blob,
+            )
+
+        # Create an entry for a _deleted_ asset. This way, nothing assumes that this
+        # asset exists.
+        # TODO: should the name be part of the asset table? It never gets returned
+        # and could be a tag instead...
+        asset_id = await conn.fetchval(
+            "INSERT INTO asset (name, deleted) VALUES ($1, $2) RETURNING id",
+            sanitize_file_name(unsanitized_file_name),
+            True,
+        )
+
+        # Move the asset into its final place
+        if self._buffer is not None:
+            await self.packs.append(conn, [(asset_id, bytes(self._buffer))])
+            self._committed = True
+        else:
+            await self._move_to(asset_id)
+
+        # "un"-delete the asset, other things can now access it
+        await conn.execute(
+            "UPDATE asset SET deleted = $1, sha256 = $2 WHERE id = $3",
+            False,
+            self.sha256,
+            asset_id,
+        )
+
+        return asset_id
+
+        # Hey! No transactions (I thought I'd need one at first)
+
+    @property
+    def sha256(self) -> str:
+        return self.hash.hexdigest()
+
+    async def _move_to(self, asset_id: int):
+        destination_file_path = asset_path_from_dir_and_id(self.asset_dir, asset_id)
+        await aiofiles.os.makedirs(destination_file_path.parent, exist_ok=True)
+        await aiofiles.os.rename(self.temp_file_path, destination_file_path)
+        self._committed = True
+
+    # The upload stays in tmp (and is removed on exit) until its asset is
+    # linked, in case the reaper removes the blob before then
+    async def _store_blob(self):
+        if not _existing_blob_path(self.asset_dir, self.sha256):
+            await self._restore_blob()
+
+    async def _restore_blob(self):
+        blob_path = blob_path_from_dir_and_sha256(self.asset_dir, self.sha256)
+        await aiofiles.os.makedirs(blob_path.parent, exist_ok=True)
+        try:
+            await _link(self.temp_file_path, blob_path)
+        except FileExistsError:
+            # Someone else stored the same contents first
+            pass
+
+
+async def _write_blob(asset_dir: Path, contents: bytes):
+    async with AssetWriter(asset_dir, content_addressed=True) as writer:
+        await writer.write(contents)
+        await writer._restore_blob()
+
+
+async def _link_blob(
+    asset_dir: Path,
+    sha256: str,
+    asset_id: int,
+    restore: Optional[Callable[[], Awaitable]] = None,
+):
+    """
+    Link an asset to its blob. Linking is only a directory entry, the contents
+    aren't written again.
+
+    The reaper removes blobs nobody references. If it got to this one before
+    our reference was taken, `restore` is awaited to write it again.
+    """
+    destination_file_path = asset_path_from_dir_and_id(asset_dir, asset_id)
+    await aiofiles.os.makedirs(destination_file_path.parent, exist_ok=True)
+    for attempt in range(2):
+        # The blob may be moved by `reshard_assets` at any moment, try both places
+        for blob_path in [
+            blob_path_from_dir_and_sha256(asset_dir, sha256),
+            flat_blob_path_from_dir_and_sha256(asset_dir, sha256),
+        ]:
+            try:
+                await _link(blob_path, destination_file_path)
+                return
+            except FileNotFoundError:
+                pass
+
+        if attempt or restore is None:
+            raise FileNotFoundError(blob_path_from_dir_and_sha256(asset_dir, sha256))
+        await restore()
+
+
+async def _post_blob_asset(
+    conn,
+    asset_dir: Path,
+    unsanitized_file_name: str,
+    sha256: str,
+    size: int,
+    restore: Callable[[], Awaitable],
+) -> int:
+    """
+    Create an asset for a blob that's already in `asset_dir/blobs`. The blob's
+    reference count is taken in the same statement that creates the asset.
+    `restore` writes the blob again if it was reaped in the meantime.
+    """
     asset_id = await conn.fetchval(
-        "INSERT INTO asset (name, deleted) VALUES ($1, $2) RETURNING id",
-        sanitized_file_name,
-        True,
+        """
+        WITH b AS (
+            INSERT INTO blob (sha256, size, refcount) VALUES ($2, $3, 1)
+            ON CONFLICT (sha256) DO UPDATE SET refcount = blob.refcount + 1
+        )
+        INSERT INTO asset (name, deleted, sha256, blob_sha256)
+        VALUES ($1, true, $2, $2)
+        RETURNING id
+        """,
+        sanitize_file_name(unsanitized_file_name),
+        sha256,
+        size,
     )
 
-    # Move the asset into its final place
-    destination_file_path = asset_path_from_dir_and_id(asset_dir, asset_id)
-    await aiofiles.os.rename(temp_file_path, destination_file_path)
+    await _link_blob(asset_dir, sha256, asset_id, restore)
 
-    # "un"-delete the asset, other things can now access it
     await conn.execute("UPDATE asset SET deleted = $1 WHERE id = $2", False, asset_id)
 
     return asset_id
 
-    # Hey! No transactions (I thought I'd need one at first)
 
+@timed
+async def post_asset(
+    conn,
+    asset_dir: str | Path,
+    unsanitized_file_name: str,
+    file_contents: bytes,
+    content_addressed: bool = False,
+    packs: Optional[packfile.PackStore] = None,
+) -> int:
+    """
+    - POST new binary data and return asset_id
+        - `POST /assets`
+        - optionally include preview?
+        - how does the client generate this?
+    """
+    if content_addressed:
+        sha256 = hashlib.sha256(file_contents).hexdigest()
+        if _existing_blob_path(asset_dir, sha256):
+            return await _post_blob_asset(
+                conn,
+                Path(asset_dir),
+                unsanitized_file_name,
+                sha256,
+                len(file_contents),
+                lambda: _write_blob(Path(asset_dir), file_contents),
+            )
+
+    async with AssetWriter(
+        asset_dir, content_addressed=content_addressed, packs=packs
+    ) as writer:
+        await writer.write(file_contents)
+        return await writer.commit(conn, unsanitized_file_name)
+
+
+# How many files of a batch upload are written at once
+MAX_CONCURRENT_WRITES = 16
+
+
+@timed
+async def post_assets(
+    conn,
+    asset_dir: str | Path,
+    files: List[Tuple[str, bytes]],
+    tag_ids: Optional[List[int]] = None,
+    content_addressed: bool = False,
+    packs: Optional[packfile.PackStore] = None,
+) -> List[int]:
+    """
+    - POST many (name, contents) files at once, optionally tagging them all,
+      and return their asset_ids in the same order
+        - `POST /assets/batch`
+    Files are written concurrently and the database work is a fixed number of
+    statements however many files there are.
+    """
+    if not files:
+        return []
+
+    # Checked before anything is written, so a bad tag doesn't leave files
+    # and rows behind
+    if tag_ids:
+        found = await conn.fetch("SELECT id FROM tag WHERE id = ANY($1::int[])", tag_ids)
+        if missing := set(tag_ids) - {row["id"] for row in found}:
+            raise TagNotFound(min(missing))
+
+    asset_dir = Path(asset_dir)
+    writers = [
+        AssetWriter(asset_dir, content_addressed=content_addressed, packs=packs)
+        for _ in files
+    ]
+
+    async with contextlib.AsyncExitStack() as stack:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+
+        async def write(writer, contents):
+            async with semaphore:
+                await stack.enter_async_context(writer)
+                await writer.write(contents)
+                await writer.close()
+
+        # Let every write finish before cleaning up after any that failed
+        results = await asyncio.gather(
+            *[write(writer, contents) for writer, (_, contents) in zip(writers, files)],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        asset_ids = await conn.fetchval(
+            "SELECT array_agg(nextval('asset_id_seq')) FROM generate_series(1, $1)",
+            len(files),
+        )
+        names = [sanitize_file_name(name) for name, _ in files]
+        sha256s = [writer.sha256 for writer in writers]
 
+        # Create entries for _deleted_ assets, like `AssetWriter.commit`
+        if content_addressed:
+            await asyncio.gather(*[writer._store_blob() for writer in writers])
+            await conn.execute(
+                """
+                WITH b AS (
+                    INSERT INTO blob (sha256, size, refcount)
+                    SELECT sha256, size, count(*)
+                    FROM unnest($3::text[], $4::bigint[]) AS upload (sha256, size)
+                    GROUP BY sha256, size
+                    ON CONFLICT (sha256) DO UPDATE
+                    SET refcount = blob.refcount + excluded.refcount
+                )
+                INSERT INTO asset (id, name, deleted, sha256, blob_sha256)
+                SELECT id, name, true, sha256, sha256
+                FROM unnest($1::int[], $2::text[], $3::text[]) AS upload (id, name, sha256)
+                """,
+                asset_ids,
+                names,
+                sha256s,
+                [writer.size for writer in writers],
+            )
+            await asyncio.gather(
+                *[
+                    _link_blob(asset_dir, writer.sha256, asset_id, writer._restore_blob)
+                    for writer, asset_id in zip(writers, asset_ids)
+                ]
+            )
+        else:
+            await conn.execute(
+                """
+                INSERT INTO asset (id, name, deleted, sha256)
+                SELECT id, name, true, sha256
+                FROM unnest($1::int[], $2::text[], $3::text[]) AS upload (id, name, sha256)
+                """,
+                asset_ids,
+                names,
+                sha256s,
+            )
+            # Packed files go into the segment together
+            packed = [
+                (asset_id, bytes(writer._buffer))
+                for writer, asset_id in zip(writers, asset_ids)
+                if writer._buffer is not None
+            ]
+            if packed:
+                await packs.append(conn, packed)
+            await asyncio.gather(
+                *[
+                    writer._move_to(asset_id)
+                    for writer, asset_id in zip(writers, asset_ids)
+                    if writer._buffer is None
+                ]
+            )
+
+    # If tagging fails, the assets are never un-deleted
+    async with conn.transaction():
+        if tag_ids:
+            await conn.execute(
+                """
+                INSERT INTO asset_tag (asset_id, tag_id)
+                SELECT asset_id, tag_id
+                FROM unnest($1::int[]) AS asset_id CROSS JOIN unnest($2::int[]) AS tag_id
+                ON CONFLICT DO NOTHING
+                """,
+                asset_ids,
+                tag_ids,
+            )
+
+        await conn.execute(
+            "UPDATE asset SET deleted = $1 WHERE id = ANY($2)", False, asset_ids
+        )
+
+    return asset_ids
+
+
+@timed
 async def post_tag(conn, tag: TagInfo):
     """
     - POST new tag and return a tag_id that can be applied to an asset
         - `POST /tag`
+    Posting a tag that already exists returns the existing tag's id, rather
+    than failing on the unique index (it used to be an error).
     """
 
     # TODO: handle asyncpg.exceptions.ForeignKeyViolationError
     tag_id = await conn.fetchval(
-        "INSERT INTO tag (key, value, linked_asset_id) VALUES ($1, $2, $3) RETURNING id",
+        """
+        INSERT INTO tag (key, value, linked_asset_id) VALUES ($1, $2, $3)
+        ON CONFLICT (key, value, COALESCE(linked_asset_id, 0)) DO NOTHING
+        RETURNING id
+        """,
         tag.key,
         tag.value,
         tag.linked_asset_id,
     )
+    if tag_id is None:
+        # Already there. Updating the row on conflict instead would return it
+        # too, but as a change every worker's tag cache hears about.
+        tag_id = await conn.fetchval(
+            """
+            SELECT id FROM tag WHERE key = $1 AND value = $2
+            AND COALESCE(linked_asset_id, 0) = COALESCE($3::int, 0)
+            """,
+            tag.key,
+            tag.value,
+            tag.linked_asset_id,
+        )
 
     return tag_id
 
 
+@timed
+async def ensure_tags(
+    conn, tags: Sequence[TagInfo], asset_id: Optional[int] = None
+) -> List[TagResult]:
+    """
+    - Find or create many tags at once, and optionally add them all to an asset
+        - `POST /tags/ensure`
+    Returns the tags in the same order as `tags`. Everything happens in one
+    transaction, and tags that already exist are left alone.
+    """
+    async with conn.transaction():
+        if asset_id is not None and not await conn.fetchval(
+            "SELECT EXISTS (SELECT FROM asset WHERE id = $1 AND NOT deleted)", asset_id
+        ):
+            raise AssetNotFound(asset_id)
+
+        if not tags:
+            return []
+
+        linked_asset_ids = [tag.linked_asset_id for tag in tags]
+        if any(linked_asset_ids):
+            missing = await conn.fetchval(
+                """
+                SELECT linked.id FROM unnest($1::int[]) AS linked (id)
+                WHERE NOT EXISTS (SELECT FROM asset WHERE asset.id = linked.id)
+                LIMIT 1
+                """,
+                [i for i in linked_asset_ids if i is not None],
+            )
+            if missing is not None:
+                raise AssetNotFound(missing)
+
+        args = (
+            [tag.key for tag in tags],
+            [tag.value for tag in tags],
+            linked_asset_ids,
+        )
+        # New tags come back from the INSERT, ones that were already there
+        # from the tag table as it was when the statement started
+        rows = await conn.fetch(
+            """
+            WITH input AS (
+                SELECT DISTINCT key, value, linked_asset_id
+                FROM unnest($1::text[], $2::text[], $3::int[])
+                    AS input (key, value, linked_asset_id)
+            ),
+            inserted AS (
+                INSERT INTO tag (key, value, linked_asset_id)
+                SELECT key, value, linked_asset_id FROM input
+                ON CONFLICT (key, value, COALESCE(linked_asset_id, 0)) DO NOTHING
+                RETURNING id, key, value, linked_asset_id
+            )
+            SELECT id, key, value, linked_asset_id FROM inserted
+            UNION ALL
+            SELECT tag.id, tag.key, tag.value, tag.linked_asset_id
+            FROM tag JOIN input
+            ON tag.key = input.key AND tag.value = input.value
+            AND COALESCE(tag.linked_asset_id, 0) = COALESCE(input.linked_asset_id, 0)
+            """,
+            *args,
+        )
+        found = {
+            (row["key"], row["value"], row["linked_asset_id"]): row["id"]
+            for row in rows
+        }
+
+        if len(found) < len(set(zip(*args))):
+            # Someone else created some of these after the statement started.
+            # They've committed (or we'd still be waiting on them), so a new
+            # statement sees them.
+            rows = await conn.fetch(
+                """
+                SELECT tag.id, tag.key, tag.value, tag.linked_asset_id
+                FROM tag
+                JOIN unnest($1::text[], $2::text[], $3::int[])
+                    AS input (key, value, linked_asset_id)
+                ON tag.key = input.key AND tag.value = input.value
+                AND COALESCE(tag.linked_asset_id, 0) = COALESCE(input.linked_asset_id, 0)
+                """,
+                *args,
+            )
+            found = {
+                (row["key"], row["value"], row["linked_asset_id"]): row["id"]
+                for row in rows
+            }
+
+        results = [
+            TagResult(
+                tag_id=found[tag.key, tag.value, tag.linked_asset_id],
+                key=tag.key,
+                value=tag.value,
+                linked_asset_id=tag.linked_asset_id,
+            )
+            for tag in tags
+        ]
+
+        if asset_id is not None:
+            await conn.execute(
+                """
+                INSERT INTO asset_tag (asset_id, tag_id)
+                SELECT $1, tag_id FROM unnest($2::int[]) AS tag_id
+                ON CONFLICT DO NOTHING
+                """,
+                asset_id,
+                list({result.tag_id for result in results}),
+            )
+
+    return results
+
+
+# Arbitrary key for the advisory lock held while changing tag implications
+TAG_IMPLICATION_LOCK_ID = 0x5348414D + 1
+
+
+class TagCycle(Exception):
+    pass
+
+
+@timed
+async def post_associated_tag(conn, implied_by: int, implies: int):
+    """
+    - Make one tag imply another (eg. "dog" implies "animal")
+        - `POST /tags/<tag-id>/implies`
+    The implication is transitive, and it may not form a cycle. Raises
+    `TagNotFound` with whichever tag doesn't exist.
+    """
+    async with conn.transaction():
+        # Implications are changed one at a time so the closure stays right
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", TAG_IMPLICATION_LOCK_ID)
+
+        cycle = implied_by == implies or await conn.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT FROM tag_closure WHERE implied_by = $1 AND implies = $2
+            )
+            """,
+            implies,
+            implied_by,
+        )
+        if cycle:
+            raise TagCycle(f"tag {implies} already implies tag {implied_by}")
+
+        try:
+            inserted = await conn.fetchval(
+                """
+                INSERT INTO associated_tag (implied_by, implies) VALUES ($1, $2)
+                ON CONFLICT DO NOTHING
+                RETURNING true
+                """,
+                implied_by,
+                implies,
+            )
+        except asyncpg.ForeignKeyViolationError as e:
+            if e.constraint_name == "associated_tag_implies_fkey":
+                raise TagNotFound(implies)
+            raise TagNotFound(implied_by)
+        if not inserted:
+            return
+
+        # Everything that implies `implied_by` now implies everything that
+        # `implies` implies
+        await conn.execute(
+            """
+            INSERT INTO tag_closure (implied_by, implies)
+            SELECT ancestor.id, descendant.id
+            FROM (
+                SELECT $1::int AS id
+                UNION SELECT implied_by FROM tag_closure WHERE implies = $1
+            ) AS ancestor
+            CROSS JOIN (
+                SELECT $2::int AS id
+                UNION SELECT implies FROM tag_closure WHERE implied_by = $2
+            ) AS descendant
+            ON CONFLICT DO NOTHING
+            """,
+            implied_by,
+            implies,
+        )
+
+
+@timed
+async def delete_associated_tag(conn, implied_by: int, implies: int):
+    """
+    - Stop one tag from implying another
+        - `DELETE /tags/<tag-id>/implies/<tag-id>`
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", TAG_IMPLICATION_LOCK_ID)
+
+        deleted = await conn.fetchval(
+            """
+            DELETE FROM associated_tag WHERE implied_by = $1 AND implies = $2
+            RETURNING true
+            """,
+            implied_by,
+            implies,
+        )
+        if not deleted:
+            return
+
+        # Other paths may still connect the same tags, so recompute the closure
+        # of the tags that could have been affected: `implied_by` and whatever
+        # implies it
+        affected = await conn.fetchval(
+            """
+            SELECT array_agg(id) FROM (
+                SELECT $1::int AS id
+                UNION SELECT implied_by FROM tag_closure WHERE implies = $1
+            ) AS affected
+            """,
+            implied_by,
+        )
+        await conn.execute(
+            "DELETE FROM tag_closure WHERE implied_by = ANY($1)", affected
+        )
+        await conn.execute(
+            """
+            INSERT INTO tag_closure
+            WITH RECURSIVE closure (implied_by, implies) AS (
+                SELECT implied_by, implies FROM associated_tag
+                WHERE implied_by = ANY($1)
+                UNION
+                SELECT closure.implied_by, associated_tag.implies
+                FROM closure
+                JOIN associated_tag ON associated_tag.implied_by = closure.implies
+            )
+            SELECT implied_by, implies FROM closure
+            """,
+            affected,
+        )
+
+
+@timed
+async def get_implied_tags(conn, tag_id: int) -> List[int]:
+    """
+    - GET every tag implied by tag_id, directly or not
+        - `GET /tags/<tag-id>/implies`
+    """
+    rows = await conn.fetch(
+        "SELECT implies FROM tag_closure WHERE implied_by = $1", tag_id
+    )
+    return [row["implies"] for row in rows]
+
+
+@timed
 async def delete_asset(conn, asset_id: int):
     """
     - DELETE asset_id
         - `DELETE /assets/<asset-id>`
     """
-    await conn.execute("UPDATE asset SET deleted = $1 WHERE id = $2", True, asset_id)
+    # The files are removed later by the reaper, see `reaper.reap`
+    await conn.execute(
+        "UPDATE asset SET deleted = $1, deleted_at = now() WHERE id = $2",
+        True,
+        asset_id,
+    )
 
 
+@timed
 async def post_tag_on_asset(conn, asset_id, tag_id):
     """
     - Associate tag with asset (should the client have to create the tag, or should this be an upsert?)
@@ -205,6 +1305,7 @@ async def post_tag_on_asset(conn, asset_id, tag_id):
     )
 
 
+@timed
 async def delete_tag_from_asset(conn, asset_id, tag_id):
     """
     - Tags are never deleted, associations are just removed
@@ -215,6 +1316,111 @@ async def delete_tag_from_asset(conn, asset_id, tag_id):
     )
 
 
+@dataclass
+class AssetTagBatchResult:
+    added: int
+    removed: int
+    # Why pairs couldn't be added, by their key in `add`
+    errors: Dict[int, Error]
+
+
+@timed
+async def post_asset_tags(
+    conn, add: Mapping[int, Tuple[int, int]], remove: Mapping[int, Tuple[int, int]]
+) -> AssetTagBatchResult:
+    """
+    - Add and remove many (asset_id, tag_id) associations at once
+        - `POST /asset_tags`
+    Everything happens in one transaction. Adding a pair that's already there,
+    or removing one that isn't, is not an error. Pairs where the asset or tag
+    doesn't exist are skipped and reported.
+    """
+    errors = {}
+    added = 0
+    removed = 0
+
+    async with conn.transaction():
+        if add:
+            await conn.execute(
+                """
+                CREATE TEMPORARY TABLE _asset_tag_batch (
+                    key INTEGER NOT NULL,
+                    asset_id INTEGER NOT NULL,
+                    tag_id INTEGER NOT NULL
+                ) ON COMMIT DROP
+                """
+            )
+            await conn.copy_records_to_table(
+                "_asset_tag_batch",
+                records=[
+                    (key, asset_id, tag_id) for key, (asset_id, tag_id) in add.items()
+                ],
+            )
+
+            missing = await conn.fetch(
+                """
+                SELECT batch.key, batch.asset_id, batch.tag_id,
+                    asset.id IS NULL AS no_asset, tag.id IS NULL AS no_tag
+                FROM _asset_tag_batch AS batch
+                LEFT JOIN asset ON asset.id = batch.asset_id
+                LEFT JOIN tag ON tag.id = batch.tag_id
+                WHERE asset.id IS NULL OR tag.id IS NULL
+                """
+            )
+            for row in missing:
+                if row["no_asset"]:
+                    errors[row["key"]] = Error(f"asset {row['asset_id']} does not exist")
+                else:
+                    errors[row["key"]] = Error(f"tag {row['tag_id']} does not exist")
+
+            added = await conn.fetchval(
+                """
+                WITH inserted AS (
+                    INSERT INTO asset_tag (asset_id, tag_id)
+                    SELECT DISTINCT batch.asset_id, batch.tag_id
+                    FROM _asset_tag_batch AS batch
+                    JOIN asset ON asset.id = batch.asset_id
+                    JOIN tag ON tag.id = batch.tag_id
+                    ON CONFLICT DO NOTHING
+                    RETURNING 1
+                )
+                SELECT count(*) FROM inserted
+                """
+            )
+
+        if remove:
+            asset_ids, tag_ids = zip(*remove.values())
+            removed = await conn.fetchval(
+                """
+                WITH deleted AS (
+                    DELETE FROM asset_tag
+                    USING unnest($1::int[], $2::int[]) AS batch (asset_id, tag_id)
+                    WHERE asset_tag.asset_id = batch.asset_id
+                    AND asset_tag.tag_id = batch.tag_id
+                    RETURNING 1
+                )
+                SELECT count(*) FROM deleted
+                """,
+                asset_ids,
+                tag_ids,
+            )
+
+    return AssetTagBatchResult(added=added, removed=removed, errors=errors)
+
+
+@timed
 async def get_all_asset_tags(conn):
     rows = await conn.fetch("SELECT asset_id, tag_id FROM asset_tag")
     return [{"tag_id": row["tag_id"], "asset_id": row["asset_id"]} for row in rows]
+
+
+async def iter_all_asset_tags(conn, batch_size: int = 10000) -> AsyncIterator[dict]:
+    """
+    Like `get_all_asset_tags`, but reads the table through a server-side
+    cursor `batch_size` rows at a time instead of all at once.
+    """
+    async with conn.transaction():
+        async for row in conn.cursor(
+            "SELECT asset_id, tag_id FROM asset_tag", prefetch=batch_size
+        ):
+            yield {"tag_id": row["tag_id"], "asset_id": row["asset_id"]}
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Hashable
+
+
+class AssetCache:
+    """
+    The contents of small assets that were read recently, so the popular ones
+    are served from memory without touching the disk.
+
+    Entries are keyed by asset id, or by (asset id, encoding) for compressed
+    variants. Assets never change, so an entry only goes away when it's
+    evicted to stay under `max_bytes`, or when the asset is deleted or
+    purged. Each worker has its own cache.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_size: int):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Least recently used first
+        self._entries: OrderedDict[Hashable, bytes] = OrderedDict()
+
+    def fits(self, size: int) -> bool:
+        return size <= min(self.max_entry_size, self.max_bytes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Without counting a hit or a miss
+        return key in self._entries
+
+    def get(self, key: Hashable) -> bytes | None:
+        body = self._entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: Hashable, body: bytes):
+        if not self.fits(len(body)):
+            return
+
+        self.discard(key)
+        self._entries[key] = body
+        self.size += len(body)
+
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def discard(self, key: Hashable):
+        if (body := self._entries.pop(key, None)) is not None:
+            self.size -= len(body)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from . import __version__
+
+SCENARIOS = ["upload", "download", "search", "tag"]
+
+
+@dataclass
+class BenchConfig:
+    # Seeded before anything is measured
+    assets: int = 1000
+    tags: int = 50
+    tags_per_asset: int = 3
+    asset_size: int = 4096
+    # Clients running at once, each with one keep-alive connection
+    concurrency: int = 16
+    # Requests per scenario
+    requests: int = 2000
+    seed: int = 0
+
+
+class HttpClient:
+    """
+    Just enough HTTP/1.1 for the benchmark: one keep-alive connection, bodies
+    with a Content-Length or chunked. Keeping it this small means the client
+    isn't what's being measured.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes = b"",
+        content_type: str = "application/octet-stream",
+    ) -> Tuple[int, bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        head = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "\r\n"
+        )
+        self._writer.write(head.encode() + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("server closed the connection")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while (line := await self._reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while size := int((await self._reader.readline()).split(b";")[0], 16):
+                chunks.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+            await self._reader.readline()
+            response_body = b"".join(chunks)
+        else:
+            length = int(headers.get("content-length", 0))
+            response_body = await self._reader.readexactly(length)
+
+        if headers.get("connection") == "close":
+            await self.close()
+
+        return status, response_body
+
+    async def json(self, method: str, path: str, data=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        status, response_body = await self.request(
+            method, path, body, content_type="application/json"
+        )
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} failed with {status}: {response_body!r}")
+        return json.loads(response_body)
+
+
+@dataclass
+class Seeded:
+    asset_ids: List[int]
+    tag_ids: List[int]
+    # One per client for the tag scenario, so clients never fight over a pair
+    scratch_tag_ids: List[int]
+
+
+async def seed(host: str, port: int, config: BenchConfig, rng: random.Random) -> Seeded:
+    clients = [HttpClient(host, port) for _ in range(config.concurrency)]
+    try:
+        client = clients[0]
+        tag_ids = []
+        for i in range(config.tags):
+            tag = {"key": "bench", "value": f"tag-{i}", "linked_asset_id": None}
+            tag_ids.append((await client.json("POST", "/tags", tag))["id"])
+
+        scratch_tag_ids = []
+        for i in range(config.concurrency):
+            tag = {"key": "bench-scratch", "value": f"client-{i}", "linked_asset_id": None}
+            scratch_tag_ids.append((await client.json("POST", "/tags", tag))["id"])
+
+        bodies = [rng.randbytes(config.asset_size) for _ in range(config.assets)]
+
+        async def upload(client, indexes):
+            ids = []
+            for i in indexes:
+                path = f"/assets?filename=seed-{i}.bin"
+                status, body = await client.request("POST", path, bodies[i])
+                if status >= 400:
+                    raise RuntimeError(f"POST {path} failed with {status}: {body!r}")
+                ids.append(json.loads(body)["id"])
+            return ids
+
+        batches = await asyncio.gather(
+            *(
+                upload(c, range(n, config.assets, config.concurrency))
+                for n, c in enumerate(clients)
+            )
+        )
+        asset_ids = sorted(asset_id for batch in batches for asset_id in batch)
+
+        add = [
+            {"asset_id": asset_id, "tag_id": tag_id}
+            for asset_id in asset_ids
+            for tag_id in rng.sample(tag_ids, min(config.tags_per_asset, len(tag_ids)))
+        ]
+        for start in range(0, len(add), 10_000):
+            await client.json("POST", "/asset_tags", {"add": add[start : start + 10_000]})
+
+        return Seeded(asset_ids, tag_ids, scratch_tag_ids)
+    finally:
+        for client in clients:
+            await client.close()
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(p * len(sorted_values)) - 1, 0)]
+
+
+async def run_scenario(
+    host: str,
+    port: int,
+    config: BenchConfig,
+    make_op: Callable[[int, HttpClient, random.Random], Callable[[], Awaitable[int]]],
+) -> dict:
+    """
+    Run `config.requests` operations spread over `config.concurrency`
+    clients. `make_op` makes each client's operation, which returns the HTTP
+    status.
+    """
+    latencies = []
+    errors = 0
+    remaining = config.requests
+
+    async def run_client(n):
+        nonlocal errors, remaining
+        client = HttpClient(host, port)
+        # Each client gets its own deterministic stream of choices
+        op = make_op(n, client, random.Random(config.seed * 1000 + n))
+        try:
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    status = await op()
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    status = 599
+                    await client.close()
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors += 1
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(n) for n in range(config.concurrency)))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(len(latencies) / seconds, 1),
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+def _scenario_ops(config: BenchConfig, seeded: Seeded, upload_body: bytes):
+    def upload(n, client, rng):
+        async def op():
+            status, _ = await client.request(
+                "POST", f"/assets?filename=bench-{n}.bin", upload_body
+            )
+            return status
+
+        return op
+
+    def download(n, client, rng):
+        async def op():
+            status, _ = await client.request("GET", f"/assets/{rng.choice(seeded.asset_ids)}")
+            return status
+
+        return op
+
+    def search(n, client, rng):
+        async def op():
+            # Mostly one tag, sometimes the intersection of two
+            tags = rng.sample(seeded.tag_ids, 2 if rng.random() < 0.3 else 1)
+            query = "&".join(f"tag={tag_id}" for tag_id in tags)
+            status, _ = await client.request("GET", f"/assets?{query}&limit=100")
+            return status
+
+        return op
+
+    def tag(n, client, rng):
+        # Alternately tag and untag assets with this client's own tag
+        tag_id = seeded.scratch_tag_ids[n]
+        state = {"asset_id": None}
+
+        async def op():
+            if state["asset_id"] is None:
+                state["asset_id"] = rng.choice(seeded.asset_ids)
+                status, _ = await client.request(
+                    "POST",
+                    f"/assets/{state['asset_id']}/tags",
+                    json.dumps({"tag_id": tag_id}).encode(),
+                    content_type="application/json",
+                )
+            else:
+                status, _ = await client.request(
+                    "DELETE", f"/assets/{state['asset_id']}/tags/{tag_id}"
+                )
+                state["asset_id"] = None
+            return status
+
+        return op
+
+    return {"upload": upload, "download": download, "search": search, "tag": tag}
+
+
+async def run_bench(
+    host: str, port: int, config: BenchConfig, scenarios: List[str] = SCENARIOS
+) -> dict:
+    rng = random.Random(config.seed)
+
+    seed_start = time.perf_counter()
+    seeded = await seed(host, port, config, rng)
+    seed_seconds = time.perf_counter() - seed_start
+
+    ops = _scenario_ops(config, seeded, rng.randbytes(config.asset_size))
+    results = {}
+    for scenario in scenarios:
+        results[scenario] = await run_scenario(host, port, config, ops[scenario])
+
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "config": asdict(config),
+        "seed_seconds": round(seed_seconds, 3),
+        "scenarios": results,
+    }
+
+
+def _start_server(db_url: str, asset_dir: str, port: int, server_args: List[str]):
+    p = subprocess.Popen(
+        [
+            sys.executable, "-m", "sham",
+            "--db_url", db_url,
+            "--asset_dir", asset_dir,
+            "--port", str(port),
+            *server_args,
+        ],
+        # Logging every request would be most of what's measured, and the
+        # results go to stdout
+        env={**os.environ, "SHAM_ACCESS_LOG": "false"},
+        stdout=subprocess.DEVNULL,
+    )
+
+    async def is_up():
+        client = HttpClient("127.0.0.1", port)
+        try:
+            await client.request("GET", "/stats")
+            return True
+        except OSError:
+            return False
+        finally:
+            await client.close()
+
+    for _ in range(500):
+        if p.poll() is not None:
+            raise RuntimeError("sham exited while starting")
+        if asyncio.run(is_up()):
+            return p
+        time.sleep(0.02)
+
+    p.kill()
+    raise RuntimeError("sham didn't start")
+
+
+def main(argv: Optional[List[str]] = None):
+    """
+    `sham bench`: start sham against a throwaway database (from `pg_tmp`),
+    seed it and time each scenario. Prints the results as JSON.
+    """
+    defaults = BenchConfig()
+    parser = argparse.ArgumentParser(prog="sham bench")
+    parser.add_argument(
+        "--url",
+        help="Benchmark a server that's already running (eg. http://localhost:8000)",
+    )
+    parser.add_argument("--db_url", help="Database to start sham against, rather than pg_tmp")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument(
+        "--server_args",
+        default="",
+        help='Extra flags for the server, eg. --server_args="--workers 4 --tag_index"',
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="Scenarios to run (repeatable), all of them by default",
+    )
+    parser.add_argument("--output", help="Also write the results to this file")
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name}", type=type(value), default=value)
+
+    args = parser.parse_args(argv)
+    config = BenchConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    scenarios = args.scenario or SCENARIOS
+
+    server = None
+    with tempfile.TemporaryDirectory() as asset_dir:
+        try:
+            if args.url:
+                host, _, port = args.url.removeprefix("http://").rstrip("/").partition(":")
+                port = int(port or 80)
+            else:
+                db_url = args.db_url or subprocess.check_output(["pg_tmp"], text=True).strip()
+                host, port = "127.0.0.1", args.port
+                server = _start_server(db_url, asset_dir, port, shlex.split(args.server_args))
+
+            results = asyncio.run(run_bench(host, port, config, scenarios))
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
@@ -0,0 +1,242 @@
+import asyncio
+import gzip
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import app
+
+# zstandard is optional, without it there are only gzip variants
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Content-Encoding names and the extension of their variant
+EXTENSIONS = {"zstd": "zst", "gzip": "gz"}
+
+# The encodings we can write, most preferred first (for the same q-value)
+ENCODINGS = ["zstd", "gzip"] if zstandard else ["gzip"]
+
+# Types that are worth compressing. Everything under text/ is too.
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/ld+json",
+    "application/x-ndjson",
+    "application/xml",
+    "image/bmp",
+    "image/svg+xml",
+    "image/x-ms-bmp",
+}
+
+# A variant is only kept if it's at most this fraction of the original.
+# Anything less isn't worth the extra file.
+MAX_RATIO = 0.9
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and (
+        content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+    )
+
+
+def wants_variants(name: str) -> bool:
+    return is_compressible(mimetypes.guess_type(name)[0])
+
+
+# Variants sit next to their asset, `asset_dir/shards/d2/04/1234.gz`
+def variant_path_from_dir_and_id(asset_dir, asset_id, encoding: str) -> Path:
+    path = app.asset_path_from_dir_and_id(asset_dir, asset_id)
+    return path.with_name(f"{path.name}.{EXTENSIONS[encoding]}")
+
+
+def variant_paths_from_dir_and_id(asset_dir, asset_id) -> List[Path]:
+    # Every variant there could be, whatever's installed now
+    return [
+        variant_path_from_dir_and_id(asset_dir, asset_id, encoding)
+        for encoding in EXTENSIONS
+    ]
+
+
+def negotiate(accept_encoding: Optional[str], encodings) -> Optional[str]:
+    """
+    The best of `encodings` (in order of preference) that the client accepts,
+    or None for the unencoded asset.
+    """
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip().lower()] = weight
+
+    best = None
+    best_weight = 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=19).compress(data)
+
+    # mtime=0 so the same asset always compresses to the same bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def write_variants(
+    source: List[str] | bytes, dest_paths: Dict[str, str], min_size: int, max_size: int
+) -> List[str]:
+    """
+    Compress the first of the paths in `source` that exists (or the bytes of
+    a packed asset, see `app.asset_source`) with each encoding in
+    `dest_paths`, keeping the variants that are enough smaller. Returns the
+    encodings that were kept. This runs in a worker thread.
+    """
+    if isinstance(source, bytes):
+        data = source
+        if not min_size <= len(data) <= max_size:
+            return []
+    else:
+        for source_path in source:
+            if os.path.exists(source_path):
+                break
+        else:
+            raise app.AssetNotFound(source[0])
+
+        if not min_size <= os.path.getsize(source_path) <= max_size:
+            return []
+
+        with open(source_path, "rb") as f:
+            data = f.read()
+
+    kept = []
+    for encoding, dest_path in dest_paths.items():
+        compressed = compress(data, encoding)
+        if len(compressed) > len(data) * MAX_RATIO:
+            continue
+
+        # Packed assets don't have a directory of their own yet
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        kept.append(encoding)
+
+    return kept
+
+
+class VariantWriter:
+    """
+    Writes compressed variants of uploaded text-like assets in a pool of
+    threads, so downloads can send them as they are instead of compressing on
+    every request. zlib and zstd let go of the GIL while they work.
+
+    Uploads queue their asset with `submit`. If the queue is full, that asset
+    is only ever sent uncompressed.
+    """
+
+    def __init__(
+        self,
+        asset_dir,
+        workers: int = 1,
+        min_size: int = 1024,
+        max_size: int = 64 * 1024 * 1024,
+        max_queued: int = 1000,
+        packs=None,
+    ):
+        self.asset_dir = asset_dir
+        # Where packed assets are read from, see `packfile.PackStore`
+        self.packs = packs
+        self.workers = workers
+        # Tiny assets fit in a packet either way, and huge ones would be read
+        # into memory whole
+        self.min_size = min_size
+        self.max_size = max_size
+        self._queue = asyncio.Queue(max_queued)
+        self._tasks = []
+        self._executor = None
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        if self._executor:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self._executor.shutdown(cancel_futures=True)
+            )
+
+    def submit(self, asset_id: int, name: str) -> Optional[asyncio.Future]:
+        """
+        Queue an asset for compression, if it's text-like. The future resolves
+        to the encodings that were written.
+        """
+        if not wants_variants(name):
+            return None
+
+        job = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((asset_id, job))
+        except asyncio.QueueFull:
+            logger.warning("Compression queue is full, skipping asset %s", asset_id)
+            return None
+
+        return job
+
+    async def _work(self):
+        while True:
+            asset_id, job = await self._queue.get()
+            try:
+                job.set_result(await self._write(asset_id))
+            finally:
+                if not job.done():
+                    job.cancel()
+
+    async def _write(self, asset_id: int) -> List[str]:
+        dest_paths = {
+            encoding: str(
+                variant_path_from_dir_and_id(self.asset_dir, asset_id, encoding)
+            )
+            for encoding in ENCODINGS
+        }
+        try:
+            source = await app.asset_source(self.asset_dir, asset_id, self.packs)
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                write_variants,
+                source,
+                dest_paths,
+                self.min_size,
+                self.max_size,
+            )
+        except Exception:
+            logger.exception("Couldn't compress asset %s", asset_id)
+            return []
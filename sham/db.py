@@ -1,5 +1,9 @@
+import asyncio
 import asyncpg
-from typing import Optional
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
 
 SCHEMA_UPDATES = [
     # Version 0 is a no-op
@@ -48,9 +52,355 @@ SCHEMA_UPDATES = [
     ALTER TABLE tag DROP CONSTRAINT tag_key_value_key;
     ALTER TABLE tag ADD UNIQUE (key, value, linked_asset_id);
     """,
+    # Hex SHA-256 of the asset's contents, computed while it's uploaded. Assets
+    # from before this was added don't have one.
+    """
+    ALTER TABLE asset ADD COLUMN sha256 TEXT;
+    """,
+    # With content addressed storage, identical uploads share one blob on disk
+    # named after its hash. The refcount is the number of assets using it.
+    """
+    CREATE TABLE blob (
+        sha256 TEXT PRIMARY KEY NOT NULL,
+        size BIGINT NOT NULL,
+        refcount INTEGER NOT NULL CHECK (refcount >= 0)
+    );
+    ALTER TABLE asset ADD COLUMN blob_sha256 TEXT REFERENCES blob(sha256);
+    """,
+    # Indexes for searching assets. The primary key of asset_tag only helps
+    # when starting from an asset, searches start from a tag. Searches never
+    # return deleted assets, so those are left out of the asset indexes.
+    """
+    CREATE INDEX asset_tag_tag_id_asset_id ON asset_tag (tag_id, asset_id);
+    CREATE INDEX asset_not_deleted_id ON asset (id) WHERE NOT deleted;
+    CREATE INDEX asset_not_deleted_name ON asset (name text_pattern_ops, id)
+        WHERE NOT deleted;
+    """,
+    # Every (implied_by, implies) pair that follows from associated_tag,
+    # directly or transitively. This is kept up to date as associations change
+    # (see `app.post_associated_tag`) so reads don't have to walk the graph.
+    """
+    CREATE TABLE tag_closure (
+        implied_by INTEGER NOT NULL REFERENCES tag(id),
+        implies INTEGER NOT NULL REFERENCES tag(id),
+        PRIMARY KEY (implied_by, implies)
+    );
+    CREATE INDEX tag_closure_implies ON tag_closure (implies, implied_by);
+
+    INSERT INTO tag_closure
+    WITH RECURSIVE closure (implied_by, implies) AS (
+        SELECT implied_by, implies FROM associated_tag
+        UNION
+        SELECT closure.implied_by, associated_tag.implies
+        FROM closure JOIN associated_tag ON associated_tag.implied_by = closure.implies
+    )
+    SELECT implied_by, implies FROM closure WHERE implied_by <> implies;
+    """,
+    # Workers cache the tag table (see `tag_cache.TagCache`) and hear about
+    # changes on the "sham_tag" channel. Every change bumps the generation.
+    # Updating the single generation row also serialises tag changes, so
+    # generations are in commit order and a snapshot of the tag table always
+    # matches a snapshot of the generation.
+    """
+    CREATE TABLE tag_generation (generation BIGINT NOT NULL);
+    INSERT INTO tag_generation VALUES (0);
+
+    CREATE FUNCTION notify_tag_change() RETURNS trigger AS $$
+    DECLARE
+        new_generation BIGINT;
+        payload TEXT;
+    BEGIN
+        UPDATE tag_generation SET generation = generation + 1
+        RETURNING generation INTO new_generation;
+
+        IF TG_OP = 'DELETE' THEN
+            payload := json_build_object(
+                'generation', new_generation, 'op', TG_OP, 'id', OLD.id
+            );
+        ELSE
+            payload := json_build_object(
+                'generation', new_generation,
+                'op', TG_OP,
+                'id', NEW.id,
+                'key', NEW.key,
+                'value', NEW.value,
+                'linked_asset_id', NEW.linked_asset_id
+            );
+        END IF;
+
+        -- Notifications are limited to 8000 bytes, huge tags make everyone
+        -- reload instead
+        IF octet_length(payload) > 7900 THEN
+            payload := json_build_object('generation', new_generation, 'op', 'RELOAD');
+        END IF;
+
+        PERFORM pg_notify('sham_tag', payload);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER tag_notify AFTER INSERT OR UPDATE OR DELETE ON tag
+    FOR EACH ROW EXECUTE FUNCTION notify_tag_change();
+    """,
+    # Notifications for the in-memory tag index. These fire once per statement
+    # and pack the changed rows into as few notifications as fit. The sequence
+    # number keeps identical payloads in one transaction from being merged.
+    """
+    CREATE SEQUENCE notification_seq;
+
+    CREATE FUNCTION notify_batched(channel TEXT, op TEXT, items TEXT[])
+    RETURNS void AS $$
+    DECLARE
+        payload TEXT := '';
+        item TEXT;
+    BEGIN
+        FOREACH item IN ARRAY items LOOP
+            payload := payload || ' ' || item;
+            IF octet_length(payload) > 7000 THEN
+                PERFORM pg_notify(channel, nextval('notification_seq') || ' ' || op || payload);
+                payload := '';
+            END IF;
+        END LOOP;
+
+        IF payload <> '' THEN
+            PERFORM pg_notify(channel, nextval('notification_seq') || ' ' || op || payload);
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION notify_asset_tag_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM notify_batched(
+            'sham_asset_tag',
+            TG_OP,
+            ARRAY(SELECT asset_id || ':' || tag_id FROM changed_rows)
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER asset_tag_insert_notify AFTER INSERT ON asset_tag
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_tag_change();
+
+    CREATE TRIGGER asset_tag_delete_notify AFTER DELETE ON asset_tag
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_tag_change();
+
+    CREATE FUNCTION notify_asset_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM notify_batched(
+                'sham_asset',
+                'LIVE',
+                ARRAY(SELECT id::TEXT FROM new_rows WHERE NOT deleted)
+            );
+        ELSE
+            PERFORM notify_batched(
+                'sham_asset',
+                'LIVE',
+                ARRAY(
+                    SELECT id::TEXT FROM new_rows JOIN old_rows USING (id)
+                    WHERE old_rows.deleted AND NOT new_rows.deleted
+                )
+            );
+            PERFORM notify_batched(
+                'sham_asset',
+                'DELETED',
+                ARRAY(
+                    SELECT id::TEXT FROM new_rows JOIN old_rows USING (id)
+                    WHERE NOT old_rows.deleted AND new_rows.deleted
+                )
+            );
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER asset_insert_notify AFTER INSERT ON asset
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_change();
+
+    CREATE TRIGGER asset_update_notify AFTER UPDATE ON asset
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_change();
+
+    CREATE FUNCTION notify_tag_closure_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('sham_tag_closure', nextval('notification_seq') || ' ' || TG_OP);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER tag_closure_notify AFTER INSERT OR UPDATE OR DELETE ON tag_closure
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_tag_closure_change();
+    """,
+    # For the reaper (see `reaper.reap`). Uploads create their asset deleted
+    # and un-delete it once the file is in place, so a deleted asset without a
+    # deleted_at is an upload that never finished. Purged assets are deleted
+    # assets whose files have been removed. Assets deleted before this have
+    # their grace period start now, rather than being taken for uploads.
+    """
+    ALTER TABLE asset ADD COLUMN created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+    ALTER TABLE asset ADD COLUMN deleted_at TIMESTAMPTZ;
+    UPDATE asset SET deleted_at = now() WHERE deleted;
+    ALTER TABLE asset ADD COLUMN purged BOOL NOT NULL DEFAULT false;
+    CREATE INDEX asset_unpurged ON asset (id) WHERE deleted AND NOT purged;
+    CREATE INDEX blob_unreferenced ON blob (sha256) WHERE refcount = 0;
+    """,
+    # NULLs are never equal in a UNIQUE constraint, so the same key and value
+    # could be created any number of times without a linked asset. Merge those
+    # into the oldest, then make them unique. Asset ids start at 1, so 0 never
+    # clashes with a real linked asset. This also lets `app.ensure_tags` use
+    # ON CONFLICT.
+    """
+    CREATE TEMPORARY TABLE tag_merge ON COMMIT DROP AS
+    SELECT id AS duplicate, min(id) OVER (PARTITION BY key, value) AS keep
+    FROM tag WHERE linked_asset_id IS NULL;
+    DELETE FROM tag_merge WHERE duplicate = keep;
+
+    INSERT INTO asset_tag (asset_id, tag_id)
+    SELECT asset_id, keep FROM asset_tag JOIN tag_merge ON tag_id = duplicate
+    ON CONFLICT DO NOTHING;
+    DELETE FROM asset_tag USING tag_merge WHERE tag_id = duplicate;
+
+    INSERT INTO associated_tag (implied_by, implies)
+    SELECT COALESCE(a.keep, implied_by), COALESCE(b.keep, implies)
+    FROM associated_tag
+    LEFT JOIN tag_merge AS a ON a.duplicate = implied_by
+    LEFT JOIN tag_merge AS b ON b.duplicate = implies
+    WHERE (a.keep IS NOT NULL OR b.keep IS NOT NULL)
+    AND COALESCE(a.keep, implied_by) <> COALESCE(b.keep, implies)
+    ON CONFLICT DO NOTHING;
+    DELETE FROM associated_tag USING tag_merge
+    WHERE implied_by = duplicate OR implies = duplicate;
+
+    DELETE FROM tag_closure USING tag_merge
+    WHERE implied_by = duplicate OR implies = duplicate;
+    INSERT INTO tag_closure
+    WITH RECURSIVE closure (implied_by, implies) AS (
+        SELECT implied_by, implies FROM associated_tag
+        UNION
+        SELECT closure.implied_by, associated_tag.implies
+        FROM closure JOIN associated_tag ON associated_tag.implied_by = closure.implies
+    )
+    SELECT implied_by, implies FROM closure WHERE implied_by <> implies
+    ON CONFLICT DO NOTHING;
+
+    DELETE FROM tag USING tag_merge WHERE id = duplicate;
+
+    ALTER TABLE tag DROP CONSTRAINT tag_key_value_linked_asset_id_key;
+    CREATE UNIQUE INDEX tag_key_value_linked_asset_id
+        ON tag (key, value, COALESCE(linked_asset_id, 0));
+    """,
+    # Small assets can be packed into segment files, see `packfile.PackStore`.
+    # A sealed segment is never written to again. An asset's entry goes when
+    # its row does, but its bytes stay in the segment until the reaper
+    # rewrites it.
+    """
+    CREATE TABLE pack_segment (
+        id SERIAL PRIMARY KEY NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        sealed BOOL NOT NULL DEFAULT false
+    );
+    CREATE TABLE pack_entry (
+        asset_id INTEGER PRIMARY KEY NOT NULL REFERENCES asset(id) ON DELETE CASCADE,
+        segment_id INTEGER NOT NULL REFERENCES pack_segment(id),
+        start BIGINT NOT NULL,
+        length INTEGER NOT NULL
+    );
+    CREATE INDEX pack_entry_segment_id ON pack_entry (segment_id, start);
+    """,
+    # Workers remember where packed assets are and keep small ones in memory.
+    # These tell them when an asset is purged or removed by the reaper, and
+    # when a segment has been rewritten, so they stop serving it.
+    """
+    CREATE FUNCTION notify_asset_purged() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM notify_batched(
+                'sham_asset', 'PURGED', ARRAY(SELECT id::TEXT FROM old_rows)
+            );
+        ELSE
+            PERFORM notify_batched(
+                'sham_asset',
+                'PURGED',
+                ARRAY(
+                    SELECT id::TEXT FROM new_rows JOIN old_rows USING (id)
+                    WHERE NOT old_rows.purged AND new_rows.purged
+                )
+            );
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER asset_purge_notify AFTER UPDATE ON asset
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_purged();
+
+    CREATE TRIGGER asset_delete_notify AFTER DELETE ON asset
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_asset_purged();
+
+    CREATE FUNCTION notify_pack_segment_delete() RETURNS trigger AS $$
+    BEGIN
+        PERFORM notify_batched(
+            'sham_pack_segment', 'DELETE', ARRAY(SELECT id::TEXT FROM old_rows)
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER pack_segment_delete_notify AFTER DELETE ON pack_segment
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_pack_segment_delete();
+    """,
+    # Bumping the tag generation locked its one row until the transaction
+    # committed, so every tag write in every worker queued behind the others.
+    # Tag notifications are numbered from notification_seq instead, which
+    # only keeps identical ones in a transaction from being merged. Each
+    # carries the whole row, so replaying them in order is always safe.
+    """
+    CREATE OR REPLACE FUNCTION notify_tag_change() RETURNS trigger AS $$
+    DECLARE
+        payload TEXT;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            payload := json_build_object(
+                'seq', nextval('notification_seq'), 'op', TG_OP, 'id', OLD.id
+            );
+        ELSE
+            payload := json_build_object(
+                'seq', nextval('notification_seq'),
+                'op', TG_OP,
+                'id', NEW.id,
+                'key', NEW.key,
+                'value', NEW.value,
+                'linked_asset_id', NEW.linked_asset_id
+            );
+        END IF;
+
+        -- Notifications are limited to 8000 bytes, huge tags make everyone
+        -- reload instead
+        IF octet_length(payload) > 7900 THEN
+            payload := json_build_object('seq', nextval('notification_seq'), 'op', 'RELOAD');
+        END IF;
+
+        PERFORM pg_notify('sham_tag', payload);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TABLE tag_generation;
+    """,
 ]
 
 
+# Arbitrary key for the advisory lock held while migrating ("SHAM" in ASCII)
+MIGRATION_LOCK_ID = 0x5348414D
+
+
 async def _version_table_exists(conn) -> Optional[int]:
     return await conn.fetchval(
         """
@@ -108,14 +458,154 @@ async def _migrate_if_needed(conn):
     assert await fetch_schema_version(conn) == len(SCHEMA_UPDATES) - 1
 
 
+async def migrate(conn):
+    """
+    Bring the schema up to date.
+
+    Several workers (or replicas) may start at once, so the migration runs
+    under an advisory lock. Whoever gets the lock second finds nothing to do.
+    """
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await _migrate_if_needed(conn)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+
+async def migrate_db_by_url(url):
+    conn = await asyncpg.connect(url)
+    try:
+        await migrate(conn)
+    finally:
+        await conn.close()
+
+
+async def schema_is_current(conn) -> bool:
+    if not await _version_table_exists(conn):
+        return False
+
+    return await fetch_schema_version(conn) == len(SCHEMA_UPDATES) - 1
+
+
+def db_url(username, password, ip="localhost", dbname="sham", port=5432):
+    return f"postgresql://{username}:{password}@{ip}:{port}/{dbname}"
+
+
 async def connect_to_db(username, password, ip="localhost", dbname="sham", port=5432):
-    return await connect_to_db_by_url(
-        f"postgresql://{username}:{password}@{ip}:{port}/{dbname}"
-    )
+    return await connect_to_db_by_url(db_url(username, password, ip, dbname, port))
 
 
 async def connect_to_db_by_url(url):
-    conn = await asyncpg.connect(url)
-    await _migrate_if_needed(conn)
+    # The schema is expected to be current, see `migrate`
+    return await asyncpg.connect(url)
+
+
+async def create_pool(
+    url,
+    min_size=2,
+    max_size=10,
+    statement_cache_size=100,
+    max_inactive_connection_lifetime=300.0,
+):
+    """
+    Create a connection pool that lives as long as the server does.
+
+    Pooled connections don't check the schema version, run `migrate` first.
+    """
+    return await asyncpg.create_pool(
+        url,
+        min_size=min_size,
+        max_size=max_size,
+        statement_cache_size=statement_cache_size,
+        max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+    )
+
+
+def pool_metrics(pool) -> dict:
+    size = pool.get_size()
+    idle = pool.get_idle_size()
+    return {
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+        "size": size,
+        "idle": idle,
+        "in_use": size - idle,
+    }
+
+
+class Listener:
+    """
+    Keeps a dedicated connection LISTENing on some channels, reconnecting if
+    the connection is lost.
+
+    `callbacks` maps channel names to functions called with each payload.
+    Notifications sent while disconnected are lost, so `on_connect` is awaited
+    after every (re)connect, once the channels are being listened to, to
+    catch up.
+    """
+
+    def __init__(
+        self,
+        url,
+        callbacks: Dict[str, Callable[[str], None]],
+        on_connect: Callable[[], Awaitable[None]],
+        reconnect_delay: float = 1.0,
+    ):
+        self.url = url
+        self.callbacks = callbacks
+        self.on_connect = on_connect
+        self.reconnect_delay = reconnect_delay
+        self._task = None
+
+    async def start(self):
+        """
+        Returns once connected and caught up for the first time.
+        """
+        connected = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(connected))
+        await connected
+
+    async def close(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self, connected):
+        while True:
+            lost = asyncio.Event()
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.url)
+                conn.add_termination_listener(lambda _conn: lost.set())
+                for channel, callback in self.callbacks.items():
+                    await conn.add_listener(channel, _notification_handler(callback))
+                await self.on_connect()
+            except Exception as e:
+                if conn is not None:
+                    conn.terminate()
+                if not connected.done():
+                    # Not being able to start at all is for the caller to handle
+                    connected.set_exception(e)
+                    return
+                logger.exception("Couldn't reconnect listener")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            if not connected.done():
+                connected.set_result(None)
+
+            try:
+                await lost.wait()
+            finally:
+                if not conn.is_closed():
+                    await conn.close()
+            logger.warning("Listener connection lost, reconnecting")
+
+
+def _notification_handler(callback):
+    def handler(_conn, _pid, _channel, payload):
+        callback(payload)
 
-    return conn
+    return handler
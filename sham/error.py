@@ -1,6 +1,7 @@
 import textwrap
 import typing
 from dataclasses import dataclass
+from typing import Any, Tuple
 
 # Ideally the "Any" is where this would be recursive
 ErrorInfo = str | list[typing.Any] | dict[str, typing.Any]
@@ -0,0 +1,264 @@
+import abc
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast query up to a slow upload
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Counters and histograms, exposed in Prometheus' text format by `GET /metrics`.
+#
+# This is just enough of a Prometheus client for sham. Recording a value is a
+# dict lookup and some arithmetic, so it's fine on hot paths. Metrics are kept
+# per process; `WorkerMetrics` shares them between workers.
+REGISTRY: List["_Metric"] = []
+
+
+class _Metric(abc.ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """
+        The series for these label values, in the order of `labelnames`.
+        """
+        values = tuple(map(str, values))
+        if (child := self._children.get(values)) is None:
+            assert len(values) == len(self.labelnames)
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        ...
+
+    @abc.abstractmethod
+    def _lines(self, labels: str, child) -> List[str]:
+        ...
+
+    def samples(self, extra: Sequence[Tuple[str, str]] = ()) -> List[str]:
+        """
+        This metric's sample lines, with the `extra` labels on every series.
+        """
+        lines = []
+        for values, child in self._children.items():
+            pairs = [*zip(self.labelnames, values), *extra]
+            lines += self._lines(_format_labels(pairs), child)
+        return lines
+
+    def expose(self, samples: Optional[List[str]] = None) -> str:
+        if samples is None:
+            samples = self.samples()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + samples) + "\n"
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _lines(self, labels, child):
+        return [f"{self.name}{labels} {child.value}"]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One more than the buckets, for +Inf. These aren't cumulative until
+        # they're exposed.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _lines(self, labels, child):
+        base = labels[1:-1]
+        lines = []
+        total = 0
+        for le, count in zip([*map(str, self.buckets), "+Inf"], child.counts):
+            total += count
+            bucket_labels = _format_labels([("le", le)], base)
+            lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+def timed(histogram: Histogram):
+    """
+    A decorator recording how long each call to an async function takes in
+    `histogram`, labelled with the function's name.
+    """
+
+    def decorator(f):
+        series = histogram.labels(f.__qualname__)
+
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def expose() -> str:
+    return "".join(metric.expose() for metric in REGISTRY)
+
+
+class WorkerMetrics:
+    """
+    Metrics from every worker sharing `directory`.
+
+    Each worker has its own metrics, and a scrape is answered by whichever
+    worker the connection lands on. So that every scrape sees all of them, each
+    worker writes its samples to `<directory>/<pid>.json`, labelled
+    `worker="<pid>"`, when it's scraped and every `interval` seconds, and
+    `expose` merges the files. Sum over `worker` to get totals; a worker that
+    restarts is a new series rather than a counter reset.
+    """
+
+    def __init__(self, directory: Path, interval: float = 5.0):
+        self.directory = Path(directory)
+        self.interval = interval
+        self.worker = str(os.getpid())
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, update: Callable[[], Awaitable[None]]):
+        """
+        Write this worker's samples every `interval` seconds, after awaiting
+        `update` to set any gauges.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(update))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: (self.directory / f"{self.worker}.json").unlink(missing_ok=True)
+        )
+
+    async def _run(self, update):
+        while True:
+            try:
+                await update()
+                await self.write()
+            except Exception:
+                logger.exception("Failed to write metrics for worker %s", self.worker)
+            await asyncio.sleep(self.interval)
+
+    async def write(self):
+        # Sampled on the event loop, which is the only thing changing them
+        samples = {
+            metric.name: metric.samples([("worker", self.worker)]) for metric in REGISTRY
+        }
+        await asyncio.get_running_loop().run_in_executor(None, self._write, samples)
+
+    def _write(self, samples):
+        path = self.directory / f"{self.worker}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(samples))
+        tmp_path.replace(path)
+
+    async def expose(self) -> str:
+        await self.write()
+        samples = await asyncio.get_running_loop().run_in_executor(None, self._read)
+        return "".join(metric.expose(samples.get(metric.name, [])) for metric in REGISTRY)
+
+    def _read(self) -> Dict[str, List[str]]:
+        merged: Dict[str, List[str]] = {}
+        for path in sorted(self.directory.glob("*.json")):
+            if not _is_running(int(path.stem)):
+                # A worker that was killed without cleaning up
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                samples = json.loads(path.read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+            for name, lines in samples.items():
+                merged.setdefault(name, []).extend(lines)
+        return merged
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(pairs, base: str = "") -> str:
+    labels = [base] if base else []
+    for name, value in pairs:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        labels.append(f'{name}="{value}"')
+    return "{" + ",".join(labels) + "}" if labels else ""
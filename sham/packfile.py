@@ -0,0 +1,333 @@
+import asyncio
+import mmap
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncContextManager, Callable, List, Optional, Sequence, Tuple
+
+# Writers start a new segment once theirs is this big...
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+# ...or this many seconds old, so a quiet worker doesn't keep appending to one
+# forever. An unsealed segment older than this was left by a worker that
+# stopped, see `reaper.reap`.
+SEGMENT_MAX_AGE = 3600.0
+
+# Segments are rewritten without their deleted assets once less than this
+# fraction of them is still in use
+COMPACT_RATIO = 0.5
+
+# Segments each worker keeps mapped at once
+MAX_MAPPED_SEGMENTS = 64
+
+# Asset locations each worker remembers
+MAX_KNOWN_LOCATIONS = 100_000
+
+# Notified with the ids of segments the reaper has rewritten
+SEGMENT_CHANNEL = "sham_pack_segment"
+
+
+# Segments are numbered by the database, `asset_dir/packs/17.pack`
+def segment_path_from_dir_and_id(asset_dir, segment_id) -> Path:
+    return Path(asset_dir) / "packs" / f"{segment_id}.pack"
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def read_entries(path, entries: Sequence[Tuple[int, int]]) -> List[bytes]:
+    """
+    The bytes of each (start, length) in a segment. This runs in a worker
+    thread.
+    """
+    with open(path, "rb") as f:
+        return [os.pread(f.fileno(), length, start) for start, length in entries]
+
+
+class SegmentWriter:
+    """
+    Appends to one segment file at a time. Every writer (one per worker, and
+    the reaper while compacting) has segments of its own, so appends never
+    have to be coordinated between processes, and a segment is never written
+    again once it's sealed.
+    """
+
+    def __init__(
+        self,
+        asset_dir,
+        segment_size: int = SEGMENT_SIZE,
+        max_age: float = SEGMENT_MAX_AGE,
+    ):
+        self.asset_dir = asset_dir
+        self.segment_size = segment_size
+        self.max_age = max_age
+        self._lock = asyncio.Lock()
+        self._segment_id = None
+        self._fd = None
+        self._size = 0
+        self._started_at = 0.0
+
+    async def append(self, conn, contents: Sequence[bytes]) -> List[Tuple[int, int]]:
+        """
+        Write each of `contents`, returning where each went as
+        (segment_id, start). Consecutive contents in the same segment are
+        written together.
+        """
+        async with self._lock:
+            locations = []
+            pending = []
+            end = self._size
+            for data in contents:
+                if self._fd is None or self._full(end, len(data)):
+                    await self._write(b"".join(pending))
+                    pending = []
+                    await self._start_segment(conn)
+                    end = 0
+
+                locations.append((self._segment_id, end))
+                pending.append(data)
+                end += len(data)
+
+            await self._write(b"".join(pending))
+            return locations
+
+    async def close(self, conn):
+        async with self._lock:
+            await self._seal(conn)
+
+    def _full(self, end: int, size: int) -> bool:
+        if time.monotonic() - self._started_at > self.max_age:
+            return True
+        # An asset bigger than a whole segment still gets one of its own
+        return end > 0 and end + size > self.segment_size
+
+    async def _start_segment(self, conn):
+        await self._seal(conn)
+
+        segment_id = await conn.fetchval(
+            "INSERT INTO pack_segment DEFAULT VALUES RETURNING id"
+        )
+        path = segment_path_from_dir_and_id(self.asset_dir, segment_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self._segment_id = segment_id
+        self._size = 0
+        self._started_at = time.monotonic()
+
+    async def _write(self, data: bytes):
+        if data:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _pwrite_all, self._fd, data, self._size
+            )
+            self._size += len(data)
+
+    async def _seal(self, conn):
+        if self._fd is None:
+            return
+
+        os.close(self._fd)
+        self._fd = None
+        await conn.execute(
+            "UPDATE pack_segment SET sealed = true WHERE id = $1", self._segment_id
+        )
+
+
+class PackedAsset:
+    """
+    An asset's bytes in a mapped segment. It has the parts of an open file
+    that `app.read_chunks` and downloads use, so it can stand in for one.
+    """
+
+    def __init__(self, buffer, start: int, size: int):
+        self._buffer = buffer
+        self._start = start
+        self._position = 0
+        self.size = size
+
+    async def read(self, n: int = -1) -> bytes:
+        remaining = self.size - self._position
+        if n < 0 or n > remaining:
+            n = remaining
+
+        start = self._start + self._position
+        self._position += n
+        return self._buffer[start : start + n]
+
+    async def seek(self, position: int):
+        self._position = position
+
+    async def close(self):
+        self._buffer = None
+
+
+class PackStore:
+    """
+    Small assets, appended one after another to large segment files
+    (`asset_dir/packs`) instead of being a file each. That's far fewer inodes
+    and files to open, and backups copy a few big files instead of millions
+    of tiny ones. Larger assets are still files of their own.
+
+    Where each asset is (segment, start and length) is in the pack_entry
+    table. Segments are read through `mmap`, so once a segment is mapped
+    reading an asset is a lookup and a copy out of the page cache, with no
+    file to open or close.
+
+    Deleted assets stay in their segment until the reaper rewrites it (see
+    `reaper.reap`). `connect` is called for a connection to look assets up
+    with, eg. `pool.acquire`. Where assets are is remembered, so only the
+    first read in each worker needs the database. Workers are told when an
+    asset is purged or a segment is rewritten (see `sham.__main__`), and
+    call `discard` or `discard_segment` so they don't keep serving them.
+    """
+
+    def __init__(
+        self,
+        asset_dir,
+        connect: Callable[[], AsyncContextManager],
+        max_asset_size: int = 64 * 1024,
+        segment_size: int = SEGMENT_SIZE,
+    ):
+        self.asset_dir = asset_dir
+        self.connect = connect
+        # 0 packs nothing new, but what's already packed can still be read
+        self.max_asset_size = max_asset_size
+        self._writer = SegmentWriter(asset_dir, segment_size)
+        # Least recently used first. Mappings that fall off the end are
+        # unmapped once nothing is reading from them.
+        self._maps: OrderedDict[int, mmap.mmap] = OrderedDict()
+        # (segment_id, start, length) by asset id, least recently used first.
+        # These stay good when the reaper moves an asset until its old segment
+        # is discarded, then the asset is looked up again.
+        self._locations: OrderedDict[int, Tuple[int, int, int]] = OrderedDict()
+
+    def fits(self, size: int) -> bool:
+        return size <= self.max_asset_size
+
+    async def close(self):
+        async with self.connect() as conn:
+            await self._writer.close(conn)
+
+    async def append(self, conn, assets: Sequence[Tuple[int, bytes]]):
+        """
+        Pack (asset_id, contents) pairs, and record where they went.
+        """
+        locations = await self._writer.append(conn, [data for _, data in assets])
+        await conn.execute(
+            """
+            INSERT INTO pack_entry (asset_id, segment_id, start, length)
+            SELECT * FROM unnest($1::int[], $2::int[], $3::bigint[], $4::int[])
+            """,
+            [asset_id for asset_id, _ in assets],
+            [segment_id for segment_id, _ in locations],
+            [start for _, start in locations],
+            [len(data) for _, data in assets],
+        )
+        for (asset_id, data), (segment_id, start) in zip(assets, locations):
+            self._remember(asset_id, (segment_id, start, len(data)))
+
+    def open_known(self, asset_id: int) -> Optional[PackedAsset]:
+        """
+        A packed asset if this worker knows where it is, without asking the
+        database.
+        """
+        location = self._locations.get(asset_id)
+        if location is None:
+            return None
+
+        segment_id, start, length = location
+        if not length:
+            return PackedAsset(b"", 0, 0)
+
+        try:
+            buffer = self._map(segment_id, start + length)
+        except FileNotFoundError:
+            del self._locations[asset_id]
+            return None
+
+        self._locations.move_to_end(asset_id)
+        return PackedAsset(buffer, start, length)
+
+    def discard(self, asset_id: int):
+        self._locations.pop(asset_id, None)
+
+    def discard_segment(self, segment_id: int):
+        self._maps.pop(segment_id, None)
+        for asset_id in [
+            asset_id
+            for asset_id, (location_segment_id, _, _) in self._locations.items()
+            if location_segment_id == segment_id
+        ]:
+            del self._locations[asset_id]
+
+    def clear(self):
+        self._locations.clear()
+        self._maps.clear()
+
+    async def open(self, asset_id: int) -> Optional[PackedAsset]:
+        """
+        A packed asset, or None if it isn't packed (or was deleted and
+        reaped).
+        """
+        if f := self.open_known(asset_id):
+            return f
+
+        # The reaper may move the asset to another segment between looking it
+        # up and mapping its segment, in which case the second look finds it
+        for attempt in range(2):
+            async with self.connect() as conn:
+                row = await conn.fetchrow(
+                    """
+                    SELECT segment_id, start, length FROM pack_entry
+                    JOIN asset ON asset.id = asset_id
+                    WHERE asset_id = $1 AND NOT purged
+                    """,
+                    asset_id,
+                )
+            if row is None:
+                return None
+
+            self._remember(asset_id, (row["segment_id"], row["start"], row["length"]))
+            if f := self.open_known(asset_id):
+                return f
+            if attempt:
+                raise FileNotFoundError(
+                    segment_path_from_dir_and_id(self.asset_dir, row["segment_id"])
+                )
+
+    async def read(self, asset_id: int) -> Optional[bytes]:
+        f = await self.open(asset_id)
+        if f is None:
+            return None
+
+        try:
+            return await f.read()
+        finally:
+            await f.close()
+
+    def _remember(self, asset_id: int, location: Tuple[int, int, int]):
+        self._locations[asset_id] = location
+        self._locations.move_to_end(asset_id)
+        while len(self._locations) > MAX_KNOWN_LOCATIONS:
+            self._locations.popitem(last=False)
+
+    def _map(self, segment_id: int, end: int) -> mmap.mmap:
+        buffer = self._maps.get(segment_id)
+        # A segment that's still being written to may have grown since it was
+        # mapped. Opening and mapping happens once per segment, so it's done
+        # right here rather than in a thread.
+        if buffer is None or len(buffer) < end:
+            with open(segment_path_from_dir_and_id(self.asset_dir, segment_id), "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment_id] = buffer
+
+        self._maps.move_to_end(segment_id)
+        while len(self._maps) > MAX_MAPPED_SEGMENTS:
+            self._maps.popitem(last=False)
+
+        return buffer
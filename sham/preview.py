@@ -0,0 +1,198 @@
+import asyncio
+import io
+import logging
+import mimetypes
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import app
+
+# Pillow is optional, without it there are no previews
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Previews fit in a square this many pixels on a side
+PREVIEW_SIZE = 256
+PREVIEW_CONTENT_TYPE = "image/webp"
+
+# The image types worth making previews of
+PREVIEW_SOURCE_TYPES = {
+    "image/bmp",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/tiff",
+    "image/webp",
+}
+
+
+def previews_available() -> bool:
+    return Image is not None
+
+
+def wants_preview(name: str) -> bool:
+    return mimetypes.guess_type(name)[0] in PREVIEW_SOURCE_TYPES
+
+
+# Previews sit next to their asset, `asset_dir/shards/d2/04/1234.preview.webp`
+def preview_path_from_dir_and_id(asset_dir, asset_id) -> Path:
+    path = app.asset_path_from_dir_and_id(asset_dir, asset_id)
+    return path.with_name(f"{path.name}.preview.webp")
+
+
+def render_preview(source: List[str] | bytes, dest_path: str, size: int):
+    """
+    Write a preview of the first of the paths in `source` that exists, or of
+    the image in `source` if it's a packed asset's bytes (see
+    `app.asset_source`). This runs in a worker process.
+    """
+    if isinstance(source, bytes):
+        source_file = io.BytesIO(source)
+    else:
+        for source_file in source:
+            if os.path.exists(source_file):
+                break
+        else:
+            raise app.AssetNotFound(source[0])
+
+    with Image.open(source_file) as image:
+        # JPEGs can be decoded at a fraction of their size, which is much
+        # faster than decoding everything and throwing most of it away
+        image.draft(None, (size, size))
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "RGBA"):
+            transparent = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if transparent else "RGB")
+
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        try:
+            image.save(tmp_path, "WEBP", quality=80)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class PreviewRenderer:
+    """
+    Makes previews of uploaded images in a pool of processes, so resizing
+    never holds up the event loop.
+
+    Uploads queue a preview with `submit`. If the queue is full the preview
+    is skipped, and made when it's first asked for with `get` instead.
+    """
+
+    def __init__(
+        self,
+        asset_dir,
+        workers: int = 2,
+        size: int = PREVIEW_SIZE,
+        max_queued: int = 1000,
+        packs=None,
+    ):
+        self.asset_dir = asset_dir
+        # Where packed assets are read from, see `packfile.PackStore`
+        self.packs = packs
+        self.workers = workers
+        self.size = size
+        self._queue = asyncio.Queue(max_queued)
+        # Previews waiting or being made, by asset id
+        self._jobs: Dict[int, asyncio.Future] = {}
+        self._tasks = []
+        self._executor = None
+
+    def start(self):
+        if multiprocessing.current_process().daemon:
+            # Sanic's worker processes (with --workers) are daemons, which
+            # aren't allowed processes of their own. Pillow lets go of the GIL
+            # while decoding and resizing, so threads still keep the event
+            # loop free.
+            self._executor = ThreadPoolExecutor(self.workers)
+        else:
+            # Workers are spawned rather than forked, so they don't inherit
+            # the server's event loop and connections
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        if self._executor:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self._executor.shutdown(cancel_futures=True)
+            )
+
+    def submit(self, asset_id: int, name: str) -> Optional[asyncio.Future]:
+        """
+        Queue a preview of an asset, if it's an image. The future resolves to
+        whether the preview was made.
+        """
+        if not wants_preview(name):
+            return None
+
+        if job := self._jobs.get(asset_id):
+            return job
+
+        job = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((asset_id, job))
+        except asyncio.QueueFull:
+            logger.warning("Preview queue is full, skipping asset %s", asset_id)
+            return None
+
+        self._jobs[asset_id] = job
+        return job
+
+    async def get(self, asset_id: int, name: str) -> Optional[Path]:
+        """
+        The path of an asset's preview, making it first if needed. None if the
+        asset isn't an image (or isn't one Pillow can read).
+        """
+        path = preview_path_from_dir_and_id(self.asset_dir, asset_id)
+        if path.exists():
+            return path
+
+        if not wants_preview(name):
+            return None
+
+        if job := self.submit(asset_id, name):
+            made = await asyncio.shield(job)
+        else:
+            made = await self._render(asset_id)
+
+        return path if made else None
+
+    async def _work(self):
+        while True:
+            asset_id, job = await self._queue.get()
+            try:
+                job.set_result(await self._render(asset_id))
+            finally:
+                del self._jobs[asset_id]
+                if not job.done():
+                    job.cancel()
+
+    async def _render(self, asset_id: int) -> bool:
+        dest_path = str(preview_path_from_dir_and_id(self.asset_dir, asset_id))
+        try:
+            source = await app.asset_source(self.asset_dir, asset_id, self.packs)
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, render_preview, source, dest_path, self.size
+            )
+        except Exception:
+            logger.exception("Couldn't make a preview of asset %s", asset_id)
+            return False
+
+        return True
@@ -0,0 +1,431 @@
+import asyncio
+import dataclasses
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import List, Optional
+
+import aiofiles.os
+
+from . import app
+from . import compression
+from . import metrics
+from . import packfile
+from . import preview
+
+logger = logging.getLogger(__name__)
+
+# Only one reaper runs at a time, however many workers there are
+REAPER_LOCK_ID = 0x5348414D + 2
+
+REAPED = metrics.Counter(
+    "sham_reaper_reaped_total",
+    "Things removed by the reaper: deleted assets' files, unfinished uploads, "
+    "unused blobs, tmp files and rewritten pack segments",
+    ["kind"],
+)
+REAPED_BYTES = metrics.Counter(
+    "sham_reaper_freed_bytes_total", "Disk space freed by the reaper"
+)
+REAPER_RUNS = metrics.Counter("sham_reaper_runs_total", "Reaper passes run")
+
+
+@dataclass
+class ReapResult:
+    # Deleted assets whose files were removed
+    assets: int = 0
+    # Assets from uploads that never finished, removed entirely
+    orphans: int = 0
+    # Content addressed blobs no asset uses any more
+    blobs: int = 0
+    # Abandoned uploads in `asset_dir/tmp`
+    tmp_files: int = 0
+    # Segments of packed assets rewritten without their deleted assets
+    pack_segments: int = 0
+    freed_bytes: int = 0
+    # With a dry run, these are what would have been removed
+    dry_run: bool = False
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+
+async def reap(
+    conn,
+    asset_dir,
+    grace_period: timedelta,
+    batch_size: int = 1000,
+    batch_delay: float = 0.1,
+    dry_run: bool = False,
+) -> Optional[ReapResult]:
+    """
+    Remove what deleted assets and failed uploads leave behind, once it's older
+    than `grace_period`:
+    - Files of deleted assets. Their rows stay (marked purged) so their ids
+      are never reused.
+    - Rows of uploads that never finished, and any file they got to write.
+    - Content addressed blobs that no asset links to.
+    - Files in `asset_dir/tmp`.
+    - Deleted assets packed in segments, by copying what's still in use to a
+      new segment (see `packfile.PackStore`).
+
+    Work is done `batch_size` at a time with a pause between batches, so a
+    big backlog doesn't starve the server. Returns None, without doing
+    anything, if another reaper is already running.
+    """
+    if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", REAPER_LOCK_ID):
+        return None
+
+    try:
+        REAPER_RUNS.inc()
+        result = ReapResult(dry_run=dry_run)
+        asset_dir = Path(asset_dir)
+        batching = (batch_size, batch_delay, result)
+        await _reap_deleted_assets(conn, asset_dir, grace_period, *batching)
+        await _reap_orphans(conn, asset_dir, grace_period, *batching)
+        await _reap_blobs(conn, asset_dir, *batching)
+        await _reap_tmp_files(asset_dir, grace_period, *batching)
+        await _compact_packs(conn, asset_dir, grace_period, *batching)
+        return result
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", REAPER_LOCK_ID)
+
+
+async def _reap_deleted_assets(
+    conn, asset_dir, grace_period, batch_size, batch_delay, result
+):
+    after_id = 0
+    while rows := await conn.fetch(
+        """
+        SELECT id FROM asset
+        WHERE deleted AND NOT purged AND deleted_at < now() - $1::interval AND id > $2
+        ORDER BY id
+        LIMIT $3
+        """,
+        grace_period,
+        after_id,
+        batch_size,
+    ):
+        asset_ids = [row["id"] for row in rows]
+        # Files go first. If we stop part way, the next pass finds these again.
+        await _remove_asset_files(asset_dir, asset_ids, result)
+
+        if not result.dry_run:
+            async with conn.transaction():
+                await _release_blobs(conn, asset_ids)
+                await conn.execute(
+                    """
+                    UPDATE asset SET purged = true, blob_sha256 = NULL
+                    WHERE id = ANY($1::int[])
+                    """,
+                    asset_ids,
+                )
+                await conn.execute(
+                    "DELETE FROM asset_tag WHERE asset_id = ANY($1::int[])", asset_ids
+                )
+
+        result.assets += len(asset_ids)
+        _count(result, "asset", len(asset_ids))
+        after_id = asset_ids[-1]
+        await asyncio.sleep(batch_delay)
+
+
+async def _reap_orphans(
+    conn, asset_dir, grace_period, batch_size, batch_delay, result
+):
+    after_id = 0
+    while rows := await conn.fetch(
+        """
+        SELECT id FROM asset
+        WHERE deleted AND deleted_at IS NULL AND NOT purged
+        AND created_at < now() - $1::interval AND id > $2
+        AND NOT EXISTS (SELECT FROM tag WHERE linked_asset_id = asset.id)
+        ORDER BY id
+        LIMIT $3
+        """,
+        grace_period,
+        after_id,
+        batch_size,
+    ):
+        asset_ids = [row["id"] for row in rows]
+        # The upload may have got as far as moving its file into place
+        await _remove_asset_files(asset_dir, asset_ids, result)
+
+        if not result.dry_run:
+            async with conn.transaction():
+                await _release_blobs(conn, asset_ids)
+                await conn.execute(
+                    "DELETE FROM asset_tag WHERE asset_id = ANY($1::int[])", asset_ids
+                )
+                await conn.execute(
+                    "DELETE FROM asset WHERE id = ANY($1::int[])", asset_ids
+                )
+
+        result.orphans += len(asset_ids)
+        _count(result, "orphan", len(asset_ids))
+        after_id = asset_ids[-1]
+        await asyncio.sleep(batch_delay)
+
+
+async def _release_blobs(conn, asset_ids: List[int]):
+    await conn.execute(
+        """
+        UPDATE blob SET refcount = blob.refcount - released.count
+        FROM (
+            SELECT blob_sha256, count(*) AS count FROM asset
+            WHERE id = ANY($1::int[]) AND blob_sha256 IS NOT NULL
+            GROUP BY blob_sha256
+        ) AS released
+        WHERE blob.sha256 = released.blob_sha256
+        """,
+        asset_ids,
+    )
+
+
+async def _reap_blobs(conn, asset_dir, batch_size, batch_delay, result):
+    # Files are removed while the deleted rows are still locked, so an upload
+    # of the same contents either takes its reference first (and the blob is
+    # kept) or waits until the file is gone and writes it again (see
+    # `app._link_blob`)
+    after = ""
+    while rows := await conn.fetch(
+        """
+        SELECT sha256 FROM blob
+        WHERE refcount = 0 AND sha256 > $1
+        ORDER BY sha256
+        LIMIT $2
+        """,
+        after,
+        batch_size,
+    ):
+        sha256s = [row["sha256"] for row in rows]
+        async with conn.transaction():
+            if not result.dry_run:
+                rows = await conn.fetch(
+                    """
+                    DELETE FROM blob
+                    WHERE sha256 = ANY($1::text[]) AND refcount = 0
+                    AND NOT EXISTS (SELECT FROM asset WHERE blob_sha256 = blob.sha256)
+                    RETURNING sha256
+                    """,
+                    sha256s,
+                )
+
+            for row in rows:
+                for path in [
+                    app.blob_path_from_dir_and_sha256(asset_dir, row["sha256"]),
+                    app.flat_blob_path_from_dir_and_sha256(asset_dir, row["sha256"]),
+                ]:
+                    await _remove(path, result)
+
+        result.blobs += len(rows)
+        _count(result, "blob", len(rows))
+        after = sha256s[-1]
+        await asyncio.sleep(batch_delay)
+
+
+async def _reap_tmp_files(asset_dir, grace_period, batch_size, batch_delay, result):
+    cutoff = time.time() - grace_period.total_seconds()
+    stale = await asyncio.get_running_loop().run_in_executor(
+        None, _stale_files, asset_dir / "tmp", cutoff
+    )
+
+    for batch in app._batched(stale, batch_size):
+        for path in batch:
+            await _remove(path, result)
+        result.tmp_files += len(batch)
+        _count(result, "tmp_file", len(batch))
+        await asyncio.sleep(batch_delay)
+
+
+def _stale_files(path: Path, cutoff: float) -> List[Path]:
+    try:
+        with os.scandir(path) as entries:
+            return [
+                Path(entry.path)
+                for entry in entries
+                if entry.is_file() and entry.stat().st_mtime < cutoff
+            ]
+    except FileNotFoundError:
+        return []
+
+
+async def _compact_packs(conn, asset_dir, grace_period, batch_size, batch_delay, result):
+    # Writers only append to a segment for SEGMENT_MAX_AGE after starting it,
+    # so an unsealed segment older than that was left by a worker that stopped
+    abandoned = max(grace_period, timedelta(seconds=2 * packfile.SEGMENT_MAX_AGE))
+    rows = await conn.fetch(
+        """
+        SELECT pack_segment.id, COALESCE(sum(length) FILTER (WHERE NOT purged), 0) AS live
+        FROM pack_segment
+        LEFT JOIN pack_entry ON segment_id = pack_segment.id
+        LEFT JOIN asset ON asset.id = asset_id
+        WHERE sealed OR pack_segment.created_at < now() - $1::interval
+        GROUP BY pack_segment.id
+        ORDER BY pack_segment.id
+        """,
+        abandoned,
+    )
+
+    writer = packfile.SegmentWriter(asset_dir)
+    try:
+        for row in rows:
+            path = packfile.segment_path_from_dir_and_id(asset_dir, row["id"])
+            try:
+                size = (await aiofiles.os.stat(path)).st_size
+            except FileNotFoundError:
+                size = 0
+
+            live = row["live"]
+            if live and live >= size * packfile.COMPACT_RATIO:
+                continue
+
+            if not result.dry_run:
+                await _compact_segment(
+                    conn, writer, path, row["id"], batch_size, batch_delay
+                )
+                REAPED_BYTES.inc(size - live)
+
+            result.pack_segments += 1
+            result.freed_bytes += size - live
+            _count(result, "pack_segment", 1)
+            await asyncio.sleep(batch_delay)
+    finally:
+        if not result.dry_run:
+            await writer.close(conn)
+
+
+async def _compact_segment(conn, writer, path, segment_id, batch_size, batch_delay):
+    # Entries are copied a batch at a time. Until the segment is gone, readers
+    # find each asset in either place.
+    while rows := await conn.fetch(
+        """
+        SELECT asset_id, start, length FROM pack_entry
+        JOIN asset ON asset.id = asset_id
+        WHERE segment_id = $1 AND NOT purged
+        ORDER BY start
+        LIMIT $2
+        """,
+        segment_id,
+        batch_size,
+    ):
+        contents = await asyncio.get_running_loop().run_in_executor(
+            None,
+            packfile.read_entries,
+            path,
+            [(row["start"], row["length"]) for row in rows],
+        )
+        locations = await writer.append(conn, contents)
+        await conn.execute(
+            """
+            UPDATE pack_entry SET segment_id = moved.segment_id, start = moved.start
+            FROM unnest($1::int[], $2::int[], $3::bigint[])
+                AS moved (asset_id, segment_id, start)
+            WHERE pack_entry.asset_id = moved.asset_id
+            """,
+            [row["asset_id"] for row in rows],
+            [segment_id for segment_id, _ in locations],
+            [start for _, start in locations],
+        )
+        await asyncio.sleep(batch_delay)
+
+    # Only purged assets are left
+    async with conn.transaction():
+        await conn.execute("DELETE FROM pack_entry WHERE segment_id = $1", segment_id)
+        await conn.execute("DELETE FROM pack_segment WHERE id = $1", segment_id)
+
+    # Workers that have it mapped can keep reading it until they let go
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _remove_asset_files(asset_dir, asset_ids: List[int], result: ReapResult):
+    for asset_id in asset_ids:
+        for path in [
+            app.asset_path_from_dir_and_id(asset_dir, asset_id),
+            app.flat_asset_path_from_dir_and_id(asset_dir, asset_id),
+            preview.preview_path_from_dir_and_id(asset_dir, asset_id),
+            *compression.variant_paths_from_dir_and_id(asset_dir, asset_id),
+        ]:
+            await _remove(path, result)
+
+
+async def _remove(path: Path, result: ReapResult):
+    try:
+        stat = await aiofiles.os.stat(path)
+        if not result.dry_run:
+            await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        return
+
+    # Removing one of several hard links (content addressed assets) doesn't
+    # free anything
+    if stat.st_nlink == 1:
+        result.freed_bytes += stat.st_size
+        if not result.dry_run:
+            REAPED_BYTES.inc(stat.st_size)
+
+
+def _count(result: ReapResult, kind: str, n: int):
+    # Dry runs don't count towards the metrics
+    if not result.dry_run:
+        REAPED.labels(kind).inc(n)
+
+
+class Reaper:
+    """
+    Runs `reap` every `interval` seconds in the background.
+    """
+
+    def __init__(
+        self,
+        pool,
+        asset_dir,
+        interval: float,
+        grace_period: timedelta,
+        batch_size: int = 1000,
+        batch_delay: float = 0.1,
+        dry_run: bool = False,
+    ):
+        self.pool = pool
+        self.asset_dir = asset_dir
+        self.interval = interval
+        self.grace_period = grace_period
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.dry_run = dry_run
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                async with self.pool.acquire() as conn:
+                    result = await reap(
+                        conn,
+                        self.asset_dir,
+                        self.grace_period,
+                        self.batch_size,
+                        self.batch_delay,
+                        self.dry_run,
+                    )
+                if result:
+                    logger.info("Reaper finished: %s", result.to_dict())
+            except Exception:
+                logger.exception("Reaper failed, trying again next time")
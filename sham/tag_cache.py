@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from .app import TagResult
+from .db import Listener
+from .tag_suggest import TagSuggestions
+
+logger = logging.getLogger(__name__)
+
+TAG_CHANNEL = "sham_tag"
+
+
+class TagCache:
+    """
+    Every tag, held in memory so looking tags up and listing them doesn't need
+    the database.
+
+    Each worker has its own cache, kept up to date through the notifications
+    that the tag table's trigger sends on `TAG_CHANNEL`. Workers hear about
+    changes at slightly different times, but ones holding the same tags
+    agree on `etag`.
+    """
+
+    def __init__(self):
+        self.by_id: Dict[int, TagResult] = {}
+        self.by_key_value: Dict[Tuple[str, str, Optional[int]], TagResult] = {}
+        # Tags by prefix, for `GET /tags/suggest`
+        self.suggestions = TagSuggestions()
+        self._listener = None
+        self._pending: Optional[List[dict]] = None
+        self._serialized: Dict[str, bytes] = {}
+        self._etag: Optional[str] = None
+        self._reload_task: Optional[asyncio.Task] = None
+
+    async def start(self, pool, db_url):
+        """
+        Load the cache and start following changes to it.
+        """
+        self._pool = pool
+        self._listener = Listener(
+            db_url, {TAG_CHANNEL: self._on_notification}, self.reload
+        )
+        await self._listener.start()
+
+    async def close(self):
+        if self._listener:
+            await self._listener.close()
+
+    async def reload(self):
+        # Changes may arrive while we're loading. They're all applied
+        # afterwards, in order. Each has the whole tag, so one the snapshot
+        # already includes is either a no-op or followed by a newer one.
+        self._pending = []
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch("SELECT id, key, value, linked_asset_id FROM tag")
+
+            self.by_id = {}
+            self.by_key_value = {}
+            self.suggestions = TagSuggestions()
+            for row in rows:
+                self._put(
+                    TagResult(
+                        tag_id=row["id"],
+                        key=row["key"],
+                        value=row["value"],
+                        linked_asset_id=row["linked_asset_id"],
+                    )
+                )
+            pending = self._pending
+        finally:
+            self._pending = None
+
+        for change in pending:
+            self._apply(change)
+
+    def get(self, tag_id: int) -> Optional[TagResult]:
+        return self.by_id.get(tag_id)
+
+    def find(
+        self, key: str, value: str, linked_asset_id: Optional[int]
+    ) -> Optional[TagResult]:
+        return self.by_key_value.get((key, value, linked_asset_id))
+
+    def etag(self, dumps) -> str:
+        """
+        A hash of the tags as they are now, serialized with `dumps`. It's kept
+        until the tags change.
+        """
+        if self._etag is None:
+            digest = hashlib.blake2b(self.serialized(dumps, "json"), digest_size=8)
+            self._etag = f"tags-{digest.hexdigest()}"
+        return self._etag
+
+    def put(self, tag: TagResult):
+        """
+        Add a tag we've just created, so this worker sees it even before the
+        notification arrives.
+        """
+        self._put(tag)
+
+    def serialized(self, dumps, format: str) -> bytes:
+        """
+        All tags by id, serialized with `dumps`, either as a JSON array
+        (`"json"`) or as newline delimited JSON (`"ndjson"`). The result is
+        kept until the tags change.
+        """
+        if format in self._serialized:
+            return self._serialized[format]
+
+        tags = [self.by_id[tag_id].to_dict() for tag_id in sorted(self.by_id)]
+        if format == "ndjson":
+            body = "".join(dumps(tag) + "\n" for tag in tags).encode()
+        else:
+            body = dumps(tags).encode()
+
+        self._serialized[format] = body
+        return body
+
+    def _put(self, tag: TagResult):
+        if old := self.by_id.get(tag.tag_id):
+            del self.by_key_value[(old.key, old.value, old.linked_asset_id)]
+        self.by_id[tag.tag_id] = tag
+        self.by_key_value[(tag.key, tag.value, tag.linked_asset_id)] = tag
+        self.suggestions.add(tag)
+        self._serialized.clear()
+        self._etag = None
+
+    def _remove(self, tag_id: int):
+        if old := self.by_id.pop(tag_id, None):
+            del self.by_key_value[(old.key, old.value, old.linked_asset_id)]
+        self.suggestions.remove(tag_id)
+        self._serialized.clear()
+        self._etag = None
+
+    def _on_notification(self, payload: str):
+        change = json.loads(payload)
+        if self._pending is not None:
+            self._pending.append(change)
+        else:
+            self._apply(change)
+
+    def _apply(self, change: dict):
+        match change["op"]:
+            case "INSERT" | "UPDATE":
+                self._put(
+                    TagResult(
+                        tag_id=change["id"],
+                        key=change["key"],
+                        value=change["value"],
+                        linked_asset_id=change["linked_asset_id"],
+                    )
+                )
+            case "DELETE":
+                self._remove(change["id"])
+            case "RELOAD":
+                self._reload_task = asyncio.create_task(self.reload())
+                self._reload_task.add_done_callback(_log_reload_failure)
+
+
+def _log_reload_failure(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()):
+        logger.error("Couldn't reload the tag cache", exc_info=e)
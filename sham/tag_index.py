@@ -0,0 +1,299 @@
+import asyncio
+import functools
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set
+
+from .db import Listener
+
+logger = logging.getLogger(__name__)
+
+ASSET_TAG_CHANNEL = "sham_asset_tag"
+ASSET_CHANNEL = "sham_asset"
+TAG_CLOSURE_CHANNEL = "sham_tag_closure"
+
+# Bitmaps are split into chunks of this many bits
+CHUNK_BITS = 4096
+
+# Seconds before trying again when reading tag implications fails
+CLOSURE_RETRY_DELAY = 1.0
+
+
+class Bitmap:
+    """
+    A set of non-negative ints, stored as bits.
+
+    The bits are split into chunks of `CHUNK_BITS`, each one a Python int, and
+    only chunks with something in them are kept. Sparse sets stay small and
+    set operations run a whole chunk at a time.
+    """
+
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks: Optional[Dict[int, int]] = None):
+        self.chunks = chunks if chunks is not None else {}
+
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "Bitmap":
+        bitmap = cls()
+        for i in ids:
+            bitmap.add(i)
+        return bitmap
+
+    def add(self, i: int):
+        key, bit = divmod(i, CHUNK_BITS)
+        self.chunks[key] = self.chunks.get(key, 0) | (1 << bit)
+
+    def discard(self, i: int):
+        key, bit = divmod(i, CHUNK_BITS)
+        if chunk := self.chunks.get(key):
+            chunk &= ~(1 << bit)
+            if chunk:
+                self.chunks[key] = chunk
+            else:
+                del self.chunks[key]
+
+    def __contains__(self, i: int) -> bool:
+        key, bit = divmod(i, CHUNK_BITS)
+        return bool(self.chunks.get(key, 0) >> bit & 1)
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        small, large = sorted([self.chunks, other.chunks], key=len)
+        return Bitmap(
+            {key: chunk for key, c in small.items() if (chunk := c & large.get(key, 0))}
+        )
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        chunks = dict(self.chunks)
+        for key, chunk in other.chunks.items():
+            chunks[key] = chunks.get(key, 0) | chunk
+        return Bitmap(chunks)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        return Bitmap(
+            {
+                key: chunk
+                for key, c in self.chunks.items()
+                if (chunk := c & ~other.chunks.get(key, 0))
+            }
+        )
+
+    def __len__(self) -> int:
+        return sum(chunk.bit_count() for chunk in self.chunks.values())
+
+    def __iter__(self) -> Iterator[int]:
+        return self.after(-1)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitmap) and self.chunks == other.chunks
+
+    def __repr__(self) -> str:
+        return f"Bitmap({list(self)})"
+
+    def after(self, after_id: int) -> Iterator[int]:
+        """
+        The ints in the set greater than `after_id`, in order.
+        """
+        first_key, first_bit = divmod(after_id + 1, CHUNK_BITS)
+        for key in sorted(self.chunks):
+            if key < first_key:
+                continue
+
+            chunk = self.chunks[key]
+            if key == first_key:
+                chunk &= ~((1 << first_bit) - 1)
+
+            base = key * CHUNK_BITS
+            while chunk:
+                lowest = chunk & -chunk
+                yield base + lowest.bit_length() - 1
+                chunk ^= lowest
+
+
+class TagIndex:
+    """
+    Which (non-deleted) assets have each tag, as bitmaps, so tag searches are
+    set operations in memory instead of joins over asset_tag.
+
+    Like `tag_cache.TagCache`, each worker has its own index, loaded at
+    startup and kept up to date from notifications sent by triggers. Changes
+    made by other workers show up a moment after they're committed.
+    """
+
+    def __init__(self):
+        self.assets_by_tag: Dict[int, Bitmap] = {}
+        self.live_assets = Bitmap()
+        # The tags that imply each tag, see `db.SCHEMA_UPDATES` for tag_closure
+        self.implied_by: Dict[int, Set[int]] = {}
+        self._listener = None
+        self._pending: Optional[List[tuple]] = None
+        self._closure_task = None
+        self._closure_stale = False
+
+    async def start(self, pool, db_url):
+        self._pool = pool
+        self._listener = Listener(
+            db_url,
+            {
+                ASSET_TAG_CHANNEL: functools.partial(self._on_notification, ASSET_TAG_CHANNEL),
+                ASSET_CHANNEL: functools.partial(self._on_notification, ASSET_CHANNEL),
+                TAG_CLOSURE_CHANNEL: functools.partial(
+                    self._on_notification, TAG_CLOSURE_CHANNEL
+                ),
+            },
+            self.reload,
+        )
+        await self._listener.start()
+
+    async def close(self):
+        if self._listener:
+            await self._listener.close()
+        if self._closure_task:
+            self._closure_task.cancel()
+            try:
+                await self._closure_task
+            except asyncio.CancelledError:
+                pass
+
+    async def reload(self):
+        # Changes that arrive while loading are replayed afterwards, in order.
+        # They're all "this is now in/out of the set", so replaying one the
+        # snapshot already has does no harm.
+        self._pending = []
+        try:
+            assets_by_tag = {}
+            async with self._pool.acquire() as conn:
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    live_assets = Bitmap()
+                    async for row in conn.cursor(
+                        "SELECT id FROM asset WHERE NOT deleted", prefetch=10000
+                    ):
+                        live_assets.add(row["id"])
+
+                    async for row in conn.cursor(
+                        "SELECT asset_id, tag_id FROM asset_tag", prefetch=10000
+                    ):
+                        if (bitmap := assets_by_tag.get(row["tag_id"])) is None:
+                            bitmap = assets_by_tag[row["tag_id"]] = Bitmap()
+                        bitmap.add(row["asset_id"])
+
+                    implied_by = await _fetch_implied_by(conn)
+
+            self.assets_by_tag = assets_by_tag
+            self.live_assets = live_assets
+            self.implied_by = implied_by
+            pending = self._pending
+        finally:
+            self._pending = None
+
+        for channel, payload in pending:
+            self._apply(channel, payload)
+
+    def matching(
+        self, tag_ids: List[int], exclude_tag_ids: Sequence[int] = ()
+    ) -> Bitmap:
+        """
+        The live assets that have every tag in `tag_ids` and none in
+        `exclude_tag_ids`, counting implied tags.
+        """
+        result = self.live_assets
+        for bitmap in sorted(map(self._with_implied, tag_ids), key=lambda b: len(b.chunks)):
+            result = result & bitmap
+
+        for tag_id in exclude_tag_ids:
+            result = result - self._with_implied(tag_id)
+
+        return result
+
+    def search(
+        self,
+        tag_ids: List[int],
+        exclude_tag_ids: Sequence[int] = (),
+        after_id: Optional[int] = None,
+        limit: int = 100,
+    ) -> List[int]:
+        ids = self.matching(tag_ids, exclude_tag_ids).after(
+            -1 if after_id is None else after_id
+        )
+        return [asset_id for asset_id, _ in zip(ids, range(limit))]
+
+    def count(self, tag_ids: List[int], exclude_tag_ids: Sequence[int] = ()) -> int:
+        return len(self.matching(tag_ids, exclude_tag_ids))
+
+    def facet_counts(self, matching: Bitmap, tag_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        How many of the `matching` assets have each of `tag_ids`, counting
+        implied tags. Tags none of them have are left out.
+        """
+        counts = {}
+        for tag_id in tag_ids:
+            if count := len(matching & self._with_implied(tag_id)):
+                counts[tag_id] = count
+        return counts
+
+    def _with_implied(self, tag_id: int) -> Bitmap:
+        # An asset has a tag if it has the tag itself, or any tag implying it
+        bitmaps = [
+            self.assets_by_tag.get(tag, Bitmap())
+            for tag in [tag_id, *self.implied_by.get(tag_id, ())]
+        ]
+        return functools.reduce(Bitmap.__or__, bitmaps)
+
+    def _on_notification(self, channel: str, payload: str):
+        if self._pending is not None:
+            self._pending.append((channel, payload))
+        else:
+            self._apply(channel, payload)
+
+    def _apply(self, channel: str, payload: str):
+        # "<sequence number> <op> <item> <item>...", see `notify_batched`
+        _seq, op, *items = payload.split(" ")
+
+        # (The channels are spelled out, a bare name here would match anything)
+        match channel, op:
+            case ("sham_asset_tag", "INSERT"):
+                for item in items:
+                    asset_id, tag_id = map(int, item.split(":"))
+                    if (bitmap := self.assets_by_tag.get(tag_id)) is None:
+                        bitmap = self.assets_by_tag[tag_id] = Bitmap()
+                    bitmap.add(asset_id)
+
+            case ("sham_asset_tag", "DELETE"):
+                for item in items:
+                    asset_id, tag_id = map(int, item.split(":"))
+                    if bitmap := self.assets_by_tag.get(tag_id):
+                        bitmap.discard(asset_id)
+
+            case ("sham_asset", "LIVE"):
+                for item in items:
+                    self.live_assets.add(int(item))
+
+            case ("sham_asset", "DELETED"):
+                for item in items:
+                    self.live_assets.discard(int(item))
+
+            case ("sham_tag_closure", _):
+                # Implications change rarely and the closure is small, just
+                # read it again
+                self._closure_stale = True
+                if self._closure_task is None or self._closure_task.done():
+                    self._closure_task = asyncio.create_task(self._reload_closure())
+
+    async def _reload_closure(self):
+        # One read at a time, so an older one can't finish last. Changes
+        # that arrive during a read make it go round again.
+        while self._closure_stale:
+            self._closure_stale = False
+            try:
+                async with self._pool.acquire() as conn:
+                    self.implied_by = await _fetch_implied_by(conn)
+            except Exception:
+                logger.exception("Couldn't read tag implications, trying again")
+                self._closure_stale = True
+                await asyncio.sleep(CLOSURE_RETRY_DELAY)
+
+
+async def _fetch_implied_by(conn) -> Dict[int, Set[int]]:
+    implied_by = {}
+    for row in await conn.fetch("SELECT implied_by, implies FROM tag_closure"):
+        implied_by.setdefault(row["implies"], set()).add(row["implied_by"])
+    return implied_by
@@ -0,0 +1,167 @@
+import asyncio
+import bisect
+import heapq
+import logging
+import re
+from typing import Dict, Iterable, List, Mapping, Tuple
+
+from .app import TagResult
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+# Short prefixes match a lot of tags and take a while to rank, but they're
+# also what everyone types first, so results are kept until something changes
+MAX_CACHED = 1024
+
+
+def _terms(tag: TagResult) -> set:
+    # A tag is found by a prefix of its key, its value, "key:value", or any
+    # word in them, so "battle" finds "Bob-omb Battlefield"
+    key = tag.key.lower()
+    value = tag.value.lower()
+    return {key, value, f"{key}:{value}", *_WORD.findall(key), *_WORD.findall(value)}
+
+
+class TagSuggestions:
+    """
+    Tags by prefix, for autocomplete. `tag_cache.TagCache` keeps one up to
+    date alongside the tags themselves.
+
+    Every term of every tag is kept in one sorted list, so the tags for a
+    prefix are the run of terms starting where the prefix would be inserted.
+    New tags are appended and the list is only sorted again when it's next
+    searched, which is cheap for a mostly sorted list.
+    """
+
+    def __init__(self, tags: Iterable[TagResult] = ()):
+        self._tags: Dict[int, TagResult] = {}
+        self._terms: List[Tuple[str, int]] = []
+        # Terms were added since the list was sorted
+        self._unsorted = False
+        # Tags were changed or removed, so some terms are out of date
+        self._stale = False
+        self._cache: Dict[Tuple[str, int], List[TagResult]] = {}
+        self._cache_usage = None
+        for tag in tags:
+            self.add(tag)
+
+    def add(self, tag: TagResult):
+        if (old := self._tags.get(tag.tag_id)) == tag:
+            return
+        if old:
+            self._stale = True
+
+        self._tags[tag.tag_id] = tag
+        self._terms.extend((term, tag.tag_id) for term in _terms(tag))
+        self._unsorted = True
+        self._cache.clear()
+
+    def remove(self, tag_id: int):
+        if self._tags.pop(tag_id, None):
+            self._stale = True
+            self._cache.clear()
+
+    def suggest(
+        self, prefix: str, limit: int = 10, usage: Mapping[int, int] = {}
+    ) -> List[TagResult]:
+        """
+        Up to `limit` tags with a term starting with `prefix` (ignoring case).
+        Tags whose key or value is exactly `prefix` come first, then the most
+        used (by `usage`, asset counts by tag id).
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        # `TagUsage` replaces its counts rather than changing them
+        if usage is not self._cache_usage:
+            self._cache.clear()
+            self._cache_usage = usage
+        if (cached := self._cache.get((prefix, limit))) is not None:
+            return cached
+
+        terms = self._sorted_terms()
+        tag_ids = set()
+        for i in range(bisect.bisect_left(terms, (prefix,)), len(terms)):
+            term, tag_id = terms[i]
+            if not term.startswith(prefix):
+                break
+            tag_ids.add(tag_id)
+
+        def rank(tag_id):
+            tag = self._tags[tag_id]
+            exact = prefix in (tag.key.lower(), tag.value.lower())
+            return (not exact, -usage.get(tag_id, 0), len(tag.value), tag.key, tag.value)
+
+        result = [self._tags[tag_id] for tag_id in heapq.nsmallest(limit, tag_ids, key=rank)]
+        if len(self._cache) >= MAX_CACHED:
+            self._cache.clear()
+        self._cache[prefix, limit] = result
+        return result
+
+    def _sorted_terms(self) -> List[Tuple[str, int]]:
+        if self._stale:
+            self._terms = [
+                (term, tag.tag_id) for tag in self._tags.values() for term in _terms(tag)
+            ]
+            self._stale = False
+            self._unsorted = True
+
+        if self._unsorted:
+            self._terms.sort()
+            self._unsorted = False
+
+        return self._terms
+
+
+class TagUsage:
+    """
+    How many assets each tag is on, for ranking suggestions. Counting is a
+    scan of asset_tag's (tag_id, asset_id) index, so the counts are refreshed
+    every `interval` seconds rather than kept exact, and only once something
+    asks for them.
+    """
+
+    def __init__(self, pool, interval: float = 60.0):
+        self._pool = pool
+        self.interval = interval
+        self.counts: Dict[int, int] = {}
+        self._task = None
+        self._counted = asyncio.Event()
+
+    async def start(self):
+        """
+        Start counting if nothing has yet, and wait for the first counts.
+        `GET /tags/suggest` calls this, so workers that never get a request
+        for suggestions never count.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        await self._counted.wait()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def refresh(self):
+        async with self._pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT tag_id, count(*) AS count FROM asset_tag GROUP BY tag_id"
+            )
+        self.counts = {row["tag_id"]: row["count"] for row in rows}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Couldn't count tag usage, trying again next time")
+            # Suggestions without counts are better than none at all
+            self._counted.set()
+            await asyncio.sleep(self.interval)
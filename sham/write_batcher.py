@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import AsyncContextManager, Awaitable, Callable, List, Tuple
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = metrics.Histogram(
+    "sham_write_batch_size",
+    "Writes committed together by the write batcher",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+
+class WriteBatcher:
+    """
+    Commits small writes (tagging an asset, creating a tag) that arrive close
+    together in one transaction, so a burst of them waits on one commit
+    instead of one each.
+
+    `submit(f, *args)` runs `f(conn, *args)` in the next batch and returns
+    its result. A batch is committed once it has `max_batch` writes, or
+    `max_delay` seconds after its first one arrived. Each write runs in its
+    own savepoint, so one failing doesn't undo the others: its caller gets
+    the exception and everyone else gets their result. Results are only
+    handed back once the batch has committed.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], AsyncContextManager],
+        max_batch: int = 100,
+        max_delay: float = 0.002,
+    ):
+        # Called for a connection for each batch, eg. `pool.acquire`
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending: List[Tuple[Callable[..., Awaitable], tuple, asyncio.Future]] = []
+        self._timer = None
+        self._commits = set()
+
+    async def submit(self, f: Callable[..., Awaitable], *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((f, args, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+
+        return await future
+
+    async def close(self):
+        """
+        Commit whatever's waiting, and wait for every batch to finish.
+        """
+        self._flush()
+        await asyncio.gather(*self._commits, return_exceptions=True)
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            commit = asyncio.create_task(self._commit(batch))
+            self._commits.add(commit)
+            commit.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch):
+        WRITE_BATCH_SIZE.observe(len(batch))
+        outcomes = []
+        try:
+            async with self.connect() as conn:
+                async with conn.transaction():
+                    for f, args, _ in batch:
+                        try:
+                            async with conn.transaction():
+                                outcomes.append((await f(conn, *args), None))
+                        except Exception as e:
+                            outcomes.append((None, e))
+        except Exception as e:
+            # Nothing was committed, everyone gets the error
+            logger.warning("Write batch of %s failed: %s", len(batch), e)
+            outcomes = [(None, e)] * len(batch)
+
+        for (_, _, future), (result, error) in zip(batch, outcomes):
+            # Callers that gave up (eg. the client went away) were cancelled
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,34 @@
+from sham.asset_cache import AssetCache
+
+
+def test_asset_cache_lru():
+    cache = AssetCache(max_bytes=10, max_entry_size=5)
+    cache.put(1, b"aaaa")
+    cache.put(2, b"bbbb")
+    assert cache.get(1) == b"aaaa"
+
+    # 2 is the least recently used, so it makes room for 3
+    cache.put(3, b"cccc")
+    assert cache.get(2) is None
+    assert cache.get(1) == b"aaaa"
+    assert cache.get(3) == b"cccc"
+    assert cache.size == 8
+
+    # Too big for one entry
+    cache.put(4, b"dddddd")
+    assert cache.get(4) is None
+
+    cache.discard(1)
+    cache.discard(1)
+    assert 1 not in cache and 3 in cache
+    assert cache.get(1) is None
+    assert cache.size == 4
+
+    assert cache.stats() == {
+        "entries": 1,
+        "bytes": 4,
+        "max_bytes": 10,
+        "hits": 3,
+        "misses": 3,
+        "evictions": 1,
+    }
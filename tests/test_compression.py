@@ -0,0 +1,39 @@
+import gzip
+import os
+import tempfile
+
+from sham import compression
+
+
+def test_negotiate():
+    encodings = ["zstd", "gzip"]
+    assert compression.negotiate(None, encodings) is None
+    assert compression.negotiate("identity", encodings) is None
+    assert compression.negotiate("gzip, deflate", encodings) == "gzip"
+    assert compression.negotiate("gzip, zstd", encodings) == "zstd"
+    assert compression.negotiate("gzip, zstd;q=0.5", encodings) == "gzip"
+    assert compression.negotiate("GZIP;q=0", encodings) is None
+    assert compression.negotiate("*", encodings) == "zstd"
+    assert compression.negotiate("*;q=0.1, zstd;q=0", encodings) == "gzip"
+
+
+def test_write_variants():
+    with tempfile.TemporaryDirectory() as d:
+        text = os.path.join(d, "text")
+        noise = os.path.join(d, "noise")
+        with open(text, "wb") as f:
+            f.write(b'{"level": 1}\n' * 1000)
+        with open(noise, "wb") as f:
+            f.write(os.urandom(10_000))
+
+        dest = {"gzip": os.path.join(d, "out.gz")}
+        assert compression.write_variants([text], dest, 1024, 1 << 20) == ["gzip"]
+        with gzip.open(dest["gzip"]) as f:
+            assert f.read() == b'{"level": 1}\n' * 1000
+
+        # Too small, too big, or not enough smaller
+        os.remove(dest["gzip"])
+        assert compression.write_variants([text], dest, 1 << 20, 1 << 30) == []
+        assert compression.write_variants([text], dest, 0, 1024) == []
+        assert compression.write_variants([noise], dest, 0, 1 << 20) == []
+        assert not os.path.exists(dest["gzip"])
@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+from sham import metrics
+
+
+def test_exposition():
+    counter = metrics.Counter("test_things_total", "Things", ["kind"])
+    counter.labels("a").inc()
+    counter.labels("a").inc(2)
+    counter.labels('say "hi"').inc()
+
+    histogram = metrics.Histogram("test_seconds", "Time", buckets=[0.1, 1])
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+
+    text = metrics.expose()
+    assert "# TYPE test_things_total counter\n" in text
+    assert 'test_things_total{kind="a"} 3.0\n' in text
+    assert 'test_things_total{kind="say \\"hi\\""} 1.0\n' in text
+
+    # Buckets are cumulative, and include values equal to their bound
+    assert "# TYPE test_seconds histogram\n" in text
+    assert 'test_seconds_bucket{le="0.1"} 2\n' in text
+    assert 'test_seconds_bucket{le="1"} 3\n' in text
+    assert 'test_seconds_bucket{le="+Inf"} 4\n' in text
+    assert "test_seconds_sum 5.65\n" in text
+    assert "test_seconds_count 4\n" in text
+
+
+def test_timed():
+    histogram = metrics.Histogram("test_timed_seconds", "Time", ["query"])
+
+    @metrics.timed(histogram)
+    async def query():
+        return 1
+
+    assert asyncio.run(query()) == 1
+    assert 'test_timed_seconds_count{query="test_timed.<locals>.query"} 1\n' in metrics.expose()
+
+
+def test_worker_metrics(tmp_path):
+    counter = metrics.Counter("test_worker_things_total", "Things")
+    counter.inc(2)
+
+    # Another worker's file, and one from a worker that's gone
+    other = {"test_worker_things_total": ['test_worker_things_total{worker="1"} 3.0']}
+    (tmp_path / "1.json").write_text(json.dumps(other))
+    gone = {"test_worker_things_total": ['test_worker_things_total{worker="999999999"} 4.0']}
+    (tmp_path / "999999999.json").write_text(json.dumps(gone))
+
+    async def scrape():
+        worker_metrics = metrics.WorkerMetrics(tmp_path)
+        text = await worker_metrics.expose()
+        await worker_metrics.close()
+        return worker_metrics.worker, text
+
+    worker, text = asyncio.run(scrape())
+    assert text.count("# TYPE test_worker_things_total counter\n") == 1
+    assert f'test_worker_things_total{{worker="{worker}"}} 2.0\n' in text
+    assert 'test_worker_things_total{worker="1"} 3.0\n' in text
+    assert "999999999" not in text
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["1.json"]
@@ -1,19 +1,27 @@
 import asyncio
+import asyncpg
+import hashlib
+import io
+import json
+import os
 import random
+import re
 import requests
 import subprocess
 import tempfile
 import time
 from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
 
 import pytest
 import urllib3
 
-from sham import __version__, db, app
-
-# All test coroutines will be treated as marked.
-pytestmark = pytest.mark.asyncio
-
+from sham import __version__, app, bench, db, packfile, reaper, write_batcher
+from sham.tag_cache import TagCache
+from sham.tag_index import TagIndex
+from sham.tag_suggest import TagUsage
+from sham.write_batcher import WriteBatcher
 
 def is_server_up(url):
     try:
@@ -28,14 +36,16 @@ def db_url():
     return url
 
 
-@pytest.fixture
-def sham_server_url(db_url):
+@contextmanager
+def run_sham_server(db_url, *args, env=None):
+    p = None
     try:
         server_is_up = False
         for _startup_attempt in range(10):
             port = str(random.randint(10000, 20000))
             p = subprocess.Popen(
-                ["python3", "-m", "sham", "--db_url", db_url, "--port", port]
+                ["python3", "-m", "sham", "--db_url", db_url, "--port", port, *args],
+                env=env,
             )
             sham_url = f"http://localhost:{port}"
 
@@ -59,18 +69,46 @@ def sham_server_url(db_url):
             raise AssertionError("Couldn't start server")
         yield sham_url
     finally:
-        p.kill()
+        # Stop gracefully so any worker processes are stopped too
+        if p:
+            p.terminate()
+            try:
+                p.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                p.kill()
 
 
+@pytest.fixture
+def sham_server_url(db_url):
+    with run_sham_server(db_url) as url:
+        yield url
+
+
+@pytest.mark.asyncio
 async def test_schema_version(db_url):
     assert __version__ == "0.1.0"
 
     conn = await db.connect_to_db_by_url(db_url)
+    assert not await db.schema_is_current(conn)
+
+    await db.migrate(conn)
+
+    assert await db.fetch_schema_version(conn) == len(db.SCHEMA_UPDATES) - 1
+    assert await db.schema_is_current(conn)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_migrations(db_url):
+    # Workers starting at the same time queue on the advisory lock
+    await asyncio.gather(*[db.migrate_db_by_url(db_url) for _ in range(4)])
 
+    conn = await db.connect_to_db_by_url(db_url)
     assert await db.fetch_schema_version(conn) == len(db.SCHEMA_UPDATES) - 1
 
 
+@pytest.mark.asyncio
 async def test_get_assets(db_url):
+    await db.migrate_db_by_url(db_url)
     conn = await db.connect_to_db_by_url(db_url)
 
     with tempfile.TemporaryDirectory() as d:
@@ -88,12 +126,850 @@ async def test_get_assets(db_url):
         assert [asset.asset_id for asset in assets] == [1, 2]
 
 
+@pytest.mark.asyncio
+async def test_search_assets(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        for name in ["level 1.png", "level 2.png", "boss.png", "level_x.png"]:
+            await app.post_asset(conn, d, name, b"")
+
+    game = await app.post_tag(conn, app.TagInfo("game", "SM64", None))
+    level = await app.post_tag(conn, app.TagInfo("level", "Bob-omb Battlefield", None))
+    hidden = await app.post_tag(conn, app.TagInfo("hidden", "", None))
+    for asset_id in [1, 2, 3]:
+        await app.post_tag_on_asset(conn, asset_id, game)
+    for asset_id in [1, 2]:
+        await app.post_tag_on_asset(conn, asset_id, level)
+    await app.post_tag_on_asset(conn, 2, hidden)
+    await app.delete_asset(conn, 3)
+
+    async def search(**kwargs):
+        assets = await app.get_assets(conn, app.SearchParams(**kwargs))
+        return [asset.asset_id for asset in assets]
+
+    assert await search() == [1, 2, 4]
+    assert await search(tag_ids=[game]) == [1, 2]
+    assert await search(tag_ids=[game, level]) == [1, 2]
+    assert await search(tag_ids=[game], exclude_tag_ids=[hidden]) == [1]
+    assert await search(key_values=[("level", "Bob-omb Battlefield")]) == [1, 2]
+    assert await search(key_values=[("level", "Whomp's Fortress")]) == []
+    assert await search(name_prefix="level") == [1, 2, 4]
+    # "_" isn't a wildcard
+    assert await search(name_prefix="level_") == [4]
+    assert await search(after_id=1, limit=1) == [2]
+
+
+@pytest.mark.asyncio
+async def test_implied_tags(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        asset_id = await app.post_asset(conn, d, "good boy.png", b"")
+
+    dog = await app.post_tag(conn, app.TagInfo("dog", "", None))
+    mammal = await app.post_tag(conn, app.TagInfo("mammal", "", None))
+    animal = await app.post_tag(conn, app.TagInfo("animal", "", None))
+    await app.post_tag_on_asset(conn, asset_id, dog)
+
+    await app.post_associated_tag(conn, implied_by=dog, implies=mammal)
+    await app.post_associated_tag(conn, implied_by=mammal, implies=animal)
+    assert sorted(await app.get_implied_tags(conn, dog)) == [mammal, animal]
+    assert sorted(await app.get_asset_tags(conn, asset_id)) == [dog, mammal, animal]
+
+    async def search(**kwargs):
+        assets = await app.get_assets(conn, app.SearchParams(**kwargs))
+        return [asset.asset_id for asset in assets]
+
+    assert await search(tag_ids=[animal]) == [asset_id]
+    assert await search(key_values=[("animal", "")]) == [asset_id]
+    assert await search(exclude_tag_ids=[animal]) == []
+
+    with pytest.raises(app.TagCycle):
+        await app.post_associated_tag(conn, implied_by=animal, implies=dog)
+    with pytest.raises(app.TagCycle):
+        await app.post_associated_tag(conn, implied_by=dog, implies=dog)
+    with pytest.raises(app.TagNotFound, match="12345"):
+        await app.post_associated_tag(conn, implied_by=dog, implies=12345)
+    with pytest.raises(app.TagNotFound, match="12345"):
+        await app.post_associated_tag(conn, implied_by=12345, implies=dog)
+
+    # With a second path from dog to animal, removing one keeps the implication
+    await app.post_associated_tag(conn, implied_by=dog, implies=animal)
+    await app.delete_associated_tag(conn, implied_by=dog, implies=mammal)
+    assert sorted(await app.get_asset_tags(conn, asset_id)) == [dog, animal]
+
+    await app.delete_associated_tag(conn, implied_by=dog, implies=animal)
+    assert await app.get_asset_tags(conn, asset_id) == [dog]
+    assert await app.get_implied_tags(conn, mammal) == [animal]
+
+
+@pytest.mark.asyncio
+async def test_ensure_tags(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        asset_id = await app.post_asset(conn, d, "a.txt", b"a")
+
+    existing = await app.post_tag(conn, app.TagInfo("a", "1", None))
+    # Posting the same tag again is fine, and gives back the same tag
+    assert await app.post_tag(conn, app.TagInfo("a", "1", None)) == existing
+    tags = [
+        app.TagInfo("a", "1", None),
+        app.TagInfo("a", "2", None),
+        app.TagInfo("a", "2", asset_id),
+        app.TagInfo("a", "1", None),
+    ]
+    results = await app.ensure_tags(conn, tags, asset_id)
+    ids = [result.tag_id for result in results]
+    assert ids[0] == ids[3] == existing
+    assert len(set(ids)) == 3
+    assert sorted(await app.get_asset_tags(conn, asset_id)) == sorted(set(ids))
+
+    # Again, nothing changes
+    assert await app.ensure_tags(conn, tags) == results
+    assert len(await app.get_tags(conn)) == 3
+
+    # Tags without a linked asset are unique too
+    with pytest.raises(asyncpg.exceptions.UniqueViolationError):
+        await conn.execute("INSERT INTO tag (key, value) VALUES ('a', '2')")
+    assert await app.post_tag(conn, app.TagInfo("a", "2", None)) == ids[1]
+
+    # Racing to create the same tags gives everyone the same ids
+    conns = [await db.connect_to_db_by_url(db_url) for _ in range(4)]
+    tags = [app.TagInfo("b", str(i), None) for i in range(20)]
+    raced = await asyncio.gather(*(app.ensure_tags(c, tags) for c in conns))
+    assert all(results == raced[0] for results in raced)
+
+    with pytest.raises(app.AssetNotFound):
+        await app.ensure_tags(conn, tags, asset_id=12345)
+    with pytest.raises(app.AssetNotFound):
+        await app.ensure_tags(conn, [app.TagInfo("c", "", 12345)])
+
+
+@pytest.mark.asyncio
+async def test_suggest_tags(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        asset_id = await app.post_asset(conn, d, "a.txt", b"a")
+
+    zelda = await app.post_tag(conn, app.TagInfo("game", "Zelda", None))
+    sm64 = await app.post_tag(conn, app.TagInfo("game", "Super Mario 64", None))
+    await app.post_tag(conn, app.TagInfo("level", "100%", None))
+    await app.post_tag_on_asset(conn, asset_id, sm64)
+
+    # Without the tag cache, only whole keys and values match
+    def ids(suggestions):
+        return [tag.tag_id for tag, count in suggestions]
+
+    assert ids(await app.suggest_tags(conn, "GAME")) == [sm64, zelda]
+    assert ids(await app.suggest_tags(conn, "zel")) == [zelda]
+    assert ids(await app.suggest_tags(conn, "game:z")) == [zelda]
+    assert ids(await app.suggest_tags(conn, "mario")) == []
+    assert ids(await app.suggest_tags(conn, "1%")) == []
+    assert (await app.suggest_tags(conn, "s"))[0][1] == 1
+
+
+@pytest.mark.asyncio
+async def test_merge_duplicate_tags(db_url):
+    conn = await db.connect_to_db_by_url(db_url)
+
+    # Before tags without a linked asset were unique (version 13)
+    await db._create_version_table(conn)
+    for version, query in enumerate(db.SCHEMA_UPDATES[:13]):
+        if version:
+            await conn.execute(query)
+            await db._update_schema_version(conn, version)
+
+    await conn.execute(
+        """
+        INSERT INTO asset (name, deleted) VALUES ('a', false);
+        INSERT INTO tag (key, value) VALUES ('a', ''), ('b', ''), ('a', ''), ('c', '');
+        INSERT INTO asset_tag VALUES (1, 1), (1, 3), (1, 4);
+        INSERT INTO associated_tag VALUES (3, 2), (4, 3);
+        INSERT INTO tag_closure VALUES (3, 2), (4, 3), (4, 2);
+        """
+    )
+
+    await db.migrate(conn)
+
+    # Everything that used the duplicate uses the original
+    assert sorted(tag.tag_id for tag in await app.get_tags(conn)) == [1, 2, 4]
+    assert sorted(await app.get_asset_tags(conn, 1)) == [1, 2, 4]
+    assert sorted(await app.get_implied_tags(conn, 4)) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_post_asset_tags(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        for name in ["a", "b", "c"]:
+            await app.post_asset(conn, d, name, b"")
+    tag = await app.post_tag(conn, app.TagInfo("reviewed", "", None))
+    await app.post_tag_on_asset(conn, 1, tag)
+
+    result = await app.post_asset_tags(
+        conn,
+        add={0: (1, tag), 1: (2, tag), 2: (3, tag), 3: (4, tag), 5: (3, 99)},
+        remove={},
+    )
+    # Asset 1 already had the tag
+    assert (result.added, result.removed) == (2, 0)
+    assert {key: str(e) for key, e in result.errors.items()} == {
+        3: "asset 4 does not exist",
+        5: "tag 99 does not exist",
+    }
+    asset_tags = await app.get_all_asset_tags(conn)
+    assert sorted(row["asset_id"] for row in asset_tags if row["tag_id"] == tag) == [1, 2, 3]
+
+    result = await app.post_asset_tags(conn, add={}, remove={0: (1, tag), 1: (2, 99)})
+    assert (result.added, result.removed, result.errors) == (0, 1, {})
+    assert sorted(row["asset_id"] for row in await app.get_all_asset_tags(conn)) == [2, 3]
+
+
+@pytest.mark.parametrize("content_addressed", [False, True])
+@pytest.mark.asyncio
+async def test_post_assets(db_url, content_addressed):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    tag = await app.post_tag(conn, app.TagInfo("import", "2020-05-01", None))
+
+    with tempfile.TemporaryDirectory() as d:
+        files = [(f"level {i}.json", str(i % 3).encode()) for i in range(10)]
+
+        # A tag that doesn't exist is caught before anything is written
+        with pytest.raises(app.TagNotFound, match="99"):
+            await app.post_assets(
+                conn, d, files, tag_ids=[tag, 99], content_addressed=content_addressed
+            )
+        assert await conn.fetchval("SELECT count(*) FROM asset") == 0
+        assert list(Path(d).iterdir()) == []
+
+        asset_ids = await app.post_assets(
+            conn, d, files, tag_ids=[tag], content_addressed=content_addressed
+        )
+        assert asset_ids == list(range(1, 11))
+
+        for asset_id, (_, contents) in zip(asset_ids, files):
+            assert await app.get_asset(d, asset_id) == contents
+            assert await app.get_asset_tags(conn, asset_id) == [tag]
+
+        assets = await app.get_assets(conn, None)
+        assert [asset.name for asset in assets] == [name for name, _ in files]
+        assert list((Path(d) / "tmp").iterdir()) == []
+
+        if content_addressed:
+            rows = await conn.fetch("SELECT refcount FROM blob ORDER BY refcount")
+            assert [row["refcount"] for row in rows] == [3, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_iter_all_asset_tags(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        asset_ids = await app.post_assets(conn, d, [("", b"")] * 25)
+    tag = await app.post_tag(conn, app.TagInfo("bulk", "", None))
+    await app.post_asset_tags(conn, dict(enumerate((a, tag) for a in asset_ids)), {})
+
+    # Smaller batches than there are rows
+    asset_tags = [row async for row in app.iter_all_asset_tags(conn, batch_size=10)]
+    assert sorted(row["asset_id"] for row in asset_tags) == asset_ids
+    assert [tag.to_dict() async for tag in app.iter_tags(conn, batch_size=1)] == [
+        tag.to_dict() for tag in await app.get_tags(conn)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_tag_usage(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+
+    with tempfile.TemporaryDirectory() as d:
+        asset_ids = await app.post_assets(conn, d, [("", b"")] * 3)
+    tag = await app.post_tag(conn, app.TagInfo("bulk", "", None))
+    await app.post_asset_tags(conn, dict(enumerate((a, tag) for a in asset_ids)), {})
+
+    # Nothing is counted until something asks
+    usage = TagUsage(pool, interval=60)
+    try:
+        await asyncio.sleep(0.05)
+        assert usage.counts == {}
+        await usage.start()
+        assert usage.counts == {tag: 3}
+        await usage.start()
+    finally:
+        await usage.close()
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_tag_cache(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+
+    first = await app.post_tag(conn, app.TagInfo("game", "SM64", None))
+
+    cache = TagCache()
+    await cache.start(pool, db_url)
+    try:
+        assert cache.get(first).key == "game"
+
+        async def wait_until(changed):
+            for _ in range(100):
+                if changed():
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError("cache never changed")
+
+        # Changes made anywhere show up through the trigger's notifications
+        second = await app.post_tag(conn, app.TagInfo("game", "OoT", None))
+        await wait_until(lambda: cache.get(second))
+        assert cache.find("game", "OoT", None).tag_id == second
+
+        await conn.execute("UPDATE tag SET value = 'Zelda' WHERE id = $1", second)
+        await wait_until(lambda: cache.get(second).value == "Zelda")
+        assert cache.find("game", "OoT", None) is None
+
+        await conn.execute("DELETE FROM tag WHERE id = $1", second)
+        await wait_until(lambda: cache.get(second) is None)
+
+        # Tags put here before their notification arrives change the ETag
+        etag = cache.etag(json.dumps)
+        async with conn.transaction():
+            third = await app.post_tag(conn, app.TagInfo("game", "MM", None))
+            cache.put(app.TagResult(third, "game", "MM", None))
+            assert cache.etag(json.dumps) != etag
+
+        # A fresh load agrees with the cache that followed along
+        fresh = TagCache()
+        await fresh.start(pool, db_url)
+        await fresh.close()
+        assert fresh.by_id == cache.by_id
+        assert fresh.etag(json.dumps) == cache.etag(json.dumps)
+    finally:
+        await cache.close()
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_tag_index(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+
+    with tempfile.TemporaryDirectory() as d:
+        dog = await app.post_tag(conn, app.TagInfo("species", "dog", None))
+        cat = await app.post_tag(conn, app.TagInfo("species", "cat", None))
+        animal = await app.post_tag(conn, app.TagInfo("kind", "animal", None))
+        await app.post_associated_tag(conn, dog, animal)
+
+        rex = await app.post_asset(conn, d, "rex.png", b"1")
+        tom = await app.post_asset(conn, d, "tom.png", b"2")
+        await app.post_tag_on_asset(conn, rex, dog)
+
+        index = TagIndex()
+        await index.start(pool, db_url)
+        try:
+            async def eventually(check):
+                for _ in range(100):
+                    if check():
+                        return
+                    await asyncio.sleep(0.01)
+                raise AssertionError("index never caught up")
+
+            assert index.search([animal]) == [rex]
+            assert index.search([], [dog]) == [tom]
+
+            # Changes made anywhere show up through the triggers' notifications
+            await app.post_tag_on_asset(conn, tom, cat)
+            await eventually(lambda: index.search([cat]) == [tom])
+
+            await app.post_associated_tag(conn, cat, animal)
+            await eventually(lambda: index.search([animal]) == [rex, tom])
+            assert index.count([animal]) == 2
+            assert index.search([animal], after_id=rex) == [tom]
+            assert index.search([animal], limit=1) == [rex]
+
+            # Implications changing faster than they're read end up right
+            for _ in range(5):
+                await app.delete_associated_tag(conn, implied_by=cat, implies=animal)
+                await app.post_associated_tag(conn, cat, animal)
+            await app.delete_associated_tag(conn, implied_by=dog, implies=animal)
+            await eventually(lambda: index.implied_by == {animal: {cat}})
+            await app.post_associated_tag(conn, dog, animal)
+            await eventually(lambda: index.implied_by == {animal: {cat, dog}})
+
+            await app.delete_tag_from_asset(conn, rex, dog)
+            await eventually(lambda: index.search([animal]) == [tom])
+
+            await app.delete_asset(conn, tom)
+            await eventually(lambda: index.count([]) == 1)
+            assert index.search([animal]) == []
+
+            # The index answers the same as SQL
+            for tag_ids, exclude_tag_ids in [([], []), ([animal], []), ([], [cat])]:
+                search_params = app.SearchParams(
+                    tag_ids=tag_ids, exclude_tag_ids=exclude_tag_ids
+                )
+                assets = await app.get_assets(conn, search_params)
+                assert index.search(tag_ids, exclude_tag_ids) == [
+                    asset.asset_id for asset in assets
+                ]
+                assert index.count(tag_ids, exclude_tag_ids) == await app.count_assets(
+                    conn, search_params
+                )
+        finally:
+            await index.close()
+            await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_facets(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+
+    with tempfile.TemporaryDirectory() as d:
+        tags = {}
+        for key, value in [
+            ("game", "sm64"),
+            ("game", "zelda"),
+            ("level", "bob-omb"),
+            ("level", "hyrule"),
+            ("series", "mario"),
+        ]:
+            tags[value] = await app.post_tag(conn, app.TagInfo(key, value, None))
+        await app.post_associated_tag(conn, tags["bob-omb"], tags["sm64"])
+        await app.post_associated_tag(conn, tags["sm64"], tags["mario"])
+
+        assets = [await app.post_asset(conn, d, f"{i}.png", b"x") for i in range(5)]
+        for asset_id, values in zip(
+            assets,
+            [["sm64"], ["bob-omb"], ["bob-omb", "sm64"], ["zelda", "hyrule"], []],
+        ):
+            for value in values:
+                await app.post_tag_on_asset(conn, asset_id, tags[value])
+
+        def counts(facets):
+            return [(facet.key, facet.value, facet.count) for facet in facets]
+
+        # Implied tags count, but only once per asset
+        assert counts(await app.get_facets(conn, None)) == [
+            ("game", "sm64", 3),
+            ("game", "zelda", 1),
+            ("level", "bob-omb", 2),
+            ("level", "hyrule", 1),
+            ("series", "mario", 3),
+        ]
+
+        search_params = app.SearchParams(tag_ids=[tags["sm64"]])
+        assert counts(await app.get_facets(conn, search_params, ["level", "game"])) == [
+            ("game", "sm64", 3),
+            ("level", "bob-omb", 2),
+        ]
+        assert counts(await app.get_facets(conn, None, limit=1)) == [
+            ("game", "sm64", 3),
+            ("level", "bob-omb", 2),
+            ("series", "mario", 3),
+        ]
+
+        # The tag index counts the same
+        index = TagIndex()
+        await index.start(pool, db_url)
+        try:
+            all_tags = await app.get_tags(conn)
+            searches = [([], []), ([tags["sm64"]], []), ([], [tags["zelda"]])]
+            for tag_ids, exclude_tag_ids in searches:
+                search_params = app.SearchParams(
+                    tag_ids=tag_ids, exclude_tag_ids=exclude_tag_ids
+                )
+                matching = index.matching(tag_ids, exclude_tag_ids)
+                by_id = {tag.tag_id: tag for tag in all_tags}
+                from_index = [
+                    app.FacetCount(tag_id, by_id[tag_id].key, by_id[tag_id].value, count)
+                    for tag_id, count in index.facet_counts(matching, by_id).items()
+                ]
+                assert app.top_facets(from_index, 10) == await app.get_facets(
+                    conn, search_params
+                )
+        finally:
+            await index.close()
+            await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_content_addressed_assets(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        first = await app.post_asset(conn, d, "a.png", b"12345", content_addressed=True)
+        second = await app.post_asset(conn, d, "b.png", b"12345", content_addressed=True)
+        assert first != second
+
+        async with app.AssetWriter(d, content_addressed=True) as writer:
+            await writer.write(b"123")
+            await writer.write(b"45")
+            third = await writer.commit(conn, "c.png")
+
+        # All three assets are the same file on disk
+        first_path = app.asset_path_from_dir_and_id(d, first)
+        for asset_id in [second, third]:
+            assert app.asset_path_from_dir_and_id(d, asset_id).samefile(first_path)
+        assert await app.get_asset(d, third) == b"12345"
+
+        row = await conn.fetchrow("SELECT size, refcount FROM blob")
+        assert (row["size"], row["refcount"]) == (5, 3)
+
+
+@pytest.mark.asyncio
+async def test_reshard_assets():
+    with tempfile.TemporaryDirectory() as d:
+        # Assets and blobs from before sharding are stored flat
+        (Path(d) / "1").write_bytes(b"first")
+        (Path(d) / "1234").write_bytes(b"second")
+        for asset_id in [10, 39, 99]:
+            (Path(d) / str(asset_id)).write_bytes(b"%d" % asset_id)
+        (Path(d) / "blobs").mkdir()
+        (Path(d) / "blobs" / "abcdef").write_bytes(b"blob")
+        (Path(d) / "tmp").mkdir()
+
+        # They can still be read before they're moved
+        assert await app.get_asset(d, 1234) == b"second"
+
+        # New uploads are sharded while old assets are still flat. 16 is
+        # 0x10, so its shard is named like asset 10.
+        async with app.AssetWriter(d) as writer:
+            await writer.write(b"new")
+            await writer._move_to(16)
+
+        assert await app.reshard_assets(d, batch_size=1, batch_delay=0) == 6
+
+        assert (
+            app.asset_path_from_dir_and_id(d, 1234)
+            == Path(d) / "shards" / "d2" / "04" / "1234"
+        )
+        assert app.asset_path_from_dir_and_id(d, 1234).read_bytes() == b"second"
+        assert app.blob_path_from_dir_and_sha256(d, "abcdef").read_bytes() == b"blob"
+        assert sorted(p.name for p in Path(d).iterdir()) == ["blobs", "shards", "tmp"]
+
+        assert await app.get_asset(d, 1) == b"first"
+        assert await app.get_asset(d, 1234) == b"second"
+        assert await app.get_asset(d, 16) == b"new"
+        for asset_id in [10, 39, 99]:
+            assert await app.get_asset(d, asset_id) == b"%d" % asset_id
+
+        # Running it again has nothing to do
+        assert await app.reshard_assets(d, batch_delay=0) == 0
+
+
+@pytest.mark.asyncio
+async def test_write_batcher(db_url):
+    await db.migrate_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+    try:
+        async with pool.acquire() as conn:
+            with tempfile.TemporaryDirectory() as d:
+                asset_id = await app.post_asset(conn, d, "a.txt", b"a")
+
+        batch_sizes = write_batcher.WRITE_BATCH_SIZE.labels()
+        batches = sum(batch_sizes.counts)
+
+        batcher = WriteBatcher(pool.acquire, max_batch=100, max_delay=0.05)
+        tags = [app.TagInfo(key="k", value=str(i), linked_asset_id=None) for i in range(10)]
+        tag_ids = await asyncio.gather(
+            *(batcher.submit(app.post_tag, tag) for tag in tags)
+        )
+        assert sorted(tag_ids) == list(range(1, 11))
+
+        # They were all committed together
+        assert sum(batch_sizes.counts) == batches + 1
+
+        # A write that fails doesn't take the rest of its batch with it
+        results = await asyncio.gather(
+            batcher.submit(app.post_tag_on_asset, asset_id, tag_ids[0]),
+            batcher.submit(app.post_tag_on_asset, 12345, tag_ids[0]),
+            batcher.submit(app.post_tag_on_asset, asset_id, tag_ids[1]),
+            return_exceptions=True,
+        )
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], asyncpg.exceptions.ForeignKeyViolationError)
+
+        async with pool.acquire() as conn:
+            assert sorted(await app.get_asset_tags(conn, asset_id)) == tag_ids[:2]
+
+        # A full batch doesn't wait for the delay
+        batcher = WriteBatcher(pool.acquire, max_batch=2, max_delay=60)
+        await asyncio.wait_for(
+            asyncio.gather(
+                batcher.submit(app.delete_tag_from_asset, asset_id, tag_ids[0]),
+                batcher.submit(app.delete_tag_from_asset, asset_id, tag_ids[1]),
+            ),
+            timeout=5,
+        )
+        await batcher.close()
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_reap(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+
+    with tempfile.TemporaryDirectory() as d:
+        kept = await app.post_asset(conn, d, "kept.txt", b"kept")
+        deleted = await app.post_asset(conn, d, "deleted.txt", b"deleted")
+        shared = [
+            await app.post_asset(conn, d, name, b"shared", content_addressed=True)
+            for name in ["a.txt", "b.txt"]
+        ]
+        for asset_id in [deleted, *shared]:
+            await app.delete_asset(conn, asset_id)
+
+        # An upload that died before it was un-deleted, and one left in tmp
+        orphan = await conn.fetchval(
+            "INSERT INTO asset (name, deleted) VALUES ('orphan', true) RETURNING id"
+        )
+        app.asset_path_from_dir_and_id(d, orphan).parent.mkdir(parents=True)
+        app.asset_path_from_dir_and_id(d, orphan).write_bytes(b"orphan")
+        (Path(d) / "tmp" / "abandoned").write_bytes(b"abandoned")
+
+        # Nothing is old enough yet
+        result = await reaper.reap(conn, d, timedelta(hours=1), batch_delay=0)
+        assert result == reaper.ReapResult()
+
+        # A dry run reports without removing anything
+        result = await reaper.reap(conn, d, timedelta(0), batch_delay=0, dry_run=True)
+        assert (result.assets, result.orphans, result.tmp_files) == (3, 1, 1)
+        assert app.asset_path_from_dir_and_id(d, deleted).exists()
+
+        # Only one reaper at a time
+        other = await db.connect_to_db_by_url(db_url)
+        await other.execute("SELECT pg_advisory_lock($1)", reaper.REAPER_LOCK_ID)
+        assert await reaper.reap(conn, d, timedelta(0), batch_delay=0) is None
+        await other.close()
+
+        result = await reaper.reap(conn, d, timedelta(0), batch_size=1, batch_delay=0)
+        assert result == reaper.ReapResult(
+            assets=3,
+            orphans=1,
+            blobs=1,
+            tmp_files=1,
+            freed_bytes=len(b"deleted" + b"shared" + b"orphan" + b"abandoned"),
+        )
+
+        for asset_id in [deleted, orphan, *shared]:
+            assert not app.asset_path_from_dir_and_id(d, asset_id).exists()
+        assert list((Path(d) / "tmp").iterdir()) == []
+        assert not any(p.is_file() for p in (Path(d) / "blobs").rglob("*"))
+        assert await conn.fetchval("SELECT count(*) FROM blob") == 0
+        assert await app.get_asset(d, kept) == b"kept"
+
+        # Reaped assets keep their rows so ids aren't reused, orphans don't
+        rows = await conn.fetch("SELECT id, purged FROM asset ORDER BY id")
+        assert [(row["id"], row["purged"]) for row in rows] == [
+            (kept, False),
+            (deleted, True),
+            *[(asset_id, True) for asset_id in shared],
+        ]
+
+        # There's nothing left to do
+        result = await reaper.reap(conn, d, timedelta(0), batch_delay=0)
+        assert result == reaper.ReapResult()
+
+
+@pytest.mark.asyncio
+async def test_blob_reaped_during_upload(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    reaping = await db.connect_to_db_by_url(db_url)
+    sha256 = hashlib.sha256(b"same").hexdigest()
+
+    with tempfile.TemporaryDirectory() as d:
+        blob_path = app.blob_path_from_dir_and_sha256(d, sha256)
+        uploads = [
+            lambda: app.post_asset(conn, d, "a.txt", b"same", content_addressed=True),
+            lambda: app.post_assets(conn, d, [("b.txt", b"same")], content_addressed=True),
+        ]
+        for upload in uploads:
+            # A blob nobody uses any more, which the reaper is removing
+            await app.post_asset(conn, d, "old.txt", b"same", content_addressed=True)
+            await conn.execute("UPDATE asset SET deleted = true, blob_sha256 = NULL")
+            await conn.execute("UPDATE blob SET refcount = 0")
+            tx = reaping.transaction()
+            await tx.start()
+            assert await reaping.execute("DELETE FROM blob WHERE refcount = 0") == "DELETE 1"
+
+            # An upload of the same contents finds the blob, and waits for
+            # the reaper before taking its reference
+            task = asyncio.create_task(upload())
+            await asyncio.sleep(0.1)
+            assert not task.done()
+            blob_path.unlink()
+            await tx.commit()
+
+            # Then writes the blob again
+            result = await task
+            new_id = result if isinstance(result, int) else result[0]
+            assert await app.get_asset(d, new_id) == b"same"
+            assert blob_path.read_bytes() == b"same"
+            assert await conn.fetchval("SELECT refcount FROM blob") == 1
+            assert list((Path(d) / "tmp").iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_reap_assets_deleted_before_migration(db_url):
+    conn = await db.connect_to_db_by_url(db_url)
+
+    # Before deleted_at (version 12)
+    await db._create_version_table(conn)
+    for version, query in enumerate(db.SCHEMA_UPDATES[:12]):
+        if version:
+            await conn.execute(query)
+            await db._update_schema_version(conn, version)
+
+    await conn.execute(
+        """
+        INSERT INTO asset (name, deleted) VALUES ('kept', false), ('deleted', true);
+        INSERT INTO tag (key, value) VALUES ('a', '');
+        INSERT INTO asset_tag VALUES (2, 1);
+        """
+    )
+    await db.migrate(conn)
+
+    # It's an asset that was deleted, not an unfinished upload
+    with tempfile.TemporaryDirectory() as d:
+        result = await reaper.reap(conn, d, timedelta(0), batch_delay=0)
+    assert (result.assets, result.orphans) == (1, 0)
+    rows = await conn.fetch("SELECT id, purged FROM asset ORDER BY id")
+    assert [(row["id"], row["purged"]) for row in rows] == [(1, False), (2, True)]
+
+
+@pytest.mark.asyncio
+async def test_asset_writer_max_size():
+    with tempfile.TemporaryDirectory() as d:
+        with pytest.raises(app.AssetTooLarge):
+            async with app.AssetWriter(d, max_size=8) as writer:
+                await writer.write(b"12345")
+                await writer.write(b"67890")
+
+        # The partial upload was cleaned up
+        assert list((Path(d) / "tmp").iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_packs(db_url):
+    await db.migrate_db_by_url(db_url)
+    conn = await db.connect_to_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=2)
+
+    with tempfile.TemporaryDirectory() as d:
+        packs = packfile.PackStore(d, pool.acquire, max_asset_size=8, segment_size=16)
+        small = [
+            await app.post_asset(conn, d, f"{i}.txt", b"small %d" % i, packs=packs)
+            for i in range(3)
+        ]
+        large = await app.post_asset(conn, d, "large.txt", b"too big to pack", packs=packs)
+        batch = await app.post_assets(
+            conn, d, [("a.txt", b"a"), ("b.txt", b"b" * 100), ("c.txt", b"")], packs=packs
+        )
+
+        # Small assets aren't files of their own, two fit in a segment
+        for asset_id in [*small, batch[0], batch[2]]:
+            assert not app.asset_path_from_dir_and_id(d, asset_id).exists()
+        assert app.asset_path_from_dir_and_id(d, large).exists()
+        assert app.asset_path_from_dir_and_id(d, batch[1]).exists()
+        assert sorted(p.name for p in (Path(d) / "packs").iterdir()) == ["1.pack", "2.pack"]
+
+        for i, asset_id in enumerate(small):
+            assert await app.get_asset(d, asset_id, packs) == b"small %d" % i
+        assert await app.get_asset(d, batch[0], packs) == b"a"
+        assert await app.get_asset(d, batch[1], packs) == b"b" * 100
+        assert await app.get_asset(d, batch[2], packs) == b""
+        assert await app.get_asset(d, large, packs) == b"too big to pack"
+        with pytest.raises(app.AssetNotFound):
+            await app.get_asset(d, small[0])
+
+        # The segment being written to grows after it's mapped
+        grown = await app.post_asset(conn, d, "grown.txt", b"grown", packs=packs)
+        assert await app.get_asset(d, grown, packs) == b"grown"
+
+        f = await app.open_asset(d, small[1], packs)
+        assert app.asset_size(f) == 7
+        assert [chunk async for chunk in app.read_chunks(f, 2, 3, chunk_size=2)] == [
+            b"al",
+            b"l",
+        ]
+        await f.close()
+
+        for asset_id in [small[0], small[2], grown]:
+            await app.delete_asset(conn, asset_id)
+        await packs.close()
+
+        # The second segment is mostly deleted assets, so what's left of it is
+        # moved to a new one. The first is still half in use.
+        result = await reaper.reap(conn, d, timedelta(0), batch_delay=0)
+        assert result == reaper.ReapResult(
+            assets=3, pack_segments=1, freed_bytes=len(b"small 2" + b"grown")
+        )
+        assert sorted(p.name for p in (Path(d) / "packs").iterdir()) == ["1.pack", "3.pack"]
+        assert await app.get_asset(d, small[1], packs) == b"small 1"
+        assert await app.get_asset(d, batch[0], packs) == b"a"
+        assert await app.get_asset(d, batch[2], packs) == b""
+
+        # Once told the old segment is gone, assets in it are looked up again
+        packs.discard_segment(2)
+        assert await app.get_asset(d, batch[0], packs) == b"a"
+        assert packs._locations[batch[0]][0] == 3
+
+        # Another worker looks them up, and reaped assets are gone
+        other = packfile.PackStore(d, pool.acquire)
+        assert await app.get_asset(d, batch[0], other) == b"a"
+        assert await app.get_asset(d, small[1], other) == b"small 1"
+        with pytest.raises(app.AssetNotFound):
+            await app.get_asset(d, small[0], other)
+
+        result = await reaper.reap(conn, d, timedelta(0), batch_delay=0)
+        assert result == reaper.ReapResult()
+
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_create_pool(db_url):
+    await db.migrate_db_by_url(db_url)
+    pool = await db.create_pool(db_url, min_size=1, max_size=3)
+
+    try:
+        async with pool.acquire() as conn:
+            assert await db.fetch_schema_version(conn) == len(db.SCHEMA_UPDATES) - 1
+
+            metrics = db.pool_metrics(pool)
+            assert metrics["min_size"] == 1
+            assert metrics["max_size"] == 3
+            assert metrics["in_use"] == 1
+    finally:
+        await pool.close()
+
+
 def test_fullup(sham_server_url):
     url = sham_server_url
 
     # We start out with no assets
     res = requests.get(url + "/assets").json()
-    assert res == {"asset": []}
+    assert res == {"asset": [], "next_after_id": None}
 
     # We insert an asset and get its id
     files = {"file": ("my_file_name.foo", "some,data,to,send\n")}
@@ -120,7 +996,7 @@ def test_fullup(sham_server_url):
 
     # We see this single element when we get all assets
     res = requests.get(url + "/assets").json()
-    assert res == {"asset": [{"id": 1, "name": "my_file_name.foo"}]}
+    assert res == {"asset": [{"id": 1, "name": "my_file_name.foo"}], "next_after_id": None}
 
     # Let's upload another file and see we got the next id
     files = {"file": ("my_file_name2.foo", "more,data,to,send\n")}
@@ -129,10 +1005,143 @@ def test_fullup(sham_server_url):
 
     # Now we should see both when we get the assets
     res = requests.get(url + "/assets").json()
-    assert res == {"asset": [{"id": 1, "name": "my_file_name.foo"}, {"id": 2, "name": "my_file_name2.foo"}]}
+    assert res == {"asset": [{"id": 1, "name": "my_file_name.foo"}, {"id": 2, "name": "my_file_name2.foo"}], "next_after_id": None}
+
+    # Which can be paged through
+    res = requests.get(url + "/assets", params={"limit": 1}).json()
+    assert res == {"asset": [{"id": 1, "name": "my_file_name.foo"}], "next_after_id": 1}
+    res = requests.get(url + "/assets", params={"limit": 1, "after_id": 1}).json()
+    assert res == {"asset": [{"id": 2, "name": "my_file_name2.foo"}], "next_after_id": 2}
+
+    # Or counted
+    res = requests.get(url + "/assets/count").json()
+    assert res == {"count": 2}
+    res = requests.get(url + "/assets/count", params={"name_prefix": "my_file_name2"}).json()
+    assert res == {"count": 1}
+
+    assert requests.get(url + "/assets", params={"limit": 0}).status_code == 400
+    assert requests.get(url + "/assets", params={"tag": "x"}).status_code == 400
 
     # TODO: test deleting assets
 
+    # Every request above shared the server's connection pool
+    res = requests.get(url + "/stats").json()
+    assert res["db_pool"]["acquired"] >= 4
+    assert res["db_pool"]["acquire_timeouts"] == 0
+
+
+def test_streaming_upload(sham_server_url):
+    url = sham_server_url
+
+    # Raw bodies are streamed to disk rather than parsed as a form
+    res = requests.post(
+        url + "/assets",
+        params={"filename": "level data.json"},
+        data=iter([b'{"level": ', b'"Bob-omb Battlefield"}']),
+        headers={"Content-Type": "application/octet-stream"},
+    ).json()
+    assert res == {"id": 1}
+
+    res = requests.get(url + "/assets/1")
+    assert res.content == b'{"level": "Bob-omb Battlefield"}'
+
+    res = requests.get(url + "/assets").json()
+    assert res == {"asset": [{"id": 1, "name": "level data.json"}], "next_after_id": None}
+
+    # A chunked body with a nonsense length alongside it
+    for path in ["/assets", "/assets/batch"]:
+        res = requests.post(
+            url + path,
+            data=iter([b"x"]),
+            headers={"Content-Type": "application/octet-stream", "Content-Length": "lots"},
+        )
+        assert res.status_code == 400
+
+
+def test_batch_upload(sham_server_url):
+    url = sham_server_url
+
+    res = requests.post(url + "/tags", json={"key": "import", "value": "", "linked_asset_id": None})
+    tag_id = res.json()["id"]
+
+    files = [("file", (f"{i}.txt", f"file {i}")) for i in range(5)]
+    res = requests.post(url + "/assets/batch", files=files, data={"tag": tag_id}).json()
+    assert res == {"ids": [1, 2, 3, 4, 5]}
+
+    assert requests.get(url + "/assets/4").content == b"file 3"
+    assert requests.get(url + "/assets/4/tags").json() == [tag_id]
+
+    res = requests.post(url + "/assets/batch", files=files, data={"tag": 12345})
+    assert res.status_code == 400
+    assert len(requests.get(url + "/assets").json()["asset"]) == 5
+
+
+def test_asset_caching(sham_server_url):
+    url = sham_server_url
+
+    files = {"file": ("clip.mp4", "0123456789")}
+    res = requests.post(url + "/assets", files=files).json()
+    assert res == {"id": 1}
+
+    res = requests.get(url + "/assets/1.mp4")
+    assert res.status_code == 200
+    assert res.headers["ETag"] == '"1"'
+    assert "immutable" in res.headers["Cache-Control"]
+    assert res.headers["Content-Length"] == "10"
+
+    # Clients that already have the asset don't download it again
+    res = requests.get(url + "/assets/1.mp4", headers={"If-None-Match": '"1"'})
+    assert res.status_code == 304
+    assert res.content == b""
+
+    # Byte ranges, including open ended and suffix ranges
+    res = requests.get(url + "/assets/1.mp4", headers={"Range": "bytes=2-4"})
+    assert res.status_code == 206
+    assert res.content == b"234"
+    assert res.headers["Content-Range"] == "bytes 2-4/10"
+
+    res = requests.get(url + "/assets/1.mp4", headers={"Range": "bytes=7-"})
+    assert res.content == b"789"
+
+    res = requests.get(url + "/assets/1.mp4", headers={"Range": "bytes=-2"})
+    assert res.content == b"89"
+
+    res = requests.get(url + "/assets/1.mp4", headers={"Range": "bytes=10-"})
+    assert res.status_code == 416
+    assert res.headers["Content-Range"] == "bytes */10"
+
+    # Assets that don't exist are a 404
+    assert requests.get(url + "/assets/999999").status_code == 404
+    assert requests.get(url + "/assets/nope").status_code == 404
+
+    # Small assets were served from memory after the first read
+    res = requests.get(url + "/stats").json()
+    assert res["asset_cache"]["entries"] == 1
+    assert res["asset_cache"]["hits"] == 4
+
+    # Large ones are streamed from disk every time
+    large = bytes(range(256)) * 2048
+    res = requests.post(url + "/assets", files={"file": ("large.bin", large)}).json()
+    large_id = res["id"]
+    for _ in range(2):
+        res = requests.get(url + f"/assets/{large_id}")
+        assert res.content == large
+        res = requests.get(url + f"/assets/{large_id}", headers={"Range": "bytes=256-511"})
+        assert res.content == bytes(range(256))
+    assert requests.get(url + "/stats").json()["asset_cache"]["entries"] == 1
+
+    # Deleting an asset drops it from the cache
+    requests.delete(url + "/assets/1")
+    assert requests.get(url + "/stats").json()["asset_cache"]["entries"] == 0
+
+    # And it's gone, even for clients that had it and even though its files
+    # are still there until it's reaped
+    for asset_id in [1, large_id]:
+        requests.delete(url + f"/assets/{asset_id}")
+        res = requests.get(url + f"/assets/{asset_id}", headers={"If-None-Match": f'"{asset_id}"'})
+        assert res.status_code == 404
+        assert requests.get(url + f"/assets/{asset_id}").status_code == 404
+
 
 def test_tags(sham_server_url):
     url = sham_server_url
@@ -175,3 +1184,419 @@ def test_tags(sham_server_url):
     # Check that the tag has been removed
     res = requests.get(f"{url}/assets/1/tags").json()
     assert res == []
+
+    # Tags can imply other tags
+    res = requests.post(f"{url}/tags/2/implies", json={"tag_id": 1})
+    assert res
+    res = requests.post(f"{url}/assets/1/tags", json={"tag_id": 2})
+    assert res
+    res = requests.get(f"{url}/assets/1/tags").json()
+    assert sorted(res) == [1, 2]
+
+    # But not in a cycle
+    res = requests.post(f"{url}/tags/1/implies", json={"tag_id": 2})
+    assert res.status_code == 409
+
+    # Or with tags that don't exist
+    res = requests.post(f"{url}/tags/12345/implies", json={"tag_id": 1})
+    assert res.status_code == 404
+    res = requests.post(f"{url}/tags/1/implies", json={"tag_id": 12345})
+    assert res.status_code == 400
+
+    res = requests.delete(f"{url}/tags/2/implies/1")
+    assert res
+    res = requests.get(f"{url}/tags/2/implies").json()
+    assert res == []
+
+    # Many tags can be changed at once
+    res = requests.post(
+        f"{url}/asset_tags",
+        json={
+            "add": [{"asset_id": 2, "tag_id": 1}, {"asset_id": 3, "tag_id": 1}, "nope"],
+            "remove": [{"asset_id": 1, "tag_id": 2}],
+        },
+    ).json()
+    assert res == {
+        "added": 1,
+        "removed": 1,
+        "errors": {
+            "add": {
+                "1": "asset 3 does not exist",
+                "2": "expected an asset_id and tag_id, got nope",
+            }
+        },
+    }
+    res = requests.get(f"{url}/asset_tags").json()
+    assert res == [{"asset_id": 2, "tag_id": 1}]
+
+    # Tags are served from memory, and clients can avoid downloading them again
+    res = requests.get(f"{url}/tags")
+    res = requests.get(f"{url}/tags", headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 304
+
+    # Big tables can be streamed as newline delimited JSON
+    res = requests.get(f"{url}/tags", params={"format": "ndjson"})
+    assert res.headers["Content-Type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in res.text.splitlines()] == [
+        {"tag_id": 1, "key": "Category", "value": "nature", "linked_asset_id": None},
+        {"tag_id": 2, "key": "next_chapter", "value": "", "linked_asset_id": 2},
+    ]
+    res = requests.get(
+        f"{url}/asset_tags", headers={"Accept": "application/x-ndjson"}
+    )
+    assert res.text == '{"tag_id":1,"asset_id":2}\n'
+
+    # Tags can be looked up (or created) by key and value and put on an asset
+    # in one request
+    res = requests.post(
+        f"{url}/tags/ensure",
+        json={
+            "tags": [
+                {"key": "Category", "value": "nature", "linked_asset_id": None},
+                {"key": "Category", "value": "science"},
+            ],
+            "asset_id": 1,
+        },
+    ).json()
+    category, science = res["ids"]
+    assert category == 1
+
+    # Posting an existing tag gives back the same tag
+    res = requests.post(
+        url + "/tags",
+        json={"key": "Category", "value": "science", "linked_asset_id": None},
+    )
+    assert res.status_code == 200
+    assert res.json() == {"id": science}
+    res = requests.get(f"{url}/assets/1/tags").json()
+    assert sorted(res) == [1, science]
+    res = requests.get(f"{url}/tags").json()
+    assert res[-1] == {
+        "tag_id": science, "key": "Category", "value": "science", "linked_asset_id": None
+    }
+
+    # Autocomplete
+    res = requests.get(f"{url}/tags/suggest", params={"q": "cat"}).json()
+    assert sorted(tag["tag_id"] for tag in res) == [1, science]
+    res = requests.get(f"{url}/tags/suggest", params={"q": "sci", "limit": 1}).json()
+    assert [tag["tag_id"] for tag in res] == [science]
+
+    # Counts of each tag on the assets matching a search
+    res = requests.get(f"{url}/assets/facets", params={"facet": "Category"}).json()
+    assert res == {
+        "total": 2,
+        "facets": {
+            "Category": [
+                {"tag_id": 1, "value": "nature", "count": 2},
+                {"tag_id": science, "value": "science", "count": 1},
+            ]
+        },
+    }
+    res = requests.get(f"{url}/assets/facets", params={"facet_limit": 0})
+    assert res.status_code == 400
+
+    res = requests.post(f"{url}/tags/ensure", json={"tags": [{"key": 1}]})
+    assert res.status_code == 400
+    res = requests.post(f"{url}/tags/ensure", json={"tags": [], "asset_id": 3})
+    assert res.status_code == 404
+
+
+def test_asset_preview(sham_server_url):
+    Image = pytest.importorskip("PIL.Image")
+    url = sham_server_url
+
+    png = io.BytesIO()
+    Image.new("RGB", (1024, 512), "red").save(png, "PNG")
+    res = requests.post(url + "/assets", files={"file": ("big.png", png.getvalue())})
+    asset_id = res.json()["id"]
+    res = requests.post(url + "/assets", params={"filename": "notes.txt"}, data=b"hi")
+    text_id = res.json()["id"]
+
+    # Previews are small, and cached like the assets themselves
+    res = requests.get(url + f"/assets/{asset_id}/preview")
+    assert res.status_code == 200
+    assert res.headers["Content-Type"] == "image/webp"
+    assert "immutable" in res.headers["Cache-Control"]
+    assert Image.open(io.BytesIO(res.content)).size == (256, 128)
+
+    res = requests.get(
+        url + f"/assets/{asset_id}/preview",
+        headers={"If-None-Match": res.headers["ETag"]},
+    )
+    assert res.status_code == 304
+
+    # Only images have previews
+    assert requests.get(url + f"/assets/{text_id}/preview").status_code == 404
+    assert requests.get(url + "/assets/999999/preview").status_code == 404
+
+
+def test_compressed_variants(db_url):
+    # Variants are kept next to the assets, so don't share the default
+    # asset_dir with other tests' asset ids
+    with tempfile.TemporaryDirectory() as d:
+        with run_sham_server(db_url, "--asset_dir", d) as url:
+            _check_compressed_variants(url)
+
+
+@pytest.mark.asyncio
+async def test_packed_assets(db_url):
+    with tempfile.TemporaryDirectory() as d:
+        # Without the asset cache, packed assets are streamed like files
+        with run_sham_server(
+            db_url, "--asset_dir", d, "--packs", "--asset_cache_size", "0"
+        ) as url:
+            res = requests.post(url + "/assets", params={"filename": "a.txt"}, data=b"packed")
+            asset_id = res.json()["id"]
+            assert not app.asset_path_from_dir_and_id(d, asset_id).exists()
+
+            res = requests.get(url + f"/assets/{asset_id}")
+            assert res.content == b"packed"
+            res = requests.get(url + f"/assets/{asset_id}", headers={"Range": "bytes=1-3"})
+            assert res.status_code == 206
+            assert res.content == b"ack"
+
+            # Variants are made from packed assets too
+            _check_compressed_variants(url)
+
+    # Stopping the server sealed its segment
+    conn = await db.connect_to_db_by_url(db_url)
+    assert await conn.fetchval("SELECT bool_and(sealed) FROM pack_segment")
+    assert await conn.fetchval("SELECT count(*) FROM pack_entry") == 3
+
+
+@pytest.mark.asyncio
+async def test_workers_forget_purged_assets(db_url):
+    with tempfile.TemporaryDirectory() as d:
+        with run_sham_server(db_url, "--asset_dir", d, "--packs", "--workers", "2") as url:
+            res = requests.post(url + "/assets", params={"filename": "a.txt"}, data=b"packed")
+            asset_id = res.json()["id"]
+
+            # Both workers remember where it is, and keep it in memory
+            for _ in range(20):
+                assert requests.get(url + f"/assets/{asset_id}").content == b"packed"
+
+            assert requests.delete(url + f"/assets/{asset_id}").status_code == 200
+            conn = await db.connect_to_db_by_url(db_url)
+            result = await reaper.reap(conn, d, timedelta(0), batch_delay=0)
+            assert result.assets == 1
+
+            # Whichever worker answers has forgotten it
+            for _ in range(100):
+                statuses = {
+                    requests.get(url + f"/assets/{asset_id}").status_code for _ in range(10)
+                }
+                if statuses == {404}:
+                    break
+                time.sleep(0.02)
+            assert statuses == {404}
+
+
+def _check_compressed_variants(url):
+    data = json.dumps([{"x": i, "y": i * 2} for i in range(1000)]).encode()
+    res = requests.post(url + "/assets", params={"filename": "level.json"}, data=data)
+    asset_id = res.json()["id"]
+    res = requests.post(url + "/assets", params={"filename": "a.bin"}, data=data)
+    binary_id = res.json()["id"]
+
+    # The variant is made in the background after the upload
+    for _ in range(100):
+        res = requests.get(
+            url + f"/assets/{asset_id}.json", headers={"Accept-Encoding": "gzip"}
+        )
+        if res.headers.get("Content-Encoding") == "gzip":
+            break
+        time.sleep(0.02)
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["ETag"] == f'"{asset_id}-gzip"'
+    assert res.headers["Vary"] == "Accept-Encoding"
+    assert int(res.raw.headers["Content-Length"]) < len(data) // 2
+    assert res.content == data
+
+    res = requests.get(
+        url + f"/assets/{asset_id}.json",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": f'"{asset_id}-gzip"'},
+    )
+    assert res.status_code == 304
+
+    # Clients that don't accept it, and ranges, get the asset as it is
+    res = requests.get(
+        url + f"/assets/{asset_id}.json", headers={"Accept-Encoding": "identity"}
+    )
+    assert "Content-Encoding" not in res.headers
+    assert res.headers["ETag"] == f'"{asset_id}"'
+    assert res.content == data
+
+    res = requests.get(
+        url + f"/assets/{asset_id}.json",
+        headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"},
+    )
+    assert res.status_code == 206
+    assert "Content-Encoding" not in res.headers
+    assert res.content == data[:10]
+
+    # Binary assets aren't compressed
+    res = requests.get(url + f"/assets/{binary_id}", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in res.headers
+    assert "Vary" not in res.headers
+
+
+def test_metrics(sham_server_url):
+    url = sham_server_url
+
+    requests.post(url + "/assets", params={"filename": "a.txt"}, data=b"12345")
+    requests.get(url + "/assets/1")
+    requests.get(url + "/assets/1")
+    requests.get(url + "/nope")
+
+    res = requests.get(url + "/metrics")
+    assert res.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    # Every series is labelled with the worker that recorded it
+    worker = re.search(r'sham_upload_bytes_total\{worker="(\d+)"\}', res.text)[1]
+    text = res.text.replace(f',worker="{worker}"', "").replace(f'{{worker="{worker}"}}', "")
+
+    assert 'sham_http_requests_total{method="GET",route="assets/<asset_id_with_extension:str>",status="200"} 2.0' in text
+    assert 'sham_http_requests_total{method="GET",route="unmatched",status="404"} 1.0' in text
+    assert 'sham_http_request_seconds_count{method="POST",route="assets"} 1' in text
+    assert 'sham_db_query_seconds_count{query="AssetWriter.commit"} 1' in text
+    assert "sham_upload_bytes_total 5.0" in text
+    assert "sham_download_bytes_total 10.0" in text
+    assert 'sham_db_pool_connections{state="max_size"} 10' in text
+    assert "sham_tmp_dir_files 0" in text
+    assert 'sham_asset_cache_lookups_total{result="hit"} 1.0' in text
+    assert 'sham_asset_cache_lookups_total{result="miss"} 1.0' in text
+
+def test_bench(sham_server_url):
+    port = int(sham_server_url.rpartition(":")[2])
+    config = bench.BenchConfig(assets=20, tags=5, concurrency=4, requests=40)
+
+    results = asyncio.run(bench.run_bench("localhost", port, config))
+    assert results["config"]["assets"] == 20
+    for scenario in bench.SCENARIOS:
+        result = results["scenarios"][scenario]
+        assert result["requests"] == 40
+        assert result["errors"] == 0
+        assert 0 < result["p50_ms"] <= result["p99_ms"] <= result["max_ms"]
+
+    # Seeding the same server again reuses its tags
+    results = asyncio.run(bench.run_bench("localhost", port, config))
+    assert results["config"]["assets"] == 20
+
+
+def test_batch_upload_too_large(db_url):
+    with run_sham_server(db_url, "--max_batch_upload_size", "1000") as url:
+        files = [("file", (f"{i}.txt", b"x" * 400)) for i in range(3)]
+        res = requests.post(url + "/assets/batch", files=files)
+        assert res.status_code == 413
+
+        res = requests.post(url + "/assets/batch", files=files[:1])
+        assert res.status_code == 200
+
+
+def test_bench_seed_errors(db_url):
+    with run_sham_server(db_url, "--max_upload_size", "10") as url:
+        port = int(url.rpartition(":")[2])
+        config = bench.BenchConfig(assets=1, tags=1, concurrency=1, asset_size=100)
+        with pytest.raises(RuntimeError, match="failed with 413"):
+            asyncio.run(bench.run_bench("localhost", port, config))
+
+
+def test_workers(db_url):
+    with tempfile.TemporaryDirectory() as d:
+        # Settings can come from the environment as well as flags
+        env = {
+            **os.environ,
+            "SHAM_ASSET_DIR": d,
+            "SHAM_TAG_INDEX": "true",
+            "SHAM_METRICS_INTERVAL": "0.1",
+        }
+        with run_sham_server(db_url, "--workers", "2", env=env) as url:
+            tag = {"key": "a", "value": "b", "linked_asset_id": None}
+            tag_id = requests.post(url + "/tags", json=tag).json()["id"]
+
+            asset_ids = []
+            for i in range(10):
+                res = requests.post(
+                    url + "/assets", params={"filename": f"{i}.txt"}, data=b"x"
+                ).json()
+                asset_ids.append(res["id"])
+                res = requests.post(url + f"/assets/{res['id']}/tags", json={"tag_id": tag_id})
+                assert res.status_code == 200
+
+            # Whichever worker answers has its own pool and caches, and they
+            # all see the same data
+            for _ in range(50):
+                res = requests.get(url + "/assets", params={"tag": tag_id}).json()
+                if len(res["asset"]) == 10:
+                    break
+                time.sleep(0.05)
+            assert [asset["id"] for asset in res["asset"]] == asset_ids
+
+            for asset_id in asset_ids:
+                assert requests.get(url + f"/assets/{asset_id}").content == b"x"
+
+            # Any worker's `GET /metrics` has every worker's series, the others
+            # as of their last write
+            for _ in range(50):
+                text = requests.get(url + "/metrics").text
+                uploaded = re.findall(r'sham_upload_bytes_total\{worker="(\d+)"\} (\S+)', text)
+                if sum(float(value) for _, value in uploaded) == 10:
+                    break
+                time.sleep(0.05)
+            assert sum(float(value) for _, value in uploaded) == 10
+            assert len({worker for worker, _ in uploaded}) == 2
+            assert text.count("# TYPE sham_upload_bytes_total counter") == 1
+
+            res = requests.get(url + "/assets/facets", params={"tag": tag_id}).json()
+            assert res == {
+                "total": 10,
+                "facets": {"a": [{"tag_id": tag_id, "value": "b", "count": 10}]},
+            }
+
+        # Uploads went to the asset_dir from the environment
+        assert len([path for path in Path(d).rglob("*") if path.is_file()]) == 10
+
+
+def test_tag_suggest_usage(db_url):
+    with run_sham_server(db_url, "--tag_usage_interval", "0.05") as url:
+        ids = []
+        for value in ["sm64", "snes"]:
+            tag = {"key": "game", "value": value, "linked_asset_id": None}
+            ids.append(requests.post(url + "/tags", json=tag).json()["id"])
+        sm64, snes = ids
+
+        for i in range(2):
+            res = requests.post(url + "/assets", params={"filename": f"{i}.txt"}, data=b"x")
+            requests.post(url + f"/assets/{res.json()['id']}/tags", json={"tag_id": snes})
+
+        # Suggestions are ranked by how many assets have each tag, which is
+        # recounted in the background
+        for _ in range(100):
+            res = requests.get(url + "/tags/suggest", params={"q": "s"}).json()
+            if res[0]["count"] == 2:
+                break
+            time.sleep(0.02)
+        assert res == [
+            {"tag_id": snes, "key": "game", "value": "snes", "linked_asset_id": None, "count": 2},
+            {"tag_id": sm64, "key": "game", "value": "sm64", "linked_asset_id": None, "count": 0},
+        ]
+
+
+def test_write_batching(db_url):
+    with run_sham_server(db_url, "--write_batching") as url:
+        res = requests.post(url + "/assets", params={"filename": "a.txt"}, data=b"a")
+        asset_id = res.json()["id"]
+
+        tag = {"key": "a", "value": "b", "linked_asset_id": None}
+        tag_id = requests.post(url + "/tags", json=tag).json()["id"]
+
+        res = requests.post(url + f"/assets/{asset_id}/tags", json={"tag_id": tag_id})
+        assert res.status_code == 200
+        assert requests.get(url + f"/assets/{asset_id}/tags").json() == [tag_id]
+
+        # Errors still reach the request that caused them
+        res = requests.post(url + "/assets/12345/tags", json={"tag_id": tag_id})
+        assert res.status_code == 500
+
+        res = requests.delete(url + f"/assets/{asset_id}/tags/{tag_id}")
+        assert res.status_code == 200
+        assert requests.get(url + f"/assets/{asset_id}/tags").json() == []
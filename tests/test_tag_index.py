@@ -0,0 +1,58 @@
+from sham.tag_index import Bitmap, CHUNK_BITS
+
+import pytest
+
+# Ids on both sides of chunk boundaries
+IDS = [0, 1, 5, CHUNK_BITS - 1, CHUNK_BITS, 3 * CHUNK_BITS + 7, 10 * CHUNK_BITS]
+
+
+def test_bitmap_membership():
+    bitmap = Bitmap.from_ids(IDS)
+    assert list(bitmap) == IDS
+    assert len(bitmap) == len(IDS)
+    assert all(i in bitmap for i in IDS)
+    assert 2 not in bitmap
+    assert CHUNK_BITS + 1 not in bitmap
+
+    for i in IDS:
+        bitmap.discard(i)
+    bitmap.discard(12345)
+    assert bitmap == Bitmap()
+    assert bitmap.chunks == {}
+
+
+@pytest.mark.parametrize(
+    "a,b",
+    [
+        ([], []),
+        (IDS, []),
+        ([], IDS),
+        (IDS, IDS[::2]),
+        ([1, 2, 3], [3, 4, CHUNK_BITS + 3]),
+        (IDS, [CHUNK_BITS - 1, CHUNK_BITS + 1, 20 * CHUNK_BITS]),
+    ]
+)
+def test_bitmap_set_operations(a, b):
+    left, right = Bitmap.from_ids(a), Bitmap.from_ids(b)
+    assert list(left & right) == sorted(set(a) & set(b))
+    assert list(left | right) == sorted(set(a) | set(b))
+    assert list(left - right) == sorted(set(a) - set(b))
+
+    # Empty chunks aren't kept around
+    assert 0 not in (left & right).chunks.values()
+    assert 0 not in (left - right).chunks.values()
+
+
+@pytest.mark.parametrize(
+    "after_id,expected",
+    [
+        (-1, IDS),
+        (0, IDS[1:]),
+        (4, IDS[2:]),
+        (CHUNK_BITS - 1, IDS[4:]),
+        (CHUNK_BITS, IDS[5:]),
+        (10 * CHUNK_BITS, []),
+    ]
+)
+def test_bitmap_after(after_id, expected):
+    assert list(Bitmap.from_ids(IDS).after(after_id)) == expected
@@ -0,0 +1,57 @@
+from sham.app import TagResult
+from sham.tag_suggest import TagSuggestions
+
+
+def tag(tag_id, key, value):
+    return TagResult(tag_id=tag_id, key=key, value=value, linked_asset_id=None)
+
+
+TAGS = [
+    tag(1, "game", "Super Mario 64"),
+    tag(2, "game", "Zelda"),
+    tag(3, "level", "Bob-omb Battlefield"),
+    tag(4, "level", "Big Boo's Haunt"),
+    tag(5, "gameplay", "speedrun"),
+]
+
+
+def ids(tags):
+    return [tag.tag_id for tag in tags]
+
+
+def test_suggest_prefixes():
+    suggestions = TagSuggestions(TAGS)
+    assert ids(suggestions.suggest("zel")) == [2]
+    # Keys, words inside values and key:value all match, ignoring case
+    assert sorted(ids(suggestions.suggest("GAME"))) == [1, 2, 5]
+    assert ids(suggestions.suggest("battle")) == [3]
+    assert ids(suggestions.suggest("level:big")) == [4]
+    # Shorter values first when nothing else tells them apart
+    assert ids(suggestions.suggest("b")) == [4, 3]
+    assert suggestions.suggest("") == []
+    assert suggestions.suggest("nope") == []
+
+
+def test_suggest_ranking():
+    suggestions = TagSuggestions(TAGS)
+    # Exact matches first, then the most used
+    assert ids(suggestions.suggest("game", usage={5: 100, 2: 10})) == [2, 1, 5]
+    assert ids(suggestions.suggest("b", usage={3: 3})) == [3, 4]
+    assert ids(suggestions.suggest("game", limit=1)) == [2]
+
+
+def test_suggest_changes():
+    suggestions = TagSuggestions(TAGS)
+    assert ids(suggestions.suggest("zel")) == [2]
+
+    suggestions.add(tag(6, "game", "Zelda II"))
+    suggestions.add(tag(2, "game", "Link"))
+    assert ids(suggestions.suggest("zel")) == [6]
+    assert ids(suggestions.suggest("link")) == [2]
+
+    suggestions.remove(6)
+    assert suggestions.suggest("zel") == []
+
+    # New usage counts rank again rather than reusing earlier results
+    assert ids(suggestions.suggest("b", usage={3: 3})) == [3, 4]
+    assert ids(suggestions.suggest("b", usage={4: 3})) == [4, 3]